@@ -9,6 +9,9 @@ class Config(BaseConfig):
     test_dataset_file = 'test.csv'
     data_version = '3d'  # '3d', 'npy', 'npy256' etc.
     use_cq500 = False
+    # skip slices with fraction of soft tissue pixels below the value in training, predict them with a constant
+    # calibrated on training folds at inference, see data.blank_slices. None disables skipping
+    blank_tissue_fraction = None
     train_folds = [0, 1, 2, 3]
     val_folds = [4]
 
@@ -47,10 +50,40 @@ class Config(BaseConfig):
     freeze_first_layer = True
 
     gpus = [1]
+    # 'dp' or 'ddp', with 'ddp' each process samples a disjoint part of the dataset and batch_size is per process
+    distributed_backend = 'dp'
+    # seed of distributed samplers, must be the same in all processes
+    sampler_seed = 0
+    # number of DataLoader workers, or 'auto' to calibrate it with a short run at the start of training
     num_workers = 3 * len(gpus)
+    # cv2, torch and BLAS threads of each worker, None for available cpus // num_workers
+    worker_threads = None
+    # restrict each worker to its own subset of CPUs
+    pin_worker_cpus = False
 
     max_epoch = 20
 
+    # memory budget of preprocessed slices cache shared by DataLoader workers, 0 disables the cache
+    slice_cache_bytes = 0
+    # directory of converted slices kept between runs, keyed by a hash of preprocessing fields of the config
+    # (see data.preprocessing_cache), None disables the disk cache
+    preprocessing_cache_dir = None
+    preprocessing_cache_bytes = 50 * 2 ** 30
+    # number of upcoming samples whose slices are read into the slice cache by threads of the main process,
+    # used only with slice_cache_bytes > 0, 0 disables prefetching
+    prefetch_depth = 0
+    prefetch_threads = 8
+
+    # shuffle studies and feed contiguous runs of slices, so that overlapping windows reuse loaded slices
+    study_block_sampling = False
+    # max length of a run of slices from one study, None for whole study
+    study_block_size = 32
+    # number of studies interleaved in the sampled sequence
+    study_block_interleave = 2
+    # number of studies kept in memory of each worker, only useful with samples grouped by study
+    # (study_block_sampling), 0 disables
+    study_slabs = 0
+
     append_masks = False
     num_slices = 9  # must be odd
     pre_crop_size = 400
@@ -58,11 +91,34 @@ class Config(BaseConfig):
     crop_size = 448
     shift_limit = 0.1
     random_crop = False
+    # crop samples to the head box of their study or window of slices ('study' or 'slice') instead of crop_size
+    # center or random crop, see data.roi_crop. None disables it
+    roi_crop = None
+    # pixels added around the head box, in slices of padded_size or pre_crop_size
+    roi_margin = 16
+    # size the crop is resized to, None to enlarge it to the smallest fitting size of roi_buckets without resize
+    roi_size = 320
+    roi_buckets = [256, 320, 384, 448]
     vertical_flip = False
     pixel_augment = False
     elastic_transform = False
     use_cdf = True
     augment = True
+    # apply flips, shift/scale/rotate and crop to whole batches in the main process instead of dataset workers
+    batch_augment = False
+    # load, convert and crop samples in a single pass, used when no per sample spatial augmentation is needed
+    fused_preprocessing = False
+    # load whole batches in workers with dataset.get_batch, slices are read once per study and converted at once,
+    # used with fused preprocessing, other samples are loaded one by one
+    batch_fetch = False
+    # workers write samples into a ring of preallocated shared memory batches instead of sending them through
+    # DataLoader queues, see data.batch_ring. Takes precedence over batch_fetch
+    batch_ring = False
+    # number of batches in the ring, None for 2 * num_workers + 1
+    batch_ring_slots = None
+    # dtype of images sent from DataLoader workers, None keeps float images: 'float16', 'uint8' (quantized values)
+    # or 'int16' (HU values converted on the training device, needs batch_augment or no augmentation)
+    transport_dtype = None
 
     # used only if use_cdf is False
     min_hu_value = 20
@@ -0,0 +1,12 @@
+from rsna19.configs.base_config import BaseConfig
+from rsna19.configs.clf2Dc_resnet34_3x3 import Config as Resnet34Config
+
+
+class Config(Resnet34Config):
+    """clf2Dc_resnet34_3x3 trained on crops of the head box resized to 320 instead of 384 center crops"""
+    train_out_dir = BaseConfig.model_outdir + '/0036_3x3_roi_320' + Resnet34Config.folds_str
+
+    roi_crop = 'study'
+    roi_margin = 16
+    roi_size = 320
+    roi_buckets = None
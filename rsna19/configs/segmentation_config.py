@@ -44,6 +44,13 @@ class Config(BaseConfig):
 
     max_epoch = 60
 
+    # memory budget of preprocessed slices cache shared by DataLoader workers, 0 disables the cache
+    slice_cache_bytes = 0
+    # directory of converted slices kept between runs, keyed by a hash of preprocessing fields of the config
+    # (see data.preprocessing_cache), None disables the disk cache
+    preprocessing_cache_dir = None
+    preprocessing_cache_bytes = 50 * 2 ** 30
+
     negative_data_steps = [2000, 4500, 7000]
     # negative_data_steps = None
 
@@ -61,6 +68,8 @@ class Config(BaseConfig):
     elastic_transform = False
     use_cdf = True
     augment = True
+    # apply flips, shift/scale/rotate and crop to whole batches in the main process instead of dataset workers
+    batch_augment = False
 
     # used only if use_cdf is False
     min_hu_value = 20
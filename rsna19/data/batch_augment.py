@@ -0,0 +1,182 @@
+import inspect
+import math
+
+import torch
+import torch.nn.functional as F
+
+# torch < 1.3 has no align_corners argument and samples as with align_corners=True,
+# newer versions default to False, so it is passed explicitly when supported
+GRID_ARGS = {'align_corners': True} if 'align_corners' in inspect.signature(F.grid_sample).parameters else {}
+
+
+class BatchAugmentation:
+    """Random affine augmentation of a whole collated batch with a single grid_sample call.
+
+    Shift, scale and rotation are drawn per sample with the same meaning as albumentations.ShiftScaleRotate
+    (shift as a fraction of image size, scale as 1 +- scale_limit, rotation in degrees), and are combined with
+    flips, 90 degrees rotations and crop into one sampling grid. Images and masks get the same transform,
+    masks are sampled with nearest interpolation.
+    Runs on the device of the input batch, or on the given device. On CPU torch uses intra-op threads.
+    """
+
+    def __init__(self,
+                 shift_limit=0.0625,
+                 scale_limit=0.1,
+                 rotate_limit=45,
+                 p=0.5,
+                 hflip=0.5,
+                 vflip=0.0,
+                 rotate90=False,
+                 crop_size=None,
+                 random_crop=False,
+                 border_mode='zeros',
+                 fill_value=0.0,
+                 seed=None,
+                 device=None):
+        """
+        :param p: probability of applying shift, scale and rotation to a sample
+        :param hflip: probability of horizontal flip
+        :param vflip: probability of vertical flip
+        :param rotate90: if True, samples are randomly rotated by a multiple of 90 degrees
+        :param crop_size: output size, None keeps the input size
+        :param random_crop: if True, crop position is random, otherwise crop is centered
+        :param border_mode: grid_sample padding mode, 'zeros' (filled with fill_value) or 'border' (replicate)
+        :param fill_value: value of pixels outside of the input image, used with 'zeros' border mode
+        :param seed: seed of the random generator, None for random seed
+        :param device: device to run augmentation on, None to use device of the input batch
+        """
+        self.shift_limit = shift_limit
+        self.scale_limit = scale_limit
+        self.rotate_limit = rotate_limit
+        self.p = p
+        self.hflip = hflip
+        self.vflip = vflip
+        self.rotate90 = rotate90
+        self.crop_size = crop_size
+        self.random_crop = random_crop
+        self.border_mode = border_mode
+        self.fill_value = fill_value
+        self.device = device
+
+        # parameters are always drawn on cpu, so results don't depend on the device
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def _uniform(self, n, low, high):
+        return torch.rand(n, generator=self.generator, dtype=torch.float64) * (high - low) + low
+
+    def _bernoulli(self, n, p):
+        return torch.rand(n, generator=self.generator, dtype=torch.float64) < p
+
+    def sample_matrices(self, n, height, width):
+        """Return (n, 2, 3) affine matrices mapping output to input normalized coordinates"""
+        enabled = self._bernoulli(n, self.p).double()
+        angle = self._uniform(n, -self.rotate_limit, self.rotate_limit) * enabled
+        scale = 1 + self._uniform(n, -self.scale_limit, self.scale_limit) * enabled
+        dx = self._uniform(n, -self.shift_limit, self.shift_limit) * enabled
+        dy = self._uniform(n, -self.shift_limit, self.shift_limit) * enabled
+
+        if self.rotate90:
+            angle = angle + torch.randint(0, 4, (n,), generator=self.generator).double() * 90
+
+        # forward transform in pixel units centered at the image center: p_out = scale * R * p_in + shift
+        rad = angle * math.pi / 180
+        cos, sin = torch.cos(rad), torch.sin(rad)
+        forward = torch.zeros(n, 3, 3, dtype=torch.float64)
+        forward[:, 0, 0] = scale * cos
+        forward[:, 0, 1] = -scale * sin
+        forward[:, 1, 0] = scale * sin
+        forward[:, 1, 1] = scale * cos
+        forward[:, 0, 2] = dx * width
+        forward[:, 1, 2] = dy * height
+        forward[:, 2, 2] = 1
+
+        # output pixel coordinates of the crop window, as a transform of normalized output coordinates
+        out_height, out_width = (height, width) if self.crop_size is None else (self.crop_size, self.crop_size)
+        if self.random_crop:
+            offset_x = (torch.rand(n, generator=self.generator, dtype=torch.float64) - 0.5) * (width - out_width)
+            offset_y = (torch.rand(n, generator=self.generator, dtype=torch.float64) - 0.5) * (height - out_height)
+        else:
+            offset_x = torch.zeros(n, dtype=torch.float64)
+            offset_y = torch.zeros(n, dtype=torch.float64)
+
+        flip_x = torch.where(self._bernoulli(n, self.hflip), -torch.ones(n), torch.ones(n)).double()
+        flip_y = torch.where(self._bernoulli(n, self.vflip), -torch.ones(n), torch.ones(n)).double()
+
+        out_to_pixels = torch.zeros(n, 3, 3, dtype=torch.float64)
+        # with align_corners=True normalized -1 and 1 are centers of the corner pixels
+        out_to_pixels[:, 0, 0] = flip_x * (out_width - 1) / 2
+        out_to_pixels[:, 1, 1] = flip_y * (out_height - 1) / 2
+        out_to_pixels[:, 0, 2] = offset_x
+        out_to_pixels[:, 1, 2] = offset_y
+        out_to_pixels[:, 2, 2] = 1
+
+        pixels_to_in = torch.diag(torch.tensor([2 / (width - 1), 2 / (height - 1), 1], dtype=torch.float64))
+
+        theta = pixels_to_in @ torch.inverse(forward) @ out_to_pixels
+        return theta[:, :2, :]
+
+    def __call__(self, images, masks=None):
+        """
+        :param images: (N, C, H, W) tensor
+        :param masks: optional (N, C_mask, H, W) tensor, transformed with the same parameters as images
+        :return: augmented images, or (images, masks) if masks are given
+        """
+        if self.device is not None:
+            images = images.to(self.device)
+            masks = masks.to(self.device) if masks is not None else None
+
+        n, _, height, width = images.shape
+        out_size = (height, width) if self.crop_size is None else (self.crop_size, self.crop_size)
+        theta = self.sample_matrices(n, height, width).to(device=images.device, dtype=torch.float32)
+        grid = F.affine_grid(theta, [n, images.shape[1], out_size[0], out_size[1]], **GRID_ARGS)
+
+        images = images.float()
+        if self.border_mode == 'zeros' and self.fill_value != 0:
+            images = F.grid_sample(images - self.fill_value, grid, mode='bilinear', padding_mode='zeros',
+                                   **GRID_ARGS) + self.fill_value
+        else:
+            images = F.grid_sample(images, grid, mode='bilinear', padding_mode=self.border_mode, **GRID_ARGS)
+
+        if masks is None:
+            return images
+
+        masks = F.grid_sample(masks.float(), grid, mode='nearest', padding_mode='zeros', **GRID_ARGS)
+        return images, masks
+
+
+def check_augmentation():
+    import time
+
+    images = torch.zeros(4, 3, 400, 400)
+    images[:, :, 150:250, 100:200] = 1
+    masks = images[:, :1].clone()
+
+    aug = BatchAugmentation(shift_limit=0, scale_limit=0, rotate_limit=0, p=1.0, hflip=0, crop_size=384, seed=0)
+    out_images, out_masks = aug(images, masks)
+    assert torch.allclose(out_images, images[:, :, 8:392, 8:392], atol=1e-4)
+    assert torch.equal(out_masks, masks[:, :, 8:392, 8:392])
+
+    aug = BatchAugmentation(shift_limit=0, scale_limit=0, rotate_limit=0, p=1.0, hflip=1.0, seed=0)
+    assert torch.allclose(aug(images), images.flip(3), atol=1e-4)
+
+    # 90 degrees rotation doesn't interpolate
+    aug = BatchAugmentation(shift_limit=0, scale_limit=0, rotate_limit=90, p=1.0, hflip=0, seed=0)
+    aug._uniform = lambda n, low, high: torch.full((n,), high if high == 90 else 0, dtype=torch.float64)
+    out_images = aug(images)
+    assert any(torch.allclose(out_images, images.rot90(k, dims=(2, 3)), atol=1e-4) for k in (1, 3))
+
+    aug = BatchAugmentation(shift_limit=0.1, scale_limit=0.15, rotate_limit=30, p=0.9, crop_size=384,
+                            random_crop=True, fill_value=-1, seed=0)
+    images = torch.rand(24, 9, 400, 400)
+    start = time.time()
+    for _ in range(10):
+        aug(images)
+    print(f'{(time.time() - start) / 10 * 1000:.1f} ms per batch of 24x9x400x400, {torch.get_num_threads()} threads')
+
+
+if __name__ == '__main__':
+    check_augmentation()
@@ -0,0 +1,96 @@
+""" Batch level fetching from datasets.
+
+The DataLoader calls dataset[idx] once per index and collates samples afterwards, so per sample overhead is paid
+batch_size times. batch_fetch_loader() instead passes whole batches of indices from a batch sampler to
+dataset.get_batch(indices), which returns collated batches. Datasets without get_batch are loaded per item and
+collated in workers, so any dataset can be used.
+
+torch 1.1 DataLoader has no batch level dataset hook, so batches of indices are passed as single items of a
+sampler with batch_size=1 and the collate function unwraps them.
+"""
+import time
+
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.dataloader import default_collate
+
+
+def get_batch(dataset, indices):
+    """Return collated samples of indices, using dataset.get_batch if the dataset implements it"""
+    if hasattr(dataset, 'get_batch'):
+        return dataset.get_batch(indices)
+    return default_collate([dataset[idx] for idx in indices])
+
+
+class BatchFetchDataset(Dataset):
+    """Dataset whose items are whole batches, indexed by lists of indices of the wrapped dataset"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        return get_batch(self.dataset, indices)
+
+
+def unwrap_batch(items):
+    return items[0]
+
+
+def batch_fetch_loader(dataset, batch_sampler, **kwargs):
+    """DataLoader of batches loaded by dataset.get_batch
+
+    :param batch_sampler: sampler of lists of indices, e.g. BatchSampler or BalancedBatchSampler
+    :param kwargs: other DataLoader arguments, e.g. num_workers, worker_init_fn, pin_memory
+    """
+    return DataLoader(BatchFetchDataset(dataset), sampler=batch_sampler, batch_size=1, collate_fn=unwrap_batch,
+                      **kwargs)
+
+
+def check_batch_fetch(num_studies=6, batch_size=32, num_workers=2):
+    """Compare batches and throughput of per item and batch loading of dataset_2dc with fused preprocessing"""
+    import tempfile
+
+    import torch
+    from torch.utils.data import BatchSampler, SequentialSampler
+
+    from rsna19.configs.clf2Dc import Config
+    from rsna19.data import synthetic
+    from rsna19.data.dataset_2dc import IntracranialDataset
+    from rsna19.models.commons.study_block_sampler import StudyBlockSampler
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_root, csv_root_dir = synthetic.generate_dataset(tmp_dir, num_studies, num_slices=(30, 40))
+
+        for transport_dtype in [None, 'int16']:
+            class config(Config):
+                pass
+            config.data_root = data_root
+            config.csv_root_dir = csv_root_dir
+            config.val_dataset_file = '5fold.csv'
+            config.fused_preprocessing = True
+            config.transport_dtype = transport_dtype
+            dataset = IntracranialDataset(config, list(range(config.nb_folds)), mode='val')
+
+            batch = get_batch(dataset, list(range(batch_size)))
+            expected = default_collate([dataset[idx] for idx in range(batch_size)])
+            assert torch.equal(batch['image'], expected['image']) and torch.equal(batch['labels'], expected['labels'])
+            assert batch['path'] == expected['path'] and batch['slice_num'] == expected['slice_num']
+            assert batch['study_id'] == expected['study_id']
+
+            for sampler_name, sampler in [('sequential', SequentialSampler(dataset)),
+                                          ('study blocks', StudyBlockSampler(*dataset.study_slice_index()))]:
+                batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+                for name, data_loader in [
+                    ('per item', DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers)),
+                    ('batch', batch_fetch_loader(dataset, batch_sampler, num_workers=num_workers))
+                ]:
+                    start = time.time()
+                    num_samples = sum(len(batch['path']) for batch in data_loader)
+                    print(f'{str(transport_dtype):5s} {sampler_name:12s} {name:8s}: '
+                          f'{num_samples / (time.time() - start):.0f} samples/s')
+
+
+if __name__ == '__main__':
+    check_batch_fetch()
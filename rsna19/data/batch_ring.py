@@ -0,0 +1,258 @@
+""" Ring of preallocated shared memory batch slots filled by loader processes.
+
+The DataLoader pickles each sample dict in workers, moves its tensors to shared memory (file descriptors or files
+with the file_system sharing strategy) and collates them with another copy in the main process. BatchRingLoader
+allocates num_slots batches of every tensor field in anonymous shared memory before workers are forked:
+ * the main process sends (batch number, slot, indices) of a batch to the task queue
+ * a worker writes each sample directly into its position of the slot and reports the slot as ready
+ * the main process yields views of the slot images, without any copy, in the order of the batch sampler,
+   other tensor fields (labels, roi, ...) are small and are copied out of the slot
+ * the slot is consumed, and reused for another batch, when the next batch is requested
+
+Yielded images are only valid until the next batch is taken from the iterator, a consumer keeping them longer
+has to copy them, moving them to GPU is enough. Other fields can be kept, e.g. labels accumulated by predict.
+String fields are not sent from workers, only dataset indices (int64) of the batch travel with the slot and
+strings are looked up in the main process with dataset.batch_metadata(indices).
+
+Tensor shapes and dtypes of fields are taken from the first sample of the dataset, all samples must match it,
+so roi_crop size buckets of dataset_2dc are not supported. Only fork start method is supported, like data.slice_cache.
+"""
+import mmap
+import multiprocessing
+import queue
+import random
+import time
+import traceback
+
+import numpy as np
+import torch
+
+# slot states, kept in shared memory
+SLOT_FREE, SLOT_FILLING, SLOT_READY = 0, 1, 2
+
+
+def shared_array(shape, dtype):
+    """numpy array in anonymous shared memory, visible to processes forked after its creation"""
+    dtype = np.dtype(dtype)
+    num_bytes = int(np.prod(shape)) * dtype.itemsize
+    buffer = mmap.mmap(-1, max(num_bytes, 1))
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+class BatchRingLoader:
+    """Iterable of batches of dataset, with the batch_sampler and num_workers of a DataLoader, see module docstring"""
+    # yielded images are overwritten by later batches, see InferenceRunner
+    reuses_batches = True
+    # fields yielded as views of slots, other tensor fields are copied
+    view_fields = ('image',)
+
+    def __init__(self, dataset, batch_sampler, num_workers=2, num_slots=None, worker_init_fn=None, batch_size=None,
+                 timeout=600):
+        """
+        :param batch_sampler: sampler of lists of indices, e.g. BatchSampler or BalancedBatchSampler
+        :param num_slots: number of batches in the ring, defaults to 2 * num_workers + 1
+        :param batch_size: max length of batches, defaults to batch_sampler.batch_size
+        :param timeout: seconds to wait for a batch before raising
+        """
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        # DataLoader attributes read by training frameworks
+        self.sampler = batch_sampler
+        self.num_workers = num_workers
+        self.num_slots = num_slots or 2 * max(num_workers, 1) + 1
+        self.worker_init_fn = worker_init_fn
+        self.batch_size = batch_size or batch_sampler.batch_size
+        self.timeout = timeout
+
+        roi_bucket_ids = getattr(dataset, 'roi_bucket_ids', None)
+        if roi_bucket_ids is not None and roi_bucket_ids() is not None:
+            raise ValueError('batch_ring slots have the image size of the first sample, '
+                             'it is not possible with roi_crop size buckets (roi_size None)')
+
+        sample = dataset[0]
+        self.tensor_fields = [name for name, value in sample.items() if isinstance(value, torch.Tensor)]
+        self.string_fields = [name for name in sample if name not in self.tensor_fields]
+        if self.string_fields and not hasattr(dataset, 'batch_metadata'):
+            raise ValueError(f'fields {self.string_fields} are not tensors, dataset has to implement batch_metadata')
+
+        self.slots = {}
+        for name in self.tensor_fields:
+            value = sample[name]
+            array = shared_array((self.num_slots, self.batch_size) + tuple(value.shape),
+                                 value.numpy().dtype)
+            self.slots[name] = torch.from_numpy(array)
+        self.slot_indices = torch.from_numpy(shared_array((self.num_slots, self.batch_size), np.int64))
+        self.slot_lengths = shared_array((self.num_slots,), np.int64)
+        self.slot_states = shared_array((self.num_slots,), np.int64)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def write_batch(self, slot, indices):
+        """Load samples of indices into slot, called by workers (or the main process without workers)"""
+        self.slot_states[slot] = SLOT_FILLING
+        for position, idx in enumerate(indices):
+            sample = self.dataset[idx]
+            for name in self.tensor_fields:
+                self.slots[name][slot, position].copy_(sample[name])
+        self.slot_indices[slot, :len(indices)] = torch.as_tensor(indices, dtype=torch.int64)
+        self.slot_lengths[slot] = len(indices)
+        self.slot_states[slot] = SLOT_READY
+
+    def read_batch(self, slot):
+        """Batch of slot, images are views of shared tensors and other fields are copies"""
+        length = int(self.slot_lengths[slot])
+        batch = {name: self.slots[name][slot, :length] if name in self.view_fields else
+                 self.slots[name][slot, :length].clone() for name in self.tensor_fields}
+        if self.string_fields:
+            metadata = self.dataset.batch_metadata(self.slot_indices[slot, :length].numpy())
+            batch.update({name: metadata[name] for name in self.string_fields})
+        return batch
+
+    def worker_loop(self, worker_id, base_seed, tasks, done):
+        seed = base_seed + worker_id
+        torch.manual_seed(seed)
+        random.seed(seed)
+        np.random.seed(seed % 2 ** 32)
+        if self.worker_init_fn is not None:
+            self.worker_init_fn(worker_id)
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            batch_num, slot, indices = task
+            try:
+                self.write_batch(slot, indices)
+                done.put((batch_num, slot, None))
+            except Exception:
+                done.put((batch_num, slot, traceback.format_exc()))
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            slot = 0
+            for indices in self.batch_sampler:
+                self.write_batch(slot, indices)
+                yield self.read_batch(slot)
+                self.slot_states[slot] = SLOT_FREE
+            return
+
+        context = multiprocessing.get_context('fork')
+        tasks = context.Queue()
+        done = context.Queue()
+        base_seed = int(torch.empty((), dtype=torch.int64).random_())
+        workers = [context.Process(target=self.worker_loop, args=(worker_id, base_seed, tasks, done), daemon=True)
+                   for worker_id in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+
+        free_slots = list(range(self.num_slots))
+        self.slot_states[:] = SLOT_FREE
+        batches = enumerate(iter(self.batch_sampler))
+        ready = {}
+        next_batch = 0
+        num_sent = 0
+        consumed_slot = None
+        try:
+            while True:
+                if consumed_slot is not None:
+                    self.slot_states[consumed_slot] = SLOT_FREE
+                    free_slots.append(consumed_slot)
+                    consumed_slot = None
+
+                while free_slots:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    batch_num, indices = batch
+                    tasks.put((batch_num, free_slots.pop(), list(indices)))
+                    num_sent += 1
+
+                if next_batch == num_sent:
+                    break
+
+                while next_batch not in ready:
+                    try:
+                        batch_num, slot, error = done.get(timeout=self.timeout)
+                    except queue.Empty:
+                        raise RuntimeError(f'batch {next_batch} not loaded in {self.timeout} s')
+                    if error is not None:
+                        raise RuntimeError(f'loading batch {batch_num} failed:\n{error}')
+                    ready[batch_num] = slot
+
+                slot = ready.pop(next_batch)
+                next_batch += 1
+                # the slot is consumed when the next batch is requested
+                consumed_slot = slot
+                yield self.read_batch(slot)
+        finally:
+            for _ in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    worker.terminate()
+
+
+def check_batch_ring(num_studies=6, batch_size=32, num_workers=2):
+    """Compare batches and throughput of DataLoader and BatchRingLoader on dataset_2dc"""
+    import tempfile
+
+    from torch.utils.data import BatchSampler, DataLoader, SequentialSampler
+
+    from rsna19.configs.clf2Dc import Config
+    from rsna19.data import synthetic
+    from rsna19.data.dataset_2dc import IntracranialDataset
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_root, csv_root_dir = synthetic.generate_dataset(tmp_dir, num_studies, num_slices=(30, 40))
+
+        class config(Config):
+            pass
+        config.data_root = data_root
+        config.csv_root_dir = csv_root_dir
+        config.val_dataset_file = '5fold.csv'
+        dataset = IntracranialDataset(config, list(range(config.nb_folds)), mode='val')
+        batch_sampler = BatchSampler(SequentialSampler(dataset), batch_size, drop_last=False)
+
+        for name, data_loader in [
+            ('DataLoader', DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers)),
+            ('BatchRingLoader', BatchRingLoader(dataset, batch_sampler, num_workers=num_workers))
+        ]:
+            start = time.time()
+            batches = []
+            kept_labels = []
+            for batch in data_loader:
+                # yielded images are reused by later batches
+                batches.append({key: value.clone() if isinstance(value, torch.Tensor) else value
+                                for key, value in batch.items()})
+                # other fields can be kept without a copy, like predict does with labels
+                kept_labels.append(batch['labels'])
+            print(f'{name}: {sum(len(batch["path"]) for batch in batches) / (time.time() - start):.0f} samples/s')
+
+            if name == 'DataLoader':
+                expected = batches
+            else:
+                assert len(batches) == len(expected)
+                for batch, expected_batch in zip(batches, expected):
+                    assert batch.keys() == expected_batch.keys()
+                    assert torch.equal(batch['image'], expected_batch['image'])
+                    assert torch.equal(batch['labels'], expected_batch['labels'])
+                    assert batch['path'] == expected_batch['path'] and batch['study_id'] == expected_batch['study_id']
+                    assert batch['slice_num'] == expected_batch['slice_num']
+                assert all(torch.equal(labels, batch['labels']) for labels, batch in zip(kept_labels, batches))
+
+        # images of roi_crop size buckets don't fit slots sized by the first sample
+        config.roi_crop = 'study'
+        config.roi_size = None
+        dataset = IntracranialDataset(config, list(range(config.nb_folds)), mode='val')
+        try:
+            BatchRingLoader(dataset, batch_sampler, num_workers=num_workers)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('BatchRingLoader accepted roi_crop size buckets')
+
+
+if __name__ == '__main__':
+    check_batch_ring()
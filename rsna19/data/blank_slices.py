@@ -0,0 +1,178 @@
+""" Skipping of slices without brain tissue.
+
+Slices at the top and bottom of a scan contain only skull, air or neck and are predicted close to 0. With
+config.blank_tissue_fraction set, slices whose fraction of soft tissue pixels (HU in TISSUE_HU range) is below it are
+dropped from training epochs, and predicted at inference with a constant calibrated on blank training slices.
+
+Tissue fractions are computed once and stored in csv_root_dir/tissue_fraction.csv, slices missing there are
+computed on the fly:
+
+    python rsna19/data/blank_slices.py compute --csv 5fold.csv test2.csv
+    python rsna19/data/blank_slices.py report --predictions <train_dir>/predictions/val_normal.csv --csv 5fold.csv
+"""
+import argparse
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from rsna19.configs.base_config import BaseConfig
+from rsna19.data.sample_index import LABEL_COLUMNS
+
+TISSUE_HU = (0, 100)
+TISSUE_FRACTION_CSV = 'tissue_fraction.csv'
+# weights of classes in the competition log loss
+CLASS_WEIGHTS = np.array([1.0, 1.0, 1.0, 1.0, 1.0, 2.0])
+
+
+def default_csv_root_dir(csv_root_dir=None):
+    return csv_root_dir or os.path.normpath(__file__ + '/../csv')
+
+
+def tissue_fraction(hu, step=4):
+    """Fraction of pixels in TISSUE_HU range, on a grid of every step-th pixel"""
+    hu = hu[::step, ::step]
+    return float(np.count_nonzero((hu >= TISSUE_HU[0]) & (hu <= TISSUE_HU[1])) / hu.size)
+
+
+def slice_tissue_fraction(args):
+    path, data_root, data_version = args
+    full_path = os.path.normpath(os.path.join(data_root, '..', path.replace('npy/', data_version + '/')))
+    try:
+        return tissue_fraction(np.load(full_path))
+    except FileNotFoundError:
+        # treated as tissue, so that missing slices are never skipped
+        return 1.0
+
+
+def compute_tissue_fractions(paths, data_root=None, data_version='npy', workers=8):
+    """Return tissue fraction of slices of csv paths, as Series indexed by path"""
+    data_root = data_root or BaseConfig.data_root
+    args = [(path, data_root, data_version) for path in paths]
+    if workers > 1 and len(args) > 1000:
+        with Pool(workers) as pool:
+            fractions = pool.map(slice_tissue_fraction, args, chunksize=256)
+    else:
+        fractions = [slice_tissue_fraction(a) for a in args]
+    return pd.Series(fractions, index=pd.Index(paths, name='path'), name='tissue_fraction')
+
+
+def load_tissue_fractions(csv_root_dir=None):
+    path = os.path.join(default_csv_root_dir(csv_root_dir), TISSUE_FRACTION_CSV)
+    if not os.path.exists(path):
+        return pd.Series([], index=pd.Index([], name='path'), name='tissue_fraction', dtype=np.float64)
+    return pd.read_csv(path, index_col='path')['tissue_fraction']
+
+
+def add_tissue_fraction(data, config):
+    """Return data with tissue_fraction column, fractions missing in tissue_fraction.csv are computed"""
+    if 'tissue_fraction' in data.columns:
+        return data
+
+    fractions = load_tissue_fractions(config.csv_root_dir)
+    missing = sorted(set(data.path) - set(fractions.index))
+    if missing:
+        print(f'computing tissue fraction of {len(missing)} slices, '
+              f'store them with: python rsna19/data/blank_slices.py compute')
+        fractions = pd.concat([fractions, compute_tissue_fractions(missing, config.data_root, config.data_version)])
+    return data.assign(tissue_fraction=fractions.reindex(data.path).values)
+
+
+def blank_mask(data, config):
+    """Boolean mask of rows of data (a dataset csv) with tissue fraction below config.blank_tissue_fraction"""
+    threshold = getattr(config, 'blank_tissue_fraction', None)
+    if threshold is None:
+        return np.zeros(len(data), dtype=bool)
+    return add_tissue_fraction(data, config).tissue_fraction.values < threshold
+
+
+def blank_prediction(data, eps=1e-4):
+    """Constant prediction of blank slices, mean labels of blank training slices in LABEL_COLUMNS order"""
+    if len(data) == 0:
+        return np.full(len(LABEL_COLUMNS), eps)
+    return np.clip(data[LABEL_COLUMNS].values.astype(np.float64).mean(axis=0), eps, 1 - eps)
+
+
+def calibrated_blank_prediction(config):
+    """blank_prediction() of blank slices of training folds of config"""
+    data = pd.read_csv(os.path.join(default_csv_root_dir(config.csv_root_dir), config.train_dataset_file))
+    data = data[data.fold.isin(config.train_folds)]
+    return blank_prediction(data[blank_mask(data, config)])
+
+
+def slice_num_of_path(path):
+    return int(os.path.basename(path).split('.')[0])
+
+
+def weighted_log_loss(gt, pred, eps=1e-7):
+    pred = np.clip(pred, eps, 1 - eps)
+    bce = -(gt * np.log(pred) + (1 - gt) * np.log(1 - pred))
+    return float((bce * CLASS_WEIGHTS).sum(axis=1).mean() / CLASS_WEIGHTS.sum())
+
+
+def report(predictions, data, thresholds, folds=None):
+    """Print fraction of skipped slices and log loss of OOF predictions with blank slices predicted by a constant.
+
+    The constant is calibrated on slices of other folds than the predicted ones.
+
+    :param predictions: DataFrame saved by models/clf2Dc/predict.py, with gt_*, pred_* and path columns
+    :param data: dataset csv with path, fold, labels and tissue_fraction columns
+    """
+    # predictions contain full paths of data_version, slices are matched by study id and slice number
+    data_study_ids = data.path.map(lambda p: p.split('/')[2])
+    fraction_by_slice = dict(zip(zip(data_study_ids, data.path.map(slice_num_of_path)), data.tissue_fraction))
+    fractions = np.array([fraction_by_slice.get((study_id, int(slice_num)), np.nan)
+                          for study_id, slice_num in zip(predictions.study_id, predictions.slice_num)])
+    if folds is None:
+        folds = sorted(int(fold) for fold in data.fold[data_study_ids.isin(set(predictions.study_id))].unique())
+    train_data = data[~data.fold.isin(folds)]
+
+    gt = predictions[['gt_' + c for c in LABEL_COLUMNS]].values
+    pred = predictions[['pred_' + c for c in LABEL_COLUMNS]].values
+    base = weighted_log_loss(gt, pred)
+    print(f'{len(predictions)} slices of folds {folds}, log loss {base:.5f}')
+    for threshold in thresholds:
+        blank = fractions < threshold
+        skipped = pred.copy()
+        skipped[blank] = blank_prediction(train_data[train_data.tissue_fraction < threshold])
+        loss = weighted_log_loss(gt, skipped)
+        print(f'tissue fraction < {threshold}: {blank.mean() * 100:.1f}% of slices (and model runs) skipped, '
+              f'log loss {loss:.5f} ({loss - base:+.5f})')
+        if blank.any():
+            print(f'  log loss of skipped slices: model {weighted_log_loss(gt[blank], pred[blank]):.5f}, '
+                  f'constant {weighted_log_loss(gt[blank], skipped[blank]):.5f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['compute', 'report'])
+    parser.add_argument('--csv', type=str, nargs='+', default=['5fold.csv'], help='dataset csv files')
+    parser.add_argument('--csv_root_dir', type=str, default=None)
+    parser.add_argument('--data_version', type=str, default='npy')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--predictions', type=str, nargs='+', default=[])
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.005, 0.01, 0.02, 0.05])
+    args = parser.parse_args()
+
+    csv_root_dir = default_csv_root_dir(args.csv_root_dir)
+    data = pd.concat([pd.read_csv(os.path.join(csv_root_dir, csv_file)) for csv_file in args.csv], sort=False)
+    data = data.drop_duplicates('path')
+
+    if args.action == 'compute':
+        fractions = load_tissue_fractions(csv_root_dir)
+        missing = sorted(set(data.path) - set(fractions.index))
+        fractions = pd.concat([fractions, compute_tissue_fractions(missing, data_version=args.data_version,
+                                                                   workers=args.workers)])
+        fractions.to_csv(os.path.join(csv_root_dir, TISSUE_FRACTION_CSV), header=True)
+        print(f'{len(missing)} slices computed, {(fractions < 0.02).mean() * 100:.1f}% below 0.02')
+    else:
+        fractions = load_tissue_fractions(csv_root_dir)
+        data = data.assign(tissue_fraction=fractions.reindex(data.path).values)
+        for predictions_path in args.predictions:
+            print(predictions_path)
+            report(pd.read_csv(predictions_path), data, args.thresholds)
+
+
+if __name__ == '__main__':
+    main()
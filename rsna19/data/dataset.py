@@ -5,16 +5,32 @@ from glob import glob
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from types import SimpleNamespace
 import cv2
 import torch
-import skimage
 from torch.utils.data import Dataset
-from tqdm import tqdm
 
 from preprocessing import hu_converter
 from rsna19.configs.base_config import BaseConfig
 
-from rsna19.data.utils import load_seg_slice, timeit_context, load_seg_3d
+from rsna19.data.mask_store import SegmentationMaskStore
+from rsna19.data.preprocessing_cache import create_slice_cache, transform_signature
+from rsna19.data.sample_index import SampleIndex
+from rsna19.data.transport import BatchDecoder, check_transport_dtype, encode_image
+from rsna19.data.utils import load_seg_slice, timeit_context
+
+# transforms moving pixels without interpolation, the only ones possible with 'int16' transport of HU values
+VALUE_PRESERVING_TRANSFORMS = {'HorizontalFlip', 'VerticalFlip', 'Flip', 'Transpose', 'RandomRotate90', 'Rotate90',
+                               'CenterCrop', 'RandomCrop', 'Crop', 'ToTensor', 'ToTensorV2'}
+
+
+def changes_values(transform):
+    """Check if albumentations transform (or Compose of transforms) may interpolate or change pixel values"""
+    if transform is None:
+        return False
+    if hasattr(transform, 'transforms'):
+        return any(changes_values(t) for t in transform.transforms)
+    return type(transform).__name__ not in VALUE_PRESERVING_TRANSFORMS
 
 
 class IntracranialDataset(Dataset):
@@ -34,7 +50,11 @@ class IntracranialDataset(Dataset):
                  convert_cdf=False,
                  apply_windows=None,
                  add_segmentation_masks=False,
-                 segmentation_oversample=20
+                 segmentation_oversample=20,
+                 slice_cache_bytes=0,
+                 transport_dtype=None,
+                 preprocessing_cache_dir=None,
+                 preprocessing_cache_bytes=50 * 2 ** 30
                  ):
         """
         :param csv_file: path to csv file
@@ -42,6 +62,14 @@ class IntracranialDataset(Dataset):
         :param csv_root_dir: prepended to csv_file path, defaults to project's rsna19/datasets
         :param return_labels: if True, labels will be returned with image
         :param preprocess_func: preprocessing function, e.g. for window adjustment
+        :param slice_cache_bytes: if > 0, loaded slices are kept in cache shared between DataLoader workers
+        :param preprocessing_cache_dir: if set, loaded slices are also kept on disk between runs, in a directory of
+                                        the preprocessing signature, see data.preprocessing_cache
+        :param preprocessing_cache_bytes: budget of the disk cache
+        :param transport_dtype: dtype of returned images, see data.transport, None keeps float64 images.
+                                With 'int16' HU values are returned and scale_values, convert_cdf and apply_windows
+                                are applied by transport_decoder(), preprocess_func may only flip, rotate by 90
+                                degrees or crop then, see VALUE_PRESERVING_TRANSFORMS
         """
 
         self.segmentation_oversample = segmentation_oversample
@@ -55,11 +83,36 @@ class IntracranialDataset(Dataset):
         self.scale_values = scale_values  # scale all images data to values around 1
         self.is_test = is_test
 
+        check_transport_dtype(transport_dtype)
+        if transport_dtype == 'int16' and changes_values(preprocess_func):
+            raise ValueError('int16 transport sends HU values, preprocess_func must not interpolate or change them, '
+                             'use batch_augment or another transport_dtype')
+        self.transport_dtype = transport_dtype
+        if apply_windows is not None:
+            self.transport_value_range = (0.0, 1.0)
+        elif convert_cdf:
+            self.transport_value_range = (-1.0, 1.0)
+        else:
+            self.transport_value_range = None
+        if transport_dtype == 'uint8' and self.transport_value_range is None:
+            raise ValueError('uint8 transport needs bounded values, use convert_cdf or apply_windows')
+
         if csv_root_dir is None:
             csv_root_dir = os.path.normpath(__file__ + '/../csv')
 
         self.hu_converter = hu_converter.HuConverter
 
+        # converted slices cached in memory and/or on disk, see data.preprocessing_cache
+        raw_hu = transport_dtype == 'int16'
+        cache_settings = SimpleNamespace(data_version='3d', pre_crop_size=img_size, train_image_size=center_crop,
+                                         use_cdf=convert_cdf and not raw_hu,
+                                         scale_values=1.0 if raw_hu else scale_values, apply_windows=apply_windows,
+                                         slice_cache_bytes=slice_cache_bytes,
+                                         preprocessing_cache_dir=preprocessing_cache_dir,
+                                         preprocessing_cache_bytes=preprocessing_cache_bytes)
+        self.slice_cache = create_slice_cache(cache_settings, '2d', img_size * img_size * np.dtype(np.float).itemsize)
+        self.transform_signature = transform_signature(cache_settings, '2d')
+
         data = pd.read_csv(os.path.join(csv_root_dir, csv_file))
         study_ids = [path.split('/')[2] for path in data.path]
         data['study_id'] = study_ids
@@ -81,6 +134,8 @@ class IntracranialDataset(Dataset):
 
         self.data = data
         self.seg_data = seg_data
+        self.data_index = SampleIndex(data, with_labels=return_labels)
+        self.seg_data_index = SampleIndex(seg_data, with_labels=return_labels)
 
         if add_segmentation_masks:
             self.segmentation_masks = self.load_segmentation_masks()
@@ -89,46 +144,50 @@ class IntracranialDataset(Dataset):
 
         print(len(seg_ids))
 
-    def load_segmentation_masks(self):
-        res = {}
-        for study_id in tqdm(self.seg_ids):
-            meta_path = f'{BaseConfig.data_root}/segmentation_masks/{study_id}/meta.json'
-            seg_path = f'{BaseConfig.data_root}/segmentation_masks/{study_id}/Untitled.nii.gz'
-            seg = load_seg_3d(seg_path, meta_path)
-            if seg.shape[1:] != (self.img_size, self.img_size):
-                seg = np.array([
-                    skimage.transform.resize(np.float32(seg[i]), (self.img_size, self.img_size),
-                                             order=0, anti_aliasing=False).astype(seg.dtype)
-                    for i in range(seg.shape[0])
-                ])
-            res[study_id] = seg
+    def transport_decoder(self, device=None):
+        """Return decoder converting collated images of this dataset to float32 model input"""
+        if self.transport_dtype == 'int16':
+            return BatchDecoder(scale_values=self.scale_values,
+                                value_lut=self.hu_converter.cdf if self.convert_cdf else None,
+                                lut_min_hu=self.hu_converter.window[0],
+                                windows=self.apply_windows,
+                                device=device)
+        return BatchDecoder(value_range=self.transport_value_range, device=device)
 
-        return res
+    def load_segmentation_masks(self):
+        """Masks are read per study from memory mapped store shared by all datasets and workers, studies missing in
+        the store are converted here, before DataLoader workers are forked"""
+        store = SegmentationMaskStore(self.img_size)
+        store.build(sorted(self.seg_ids))
+        return store
 
     def __len__(self):
         return len(self.seg_data) * self.segmentation_oversample + len(self.data)
 
     def __getitem__(self, idx):
         if idx < len(self.seg_data) * self.segmentation_oversample:
-            dataset = self.seg_data
+            dataset = self.seg_data_index
             dataset_idx = idx % len(self.seg_data)
             have_segmentation = True
         else:
-            dataset = self.data
+            dataset = self.data_index
             dataset_idx = idx - len(self.seg_data) * self.segmentation_oversample
             have_segmentation = False
 
-        data_path = dataset.loc[dataset_idx, 'path'].replace('/npy/', '/3d/')
+        data_path = dataset.path(dataset_idx).replace('/npy/', '/3d/')
 
         study_id = data_path.split('/')[-3]
         slice_num = int(os.path.basename(data_path).split('.')[0])
         full_path = os.path.normpath(os.path.join(BaseConfig.data_root, '..', data_path))
         middle_img_path = Path(full_path)
 
+        # values conversion is done by transport_decoder in the main process
+        raw_hu = self.transport_dtype == 'int16'
+
         def load_img(cur_slice_num):
             try:
                 img_path = middle_img_path.parent.joinpath('{:03d}.npy'.format(cur_slice_num))
-                img = np.load(img_path).astype(np.float) * self.scale_values
+                img = np.load(img_path).astype(np.float) * (1.0 if raw_hu else self.scale_values)
             except FileNotFoundError:
                 img = np.full((self.img_size, self.img_size), self._HU_AIR, dtype=np.float)
 
@@ -140,19 +199,26 @@ class IntracranialDataset(Dataset):
                 from_col = (self.img_size - self.center_crop) // 2
                 img = img[from_row:from_row + self.center_crop, from_col:from_col + self.center_crop]
 
-            if self.convert_cdf:
+            if self.convert_cdf and not raw_hu:
                 img = self.hu_converter.convert(img, use_cdf=True)
 
             img = img[:, :, None]
 
             return img
 
+        def load_cached_img(cur_slice_num):
+            if self.slice_cache is None:
+                return load_img(cur_slice_num)
+
+            key = (study_id, cur_slice_num, self.transform_signature)
+            return self.slice_cache.get_or_load(key, lambda: load_img(cur_slice_num))
+
         if self.num_slices == 1:
-            img = load_img(slice_num)
+            img = load_cached_img(slice_num)
         else:
             steps = int(math.floor(self.num_slices/2.0))
             img = np.concatenate(
-                [load_img(slice) for slice in range(slice_num - steps, slice_num + steps + 1)],
+                [load_cached_img(slice) for slice in range(slice_num - steps, slice_num + steps + 1)],
                 axis=2
             )
 
@@ -162,7 +228,7 @@ class IntracranialDataset(Dataset):
             # seg_path = f'{BaseConfig.data_root}/segmentation_masks/{study_id}/Untitled.nii.gz'
             # with timeit_context('Load segmentation'):
             # seg = load_seg_slice(seg_path, meta_path, slice_num, self.img_size)
-            seg = self.segmentation_masks[study_id][slice_num]
+            seg = self.segmentation_masks.get_slice(study_id, slice_num)
 
         if self.preprocess_func:
             if self.num_slices == 5:
@@ -199,7 +265,7 @@ class IntracranialDataset(Dataset):
         out_seg = torch.tensor(out_seg)
         img = torch.from_numpy(img.transpose(2, 0, 1))
 
-        if self.apply_windows is not None:
+        if self.apply_windows is not None and not raw_hu:
             if isinstance(img, torch.Tensor):
                 slices = [
                     torch.clamp(
@@ -217,6 +283,8 @@ class IntracranialDataset(Dataset):
                 ]
                 img = np.concatenate(slices, axis=0)
 
+        img = encode_image(img, self.transport_dtype, self.transport_value_range)
+
         res = {
             'idx': idx,
             'image': img,
@@ -228,16 +296,7 @@ class IntracranialDataset(Dataset):
         }
 
         if self.return_labels:
-            labels = torch.tensor(dataset.loc[
-                                      dataset_idx,
-                                      [
-                                          'epidural',
-                                          'intraparenchymal',
-                                          'intraventricular',
-                                          'subarachnoid',
-                                          'subdural',
-                                          'any'
-                                      ]], dtype=torch.float)
+            labels = torch.tensor(dataset.labels[dataset_idx], dtype=torch.float)
             res['labels'] = labels
 
         return res
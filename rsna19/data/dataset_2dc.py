@@ -1,3 +1,4 @@
+import collections
 import os
 from pathlib import Path
 import random
@@ -7,22 +8,55 @@ import numpy as np
 import pandas as pd
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 import albumentations
 import albumentations.pytorch
 import cv2
 
+from rsna19.data.batch_augment import BatchAugmentation
+from rsna19.data.blank_slices import blank_mask
+from rsna19.data.fused_preprocessing import build_value_lut, load_window_fused, load_windows_fused
+from rsna19.data.sample_index import SampleIndex
+from rsna19.data.preprocessing_cache import create_slice_cache, transform_signature
+from rsna19.data.roi_crop import ROI_HU, bucket_of_geometry, crop_roi, head_box, roi_geometry, slice_box, study_boxes
+from rsna19.data.transport import BatchDecoder, check_transport_dtype, encode_image, hu_identity_lut
 from rsna19.data.utils import normalize_train, load_scan_2dc, load_seg_masks_2dc
 from rsna19.preprocessing.hu_converter import HuConverter
 
 
+def create_batch_augmentation(config, device=None):
+    """Batch level equivalent of the per sample augmentations of IntracranialDataset, used with batch_augment"""
+    return BatchAugmentation(shift_limit=config.shift_limit, scale_limit=0.15, rotate_limit=30, p=0.9,
+                             hflip=0.5,
+                             vflip=0.5 if config.vertical_flip else 0.0,
+                             crop_size=config.crop_size,
+                             random_crop=config.random_crop,
+                             # border value 0 of images in 0-1 range
+                             fill_value=-1.0,
+                             seed=getattr(config, 'batch_augment_seed', None),
+                             device=device)
+
+
+def create_transport_decoder(config, device=None):
+    """Decoder of images emitted by IntracranialDataset with config.transport_dtype"""
+    if getattr(config, 'transport_dtype', None) == 'int16':
+        value_lut, lut_min_hu = build_value_lut(config.use_cdf, config.min_hu_value, config.max_hu_value)
+        return BatchDecoder(value_lut=value_lut, lut_min_hu=lut_min_hu, device=device)
+    return BatchDecoder(device=device)
+
+
 class IntracranialDataset(Dataset):
     _HU_AIR = -1000
 
-    def __init__(self, config, folds, mode='train', augment=False, use_cq500=False, transforms=None):
+    def __init__(self, config, folds, mode='train', augment=False, use_cq500=False, transforms=None,
+                 skip_blank_slices=None, study_slabs=None):
         """
         :param folds: list of selected folds
         :param mode: 'train', 'val' or 'test'
         :param return_labels: if True, labels will be returned with image
+        :param skip_blank_slices: drop slices with tissue fraction below config.blank_tissue_fraction, they are
+                                  kept in blank_index, see data.blank_slices. Defaults to True in train mode
+        :param study_slabs: number of studies kept in memory of each worker, defaults to config.study_slabs
         """
         self.config = config
         self.mode = mode
@@ -52,54 +86,99 @@ class IntracranialDataset(Dataset):
             data_cq500 = pd.read_csv(os.path.join(csv_root_dir, 'cq500_5fold_cleared.csv'))
             data = pd.concat([data, data_cq500], axis=0)
 
+        if skip_blank_slices is None:
+            skip_blank_slices = mode == 'train'
+        blank = blank_mask(data, config) if skip_blank_slices else np.zeros(len(data), dtype=bool)
+        self.blank_index = SampleIndex(data[blank].reset_index(), with_labels=mode != 'test')
+        data = data[~blank]
+
         data = data.reset_index()
         self.data = data
+        self.data_index = SampleIndex(data, with_labels=mode != 'test')
 
         if self.config.use_cdf:
             self.hu_converter = HuConverter
 
-    def __len__(self):
-        return len(self.data)
-
-    def __getitem__(self, idx):
-        path = self.data.loc[idx, 'path']
-        study_id = path.split('/')[2]
-        slice_num = os.path.basename(path).split('.')[0]
-        path = os.path.normpath(os.path.join(self.config.data_root, '..', path))
-
-        # todo it would be better to have generic paths in csv and parameter specifying which data version to use
-        path = path.replace('npy/', self.config.data_version + '/')
-
-        middle_img_path = Path(path)
-
-        middle_img_num = int(middle_img_path.stem)
-        slices_indices = list(range(middle_img_num - self.config.num_slices // 2,
-                                    middle_img_num + self.config.num_slices // 2 + 1))
-
-        slices_image = load_scan_2dc(middle_img_path, slices_indices, self.config.pre_crop_size,
-                                     self.config.padded_size)
-
-        if self.config.use_cdf:
-            slices_image = self.hu_converter.convert(slices_image)
+        # converted slices cached in memory and/or on disk, see data.preprocessing_cache
+        slice_size = self.config.padded_size or self.config.pre_crop_size
+        itemsize = HuConverter.cdf.itemsize if self.config.use_cdf else np.dtype(np.float64).itemsize
+        self.slice_cache = create_slice_cache(self.config, '2dc', slice_size * slice_size * itemsize)
+        self.transform_signature = transform_signature(self.config, '2dc')
+
+        self.transport_dtype = getattr(self.config, 'transport_dtype', None)
+        check_transport_dtype(self.transport_dtype)
+
+        # crop of samples to the head box, see data.roi_crop
+        self.roi_crop = getattr(self.config, 'roi_crop', None)
+        if self.roi_crop is not None:
+            self.init_roi_crop(data, slice_size)
+
+        self.transforms = self.build_transforms()
+        self.fused_crop_size = self.get_fused_crop_size()
+        if self.transport_dtype == 'int16':
+            if self.fused_crop_size is None:
+                raise ValueError('int16 transport is not possible with transforms applied to converted values')
+            # HU values are loaded by fused preprocessing and converted by create_transport_decoder
+            self.value_lut, self.value_lut_min_hu = hu_identity_lut()
+        elif self.fused_crop_size is not None:
+            self.value_lut, self.value_lut_min_hu = build_value_lut(self.config.use_cdf, self.config.min_hu_value,
+                                                                    self.config.max_hu_value)
+
+        # converted slices of recently used studies, private to each worker process
+        self.max_study_slabs = getattr(self.config, 'study_slabs', 0) if study_slabs is None else study_slabs
+        self.study_slabs = collections.OrderedDict()
+
+    def init_roi_crop(self, data, slice_size):
+        if self.roi_crop not in ('study', 'slice'):
+            raise ValueError(f"roi_crop must be None, 'study' or 'slice', got {self.roi_crop}")
+        if self.augment and getattr(self.config, 'batch_augment', False):
+            raise ValueError('batch_augment crops batches to crop_size, it is not possible with roi_crop')
+
+        self.roi_margin = getattr(self.config, 'roi_margin', 16)
+        self.roi_size = getattr(self.config, 'roi_size', None)
+        self.roi_buckets = getattr(self.config, 'roi_buckets', None)
+        if self.roi_size is None and (self.roi_crop != 'study' or not self.roi_buckets):
+            raise ValueError("size buckets (roi_size None) need roi_crop 'study' and roi_buckets")
+
+        self.study_roi = None
+        if self.roi_crop == 'study':
+            boxes = study_boxes(data, self.config).reindex([name.decode() for name in self.data_index.study_names])
+            self.study_roi = np.stack([
+                roi_geometry(slice_box(box, self.config.pre_crop_size, self.config.padded_size), slice_size,
+                             self.roi_margin, self.roi_size, self.roi_buckets)
+                for box in boxes.values]) if len(boxes) else np.zeros((0, 5), dtype=np.int32)
         else:
-            slices_image = normalize_train(slices_image,
-                                           self.config.min_hu_value,
-                                           self.config.max_hu_value)
-
-        slices_image = (slices_image.transpose((1, 2, 0)) + 1) / 2
-
-        # Load and append segmentation masks
-        if hasattr(self.config, 'append_masks') and self.config.append_masks:
-            seg_masks = load_seg_masks_2dc(middle_img_path, slices_indices, self.config.pre_crop_size)
-            seg_masks = seg_masks.transpose((1, 2, 0))
-            slices_image = np.concatenate((slices_image, seg_masks), axis=2)
-
+            # images are in 0-1 range when cropped
+            self.roi_threshold = (self.convert_values(np.array([[ROI_HU]], dtype=np.float64))[0, 0] + 1) / 2
+
+    def roi_bucket_ids(self):
+        """Size bucket of each sample with roi_crop buckets, e.g. for BucketBatchSampler, None if sizes are equal"""
+        if self.roi_crop is None or self.roi_size is not None:
+            return None
+        study_buckets = np.array([bucket_of_geometry(roi, self.roi_buckets) for roi in self.study_roi], dtype=np.int64)
+        return study_buckets[self.data_index.study_ids]
+
+    def sample_roi(self, study_code, slices_image):
+        """Crop geometry of a sample, slices_image (H, W, num_slices) is used with roi_crop 'slice'"""
+        if self.study_roi is not None:
+            return self.study_roi[study_code]
+
+        slice_size = slices_image.shape[0]
+        box = head_box(slices_image.transpose((2, 0, 1)), self.roi_threshold)
+        if box is None:
+            box = (0, 0, slice_size, slice_size)
+        return roi_geometry(box, slice_size, self.roi_margin, self.roi_size)
+
+    def build_transforms(self):
         transforms = []
         if self.additional_transforms is not None:
             transforms.extend(self.additional_transforms)
 
+        # with batch_augment, flips, shift/scale/rotate and crop are applied later to a whole batch
+        batch_augment = self.augment and getattr(self.config, 'batch_augment', False)
+
         if self.augment:
-            if self.config.vertical_flip:
+            if self.config.vertical_flip and not batch_augment:
                 transforms.append(albumentations.VerticalFlip(p=0.5))
 
             if self.config.pixel_augment:
@@ -116,27 +195,182 @@ class IntracranialDataset(Dataset):
                     p=0.5
                 ))
 
-            transforms.extend([
-                albumentations.HorizontalFlip(p=0.5),
-                albumentations.ShiftScaleRotate(
-                    shift_limit=self.config.shift_limit, scale_limit=0.15, rotate_limit=30,
-                    interpolation=cv2.INTER_LINEAR,
-                    border_mode=cv2.BORDER_CONSTANT,
-                    value=0,
-                    p=0.9),
-            ])
-
-        if self.augment and self.config.random_crop:
+            if not batch_augment:
+                transforms.extend([
+                    albumentations.HorizontalFlip(p=0.5),
+                    albumentations.ShiftScaleRotate(
+                        shift_limit=self.config.shift_limit, scale_limit=0.15, rotate_limit=30,
+                        interpolation=cv2.INTER_LINEAR,
+                        border_mode=cv2.BORDER_CONSTANT,
+                        value=0,
+                        p=0.9),
+                ])
+
+        # with roi_crop, samples are already cropped to the head box
+        crop = not batch_augment and self.roi_crop is None
+        if crop and self.augment and self.config.random_crop:
             transforms.append(albumentations.RandomCrop(self.config.crop_size, self.config.crop_size))
-        else:
+        elif crop:
             transforms.append(albumentations.CenterCrop(self.config.crop_size, self.config.crop_size))
 
         transforms.append(albumentations.pytorch.ToTensorV2())
 
-        processed = albumentations.Compose(transforms)(image=slices_image)
+        return albumentations.Compose(transforms)
+
+    def get_fused_crop_size(self):
+        """Return crop size of fused preprocessing, or None if it can't replace transforms of this dataset"""
+        if not getattr(self.config, 'fused_preprocessing', False) and self.transport_dtype != 'int16':
+            return None
+
+        if self.additional_transforms is not None or getattr(self.config, 'append_masks', False) \
+                or self.roi_crop is not None:
+            return None
+
+        if not self.augment:
+            return self.config.crop_size
+
+        # with batch_augment, spatial transforms and crop happen later, pixel and elastic ones still need albumentations
+        if getattr(self.config, 'batch_augment', False) and not self.config.pixel_augment \
+                and not self.config.elastic_transform:
+            return self.config.padded_size or self.config.pre_crop_size
+
+        return None
+
+    def study_slice_index(self):
+        """Return study id and slice number of every sample, e.g. for StudyBlockSampler"""
+        return self.data_index.study_ids, self.data_index.slice_nums
+
+    def __len__(self):
+        return len(self.data)
+
+    def convert_values(self, slices_image):
+        if self.config.use_cdf:
+            return self.hu_converter.convert(slices_image)
+        else:
+            return normalize_train(slices_image,
+                                   self.config.min_hu_value,
+                                   self.config.max_hu_value)
+
+    def load_slice(self, middle_img_path, study_id, img_num):
+        """Load single converted slice, reusing the study slab of current worker or shared slice cache"""
+        slab = None
+        if self.max_study_slabs > 0:
+            slab = self.study_slabs.get(study_id)
+            if slab is None:
+                slab = self.study_slabs[study_id] = {}
+                if len(self.study_slabs) > self.max_study_slabs:
+                    self.study_slabs.popitem(last=False)
+            else:
+                self.study_slabs.move_to_end(study_id)
+
+            if img_num in slab:
+                return slab[img_num]
+
+        if self.slice_cache is None:
+            slice_image = self.convert_values(load_scan_2dc(middle_img_path, [img_num], self.config.pre_crop_size,
+                                                            self.config.padded_size))[0]
+        else:
+            slice_image = self.load_cached_slice(middle_img_path, study_id, img_num)
+
+        if slab is not None:
+            slab[img_num] = slice_image
+        return slice_image
+
+    def cached_slice_request(self, middle_img_path, study_id, img_num):
+        """Return slice cache key and function loading the converted slice"""
+        key = (study_id, int(img_num), self.transform_signature)
+
+        def load():
+            return self.convert_values(load_scan_2dc(middle_img_path, [img_num], self.config.pre_crop_size,
+                                                     self.config.padded_size))[0]
+
+        return key, load
+
+    def load_cached_slice(self, middle_img_path, study_id, img_num):
+        return self.slice_cache.get_or_load(*self.cached_slice_request(middle_img_path, study_id, img_num))
+
+    def prefetch_requests(self, idx):
+        """Cache keys and load functions of slices of a sample, see data.prefetch"""
+        if self.slice_cache is None or self.fused_crop_size is not None:
+            return []
+
+        _, study_id, _, middle_img_path, slices_indices = self.sample_slices(idx)
+        return [self.cached_slice_request(middle_img_path, study_id, img_num) for img_num in slices_indices]
+
+    def load_image(self, middle_img_path, study_id, slices_indices, study_code=None):
+        """Return converted and transformed image and its roi geometry, None without roi_crop"""
+        if self.slice_cache is None and self.max_study_slabs == 0:
+            slices_image = self.convert_values(load_scan_2dc(middle_img_path, slices_indices,
+                                                             self.config.pre_crop_size, self.config.padded_size))
+        else:
+            slices_image = np.stack([self.load_slice(middle_img_path, study_id, img_num)
+                                     for img_num in slices_indices])
+
+        slices_image = (slices_image.transpose((1, 2, 0)) + 1) / 2
+        roi = self.sample_roi(study_code, slices_image) if self.roi_crop is not None else None
+
+        # Load and append segmentation masks
+        if hasattr(self.config, 'append_masks') and self.config.append_masks:
+            seg_masks = load_seg_masks_2dc(middle_img_path, slices_indices, self.config.pre_crop_size)
+            seg_masks = seg_masks.transpose((1, 2, 0))
+            slices_image = np.concatenate((slices_image, seg_masks), axis=2)
+
+        if roi is not None:
+            slices_image = crop_roi(slices_image, roi)
+
+        processed = self.transforms(image=slices_image)
         img = (processed['image'] * 2) - 1
 
         # img = torch.tensor(slices_image, dtype=torch.float32)
+        return img, roi
+
+    def sample_path(self, data_index, idx):
+        """Return path of data_version, study id and slice number of sample idx of data_index"""
+        path = data_index.path(idx)
+        study_id = data_index.study_name(idx)
+        slice_num = os.path.basename(path).split('.')[0]
+        path = os.path.normpath(os.path.join(self.config.data_root, '..', path))
+
+        # todo it would be better to have generic paths in csv and parameter specifying which data version to use
+        path = path.replace('npy/', self.config.data_version + '/')
+        return path, study_id, slice_num
+
+    def blank_samples(self):
+        """Return paths, study ids, slice numbers and labels (None in test mode) of skipped blank slices"""
+        samples = [self.sample_path(self.blank_index, idx) for idx in range(len(self.blank_index))]
+        paths, study_ids, slice_nums = zip(*samples) if samples else ([], [], [])
+        return list(paths), list(study_ids), list(slice_nums), self.blank_index.labels
+
+    def batch_metadata(self, indices):
+        """Paths, study ids and slice numbers of samples of indices, see data.batch_ring"""
+        samples = [self.sample_path(self.data_index, idx) for idx in indices]
+        paths, study_ids, slice_nums = zip(*samples) if samples else ([], [], [])
+        return {'path': list(paths), 'study_id': list(study_ids), 'slice_num': list(slice_nums)}
+
+    def sample_slices(self, idx):
+        """Return path, study id, slice number, middle slice path and slice numbers of the window of a sample"""
+        path, study_id, slice_num = self.sample_path(self.data_index, idx)
+        middle_img_path = Path(path)
+
+        middle_img_num = int(middle_img_path.stem)
+        slices_indices = list(range(middle_img_num - self.config.num_slices // 2,
+                                    middle_img_num + self.config.num_slices // 2 + 1))
+
+        return path, study_id, slice_num, middle_img_path, slices_indices
+
+    def __getitem__(self, idx):
+        path, study_id, slice_num, middle_img_path, slices_indices = self.sample_slices(idx)
+
+        roi = None
+        if self.fused_crop_size is not None:
+            img = torch.from_numpy(load_window_fused(middle_img_path, slices_indices, self.config.pre_crop_size,
+                                                     self.config.padded_size, self.fused_crop_size,
+                                                     self.value_lut, self.value_lut_min_hu,
+                                                     dtype=self.value_lut.dtype))
+        else:
+            img, roi = self.load_image(middle_img_path, study_id, slices_indices, self.data_index.study_ids[idx])
+
+        img = encode_image(img, self.transport_dtype)
 
         out = {
             'image': img,
@@ -145,13 +379,39 @@ class IntracranialDataset(Dataset):
             'slice_num': slice_num
         }
 
+        if roi is not None:
+            # maps outputs of the cropped image back to the slice, see data.roi_crop.map_to_slice
+            out['roi'] = torch.from_numpy(roi)
+
+        if not self.mode == 'test':
+            out['labels'] = torch.tensor(self.data_index.labels[idx], dtype=torch.float32)
+
+        return out
+
+    def get_batch(self, indices):
+        """Return collated samples of indices, see data.batch_fetch.
+
+        With fused preprocessing, slices needed by the batch are read once per study and converted with a single
+        lookup table call, otherwise samples are loaded one by one.
+        """
+        if self.fused_crop_size is None:
+            return default_collate([self[idx] for idx in indices])
+
+        indices = np.asarray(indices)
+        # paths, study ids and slice numbers as in __getitem__
+        metadata = self.batch_metadata(indices)
+
+        windows = self.data_index.slice_nums[indices][:, None] + \
+            np.arange(self.config.num_slices) - self.config.num_slices // 2
+        img = load_windows_fused([os.path.dirname(path) for path in metadata['path']], windows,
+                                 self.config.pre_crop_size, self.config.padded_size, self.fused_crop_size,
+                                 self.value_lut, self.value_lut_min_hu)
+
+        out = {'image': encode_image(torch.from_numpy(img), self.transport_dtype)}
+        out.update(metadata)
+
         if not self.mode == 'test':
-            out['labels'] = torch.tensor(self.data.loc[idx, ['epidural',
-                                                             'intraparenchymal',
-                                                             'intraventricular',
-                                                             'subarachnoid',
-                                                             'subdural',
-                                                             'any']], dtype=torch.float32)
+            out['labels'] = torch.from_numpy(self.data_index.labels[indices])
 
         return out
 
@@ -35,7 +35,9 @@ class IntracranialDataset(Dataset):
                  num_slices=16,
                  convert_cdf=True,
                  apply_windows=None,
-                 combine_slices_padding=1
+                 combine_slices_padding=1,
+                 stream_chunk_slices=None,
+                 stream_extra_context=0
                  ):
         """
         :param csv_file: path to csv file
@@ -43,8 +45,14 @@ class IntracranialDataset(Dataset):
         :param csv_root_dir: prepended to csv_file path, defaults to project's rsna19/datasets
         :param return_labels: if True, labels will be returned with image
         :param preprocess_func: preprocessing function, e.g. for window adjustment
+        :param stream_chunk_slices: if set, samples are overlapping z-chunks of studies predicting
+                                    stream_chunk_slices slices each, instead of whole studies
+        :param stream_extra_context: slices of context added to chunks on top of combine_slices_padding, for models
+                                     looking further in z, predictions for them are dropped in stitching
         """
 
+        self.stream_chunk_slices = stream_chunk_slices
+        self.stream_extra_context = stream_extra_context
         self.return_all_slices = return_all_slices
         self.combine_slices_padding = combine_slices_padding
         self.random_slice = random_slice
@@ -64,6 +72,13 @@ class IntracranialDataset(Dataset):
         self.study_slices = self.load_study_slices(csv_root_dir, csv_file, folds, is_test)
         self.study_ids = list(sorted(list(self.study_slices.keys())))
 
+        if self.stream_chunk_slices is not None:
+            self.chunks = [(study_id, chunk_from, min(chunk_from + self.stream_chunk_slices, len(self.study_slices[study_id])))
+                           for study_id in self.study_ids
+                           for chunk_from in range(0, len(self.study_slices[study_id]), self.stream_chunk_slices)]
+        else:
+            self.chunks = None
+
     def load_study_slices(self, csv_root_dir, csv_file, folds, is_test):
         data = pd.read_csv(os.path.join(csv_root_dir, csv_file))
         if not is_test:
@@ -99,26 +114,8 @@ class IntracranialDataset(Dataset):
 
         return study_slices
 
-    def __len__(self):
-        return len(self.study_ids)
-
-    def __getitem__(self, idx):
-        study_id = self.study_ids[idx]
-        slices = self.study_slices[study_id]
+    def load_slices(self, slices, first_slice, last_slice):
         slices_in_study = len(slices)
-
-        if self.return_all_slices:
-            first_slice = -self.combine_slices_padding
-            last_slice = slices_in_study + self.combine_slices_padding
-        else:
-            if self.random_slice and slices_in_study + 2*self.combine_slices_padding > self.num_slices:
-                first_slice = random.randrange(-self.combine_slices_padding,
-                                               slices_in_study-self.num_slices+self.combine_slices_padding)
-                last_slice = first_slice+self.num_slices
-            else:
-                first_slice = (slices_in_study - self.num_slices) * 2 // 3
-                last_slice = first_slice+self.num_slices  # slices_in_study
-
         all_images = []
         all_labels = []
         all_paths = []
@@ -153,6 +150,62 @@ class IntracranialDataset(Dataset):
             processed = self.preprocess_func(image=all_images)
             all_images = processed['image']
 
+        return all_images, all_labels, all_paths
+
+    def get_chunk(self, idx):
+        """Load z-chunk of a study with combine_slices_padding context on both sides, see stream_chunk_slices"""
+        study_id, chunk_from, chunk_to = self.chunks[idx]
+        slices = self.study_slices[study_id]
+
+        # extra context is clipped at study boundaries, where air padding of combine_slices_padding is used anyway
+        context_before = min(self.stream_extra_context, chunk_from)
+        context_after = min(self.stream_extra_context, len(slices) - chunk_to)
+        first_slice = chunk_from - context_before - self.combine_slices_padding
+        last_slice = chunk_to + context_after + self.combine_slices_padding
+
+        all_images, all_labels, all_paths = self.load_slices(slices, first_slice, last_slice)
+
+        chunk_slice = slice(context_before + self.combine_slices_padding,
+                            context_before + self.combine_slices_padding + chunk_to - chunk_from)
+
+        return {
+            'image': all_images,
+            'study_id': study_id,
+            'first_slice': first_slice,
+            'slice_num': np.arange(chunk_from, chunk_to),
+            'labels': np.row_stack(all_labels)[chunk_slice],
+            'path': all_paths[chunk_slice],
+            # model predicts slices from first_slice + combine_slices_padding, predictions of the chunk start here
+            'output_offset': context_before
+        }
+
+    def __len__(self):
+        if self.chunks is not None:
+            return len(self.chunks)
+        return len(self.study_ids)
+
+    def __getitem__(self, idx):
+        if self.chunks is not None:
+            return self.get_chunk(idx)
+
+        study_id = self.study_ids[idx]
+        slices = self.study_slices[study_id]
+        slices_in_study = len(slices)
+
+        if self.return_all_slices:
+            first_slice = -self.combine_slices_padding
+            last_slice = slices_in_study + self.combine_slices_padding
+        else:
+            if self.random_slice and slices_in_study + 2*self.combine_slices_padding > self.num_slices:
+                first_slice = random.randrange(-self.combine_slices_padding,
+                                               slices_in_study-self.num_slices+self.combine_slices_padding)
+                last_slice = first_slice+self.num_slices
+            else:
+                first_slice = (slices_in_study - self.num_slices) * 2 // 3
+                last_slice = first_slice+self.num_slices  # slices_in_study
+
+        all_images, all_labels, all_paths = self.load_slices(slices, first_slice, last_slice)
+
         all_labels = np.row_stack(all_labels)[self.combine_slices_padding:-self.combine_slices_padding]
         all_paths = all_paths[self.combine_slices_padding:-self.combine_slices_padding]
 
@@ -272,6 +325,40 @@ def check_dataset():
             plt.show()
         break
 
+def check_streaming(csv_file='5fold.csv', folds=(1,), chunk_slices=8, combine_slices_padding=2, max_studies=20):
+    """Compare stitched chunk predictions of a toy model combining neighbouring slices with whole study predictions"""
+    import albumentations
+    import albumentations.pytorch
+
+    def toy_model(images):
+        # mean of 2 * padding + 1 neighbouring slices, drops padding slices like the 3D models
+        kernel = torch.ones(1, 1, 2 * combine_slices_padding + 1, 1, 1) / (2 * combine_slices_padding + 1)
+        return torch.nn.functional.conv3d(images[:, None], kernel)[:, 0].mean(dim=(2, 3))
+
+    def build(**kwargs):
+        return IntracranialDataset(csv_file=csv_file, folds=list(folds), return_all_slices=True, img_size=400,
+                                   combine_slices_padding=combine_slices_padding,
+                                   preprocess_func=albumentations.Compose([albumentations.pytorch.ToTensorV2()]),
+                                   **kwargs)
+
+    ds_whole = build()
+    for extra_context in [0, 3]:
+        ds_stream = build(stream_chunk_slices=chunk_slices, stream_extra_context=extra_context)
+        stitched = collections.defaultdict(list)
+        for sample in ds_stream:
+            if len(stitched) > max_studies:
+                break
+            y_hat = toy_model(sample['image'][None].float())[0]
+            stitched[sample['study_id']].append(y_hat[sample['output_offset']:][:len(sample['slice_num'])])
+
+        for study_idx, study_id in enumerate(ds_whole.study_ids[:max_studies]):
+            sample = ds_whole[study_idx]
+            expected = toy_model(sample['image'][None].float())[0]
+            assert torch.allclose(torch.cat(stitched[study_id]), expected, atol=1e-6), study_id
+        print(f'extra context {extra_context}: {len(ds_stream)} chunks, stitched predictions match whole studies')
+
+
 if __name__ == '__main__':
     # check_performance()
+    # check_streaming()
     check_dataset()
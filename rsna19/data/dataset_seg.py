@@ -1,4 +1,5 @@
 from glob import glob
+import multiprocessing
 from pathlib import Path
 import random
 
@@ -11,10 +12,77 @@ import pandas as pd
 import torch
 from torch.utils.data import Dataset
 
+from rsna19.data.batch_augment import BatchAugmentation
+from rsna19.data.sample_index import SampleIndex
+from rsna19.data.preprocessing_cache import create_slice_cache, transform_signature
 from rsna19.data.utils import normalize_train, load_scan_2dc, draw_seg, load_seg_slice
 from rsna19.preprocessing.hu_converter import HuConverter
 
 
+def create_batch_augmentation(config, device=None):
+    """Batch level equivalent of the per sample augmentations of IntracranialDataset, used with batch_augment"""
+    return BatchAugmentation(shift_limit=config.shift_value, scale_limit=0.15, rotate_limit=30, p=0.9,
+                             hflip=0.5,
+                             vflip=0.5 if config.vertical_flip else 0.0,
+                             crop_size=config.crop_size if config.random_crop or config.center_crop else None,
+                             random_crop=config.random_crop,
+                             # border value 0 of images in 0-1 range
+                             fill_value=-1.0,
+                             seed=getattr(config, 'batch_augment_seed', None),
+                             device=device)
+
+
+class NegativeSlicePool:
+    """Slices of negative studies in flat arrays, random negative slices are drawn without filesystem access.
+
+    Studies are drawn uniformly and then a slice uniformly within the study. Draws are made in vectorized blocks
+    from a generator seeded in each DataLoader worker separately.
+    """
+
+    def __init__(self, study_dirs, slice_counts, block_size=1024):
+        """
+        :param study_dirs: study directories relative to data_root, e.g. train/ID_00047d6503
+        :param slice_counts: number of slices of each study
+        """
+        slice_counts = np.asarray(slice_counts, dtype=np.int64)
+        self.study_dirs = np.array(study_dirs, dtype=np.bytes_)
+        self.study_offsets = np.concatenate([[0], np.cumsum(slice_counts)[:-1]])
+        self.slice_counts = slice_counts
+
+        # (study, slice) candidates
+        self.candidate_studies = np.repeat(np.arange(len(slice_counts), dtype=np.int32), slice_counts)
+        self.candidate_slices = (np.arange(len(self.candidate_studies)) -
+                                 np.repeat(self.study_offsets, slice_counts)).astype(np.int32)
+
+        self.block_size = block_size
+        self._pid = None
+        self._block = None
+        self._block_pos = 0
+
+    def __len__(self):
+        return len(self.candidate_studies)
+
+    def _draw_block(self):
+        if self._pid != os.getpid():
+            # python's random is seeded differently in each DataLoader worker
+            self._random_state = np.random.RandomState(random.getrandbits(32))
+            self._pid = os.getpid()
+
+        studies = self._random_state.randint(0, len(self.slice_counts), self.block_size)
+        slices = (self._random_state.random_sample(self.block_size) * self.slice_counts[studies]).astype(np.int64)
+        self._block = self.study_offsets[studies] + slices
+        self._block_pos = 0
+
+    def sample(self):
+        """Return (study_dir, slice_num) of a random negative slice"""
+        if self._pid != os.getpid() or self._block_pos >= len(self._block):
+            self._draw_block()
+
+        candidate = self._block[self._block_pos]
+        self._block_pos += 1
+        return self.study_dirs[self.candidate_studies[candidate]].decode(), int(self.candidate_slices[candidate])
+
+
 class IntracranialDataset(Dataset):
     _HU_AIR = -1000
 
@@ -36,55 +104,159 @@ class IntracranialDataset(Dataset):
         dataset_file = 'test.csv' if test else self.config.dataset_file
         data = pd.read_csv(os.path.join(csv_root_dir, dataset_file))
 
+        if use_negatives:
+            self.negative_pool = self.build_negative_pool(csv_root_dir, folds, data)
+        else:
+            self.negative_pool = None
+
         # todo use csv
         seg_ids = [path.split('/')[-2] for path in glob(f'{self.config.data_root}/train/*/Untitled.nii.gz')]
         data = data[data.path.apply(lambda x: x.split('/')[2]).isin(seg_ids)]
 
-        negative_data = pd.read_csv(os.path.join(csv_root_dir, '5fold3D.csv'))
-        negative_data = negative_data[negative_data.fold.isin(folds)]
-        self.negative_data = negative_data[negative_data['any'] == 0]
-
         if not test:
             data = data[data.fold.isin(folds)]
         data = data.reset_index()
         self.data = data
+        self.data_index = SampleIndex(data, with_labels=not test)
 
         if self.config.use_cdf:
             self.hu_converter = HuConverter
 
-        self.global_step_counter = 0
+        # converted slices cached in memory and/or on disk, see data.preprocessing_cache
+        slice_size = self.config.train_image_size or self.config.pre_crop_size
+        itemsize = HuConverter.cdf.itemsize if self.config.use_cdf else np.dtype(np.float64).itemsize
+        self.slice_cache = create_slice_cache(self.config, 'seg', slice_size * slice_size * itemsize)
+        self.transform_signature = transform_signature(self.config, 'seg')
+
+        self.transforms = self.build_transforms()
+
+        # trainer's global step, shared with DataLoader workers, see set_global_step
+        self.global_step = multiprocessing.RawValue('q', 0)
+
+    def build_negative_pool(self, csv_root_dir, folds, slices_data):
+        """
+        :param slices_data: per slice csv data, used to count slices of negative studies
+        """
+        negative_data = pd.read_csv(os.path.join(csv_root_dir, '5fold3D.csv'))
+        negative_data = negative_data[negative_data.fold.isin(folds)]
+        negative_data = negative_data[negative_data['any'] == 0]
+
+        slice_counts = slices_data.path.str.split('/').str[2].value_counts()
+        study_dirs = [path.replace('rsna/', '') for path in negative_data.path]
+        counts = []
+        for study_dir in study_dirs:
+            study_id = study_dir.split('/')[-1]
+            if study_id in slice_counts.index:
+                counts.append(int(slice_counts[study_id]))
+            else:
+                counts.append(len(os.listdir(os.path.join(self.config.data_root, study_dir, '3d'))))
+
+        return NegativeSlicePool(study_dirs, counts)
+
+    def set_global_step(self, global_step):
+        """Set step used by negative samples curriculum, visible to all DataLoader workers"""
+        self.global_step.value = global_step
+
+    def build_transforms(self):
+        transforms = []
+        if not self.augment:
+            return albumentations.Compose(transforms)
+
+        # with batch_augment, flips, shift/scale/rotate and crop are applied later to a whole batch
+        batch_augment = getattr(self.config, 'batch_augment', False)
+
+        if self.config.vertical_flip and not batch_augment:
+            transforms.append(albumentations.VerticalFlip(p=0.5))
+
+        if self.config.pixel_augment:
+            transforms.append(albumentations.RandomBrightnessContrast(0.2, 0.2, False, 0.8))
+
+        if self.config.elastic_transform:
+            transforms.append(albumentations.ElasticTransform(
+                alpha=20,
+                sigma=6,
+                alpha_affine=10,
+                interpolation=cv2.INTER_LINEAR,
+                border_mode=cv2.BORDER_CONSTANT,
+                value=0,
+                p=0.5
+            ))
+
+        if batch_augment:
+            return albumentations.Compose(transforms)
+
+        transforms.extend([
+            albumentations.HorizontalFlip(p=0.5),
+            albumentations.ShiftScaleRotate(
+                shift_limit=self.config.shift_value, scale_limit=0.15, rotate_limit=30,
+                interpolation=cv2.INTER_LINEAR,
+                border_mode=cv2.BORDER_CONSTANT,
+                value=0,
+                p=0.9),
+        ])
+
+        if self.config.random_crop:
+            transforms.append(albumentations.RandomCrop(self.config.crop_size, self.config.crop_size))
+        elif self.config.center_crop:
+            transforms.append(albumentations.CenterCrop(self.config.crop_size, self.config.crop_size))
+
+        return albumentations.Compose(transforms)
 
     def get_random_negative_prob(self):
         if self.config.negative_data_steps is None or not self.use_negatives:
             return 0
 
-        if self.global_step_counter/self.config.batch_size < self.config.negative_data_steps[0]:
+        global_step = self.global_step.value
+        if global_step < self.config.negative_data_steps[0]:
             return 0
-        elif self.global_step_counter/self.config.batch_size < self.config.negative_data_steps[1]:
+        elif global_step < self.config.negative_data_steps[1]:
             return 0.15
-        elif self.global_step_counter/self.config.batch_size < self.config.negative_data_steps[2]:
+        elif global_step < self.config.negative_data_steps[2]:
             return 0.30
         else:
             return 0.40
 
+    def load_slices(self, middle_img_path, slices_indices):
+        if self.config.train_image_size:
+            margin = int((self.config.train_image_size - self.config.pre_crop_size) / 2)
+            slices_image = np.full((len(slices_indices), self.config.train_image_size,
+                                    self.config.train_image_size), self._HU_AIR)
+            slices_image[:, margin:margin+self.config.pre_crop_size, margin:margin+self.config.pre_crop_size] = \
+                load_scan_2dc(middle_img_path, slices_indices, self.config.pre_crop_size)
+        else:
+            slices_image = load_scan_2dc(middle_img_path, slices_indices, self.config.pre_crop_size)
+        return slices_image
+
+    def convert_values(self, slices_image):
+        if self.config.use_cdf:
+            return self.hu_converter.convert(slices_image)
+        else:
+            return normalize_train(slices_image,
+                                   self.config.min_hu_value,
+                                   self.config.max_hu_value)
+
+    def load_cached_slice(self, middle_img_path, study_id, img_num):
+        key = (study_id, int(img_num), self.transform_signature)
+
+        def load():
+            return self.convert_values(self.load_slices(middle_img_path, [img_num]))[0]
+
+        return self.slice_cache.get_or_load(key, load)
+
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
-        _HU_AIR = -1000
-        self.global_step_counter += 1
         proba = self.get_random_negative_prob()
         if random.random() < proba:
-            dir_path = Path(self.negative_data.sample()['path'].values[0].replace('rsna/', ''))
-            dir_path = self.config.data_root / dir_path / '3d'
-            num_slices = len(list(dir_path.iterdir()))
-            path = str(dir_path / '{:03d}'.format(random.randint(0, num_slices-1)))
+            study_dir, negative_slice_num = self.negative_pool.sample()
+            path = str(self.config.data_root / Path(study_dir) / '3d' / '{:03d}'.format(negative_slice_num))
             if self.config.train_image_size:
                 seg = np.zeros((self.config.train_image_size, self.config.train_image_size))
             else:
                 seg = np.zeros((self.config.pre_crop_size, self.config.pre_crop_size))
         else:
-            path = self.data.loc[idx, 'path']
+            path = self.data_index.path(idx)
             seg = None
 
         study_id = path.split('/')[2]
@@ -105,13 +277,12 @@ class IntracranialDataset(Dataset):
         slices_indices = list(range(middle_img_num - self.config.num_slices // 2,
                                     middle_img_num + self.config.num_slices // 2 + 1))
 
-        if self.config.train_image_size:
-            margin = int((self.config.train_image_size - self.config.pre_crop_size) / 2)
-            slices_image = np.full((self.config.num_slices, self.config.train_image_size, self.config.train_image_size), _HU_AIR)
-            slices_image[:, margin:margin+self.config.pre_crop_size, margin:margin+self.config.pre_crop_size] = \
-                load_scan_2dc(middle_img_path, slices_indices, self.config.pre_crop_size)
+        if self.slice_cache is None:
+            slices_image = self.convert_values(self.load_slices(middle_img_path, slices_indices))
         else:
-            slices_image = load_scan_2dc(middle_img_path, slices_indices, self.config.pre_crop_size)
+            # study_id parsed from negative samples' absolute paths is not reliable
+            slices_image = np.stack([self.load_cached_slice(middle_img_path, middle_img_path.parts[-3], img_num)
+                                     for img_num in slices_indices])
         if seg is None:
             if self.config.train_image_size:
                 margin = int((self.config.train_image_size - self.config.pre_crop_size) / 2)
@@ -121,52 +292,9 @@ class IntracranialDataset(Dataset):
             else:
                 seg = load_seg_slice(seg_path, meta_path, middle_img_num, self.config.pre_crop_size)
 
-        if self.config.use_cdf:
-            slices_image = self.hu_converter.convert(slices_image)
-        else:
-            slices_image = normalize_train(slices_image,
-                                           self.config.min_hu_value,
-                                           self.config.max_hu_value)
-
         slices_image = (slices_image.transpose((1, 2, 0)) + 1) / 2
 
-        transforms = []
-        if self.augment:
-            if self.config.vertical_flip:
-                transforms.append(albumentations.VerticalFlip(p=0.5))
-
-            if self.config.pixel_augment:
-                transforms.append(albumentations.RandomBrightnessContrast(0.2, 0.2, False, 0.8))
-
-            if self.config.elastic_transform:
-                transforms.append(albumentations.ElasticTransform(
-                    alpha=20,
-                    sigma=6,
-                    alpha_affine=10,
-                    interpolation=cv2.INTER_LINEAR,
-                    border_mode=cv2.BORDER_CONSTANT,
-                    value=0,
-                    p=0.5
-                ))
-
-            transforms.extend([
-                albumentations.HorizontalFlip(p=0.5),
-                albumentations.ShiftScaleRotate(
-                    shift_limit=self.config.shift_value, scale_limit=0.15, rotate_limit=30,
-                    interpolation=cv2.INTER_LINEAR,
-                    border_mode=cv2.BORDER_CONSTANT,
-                    value=0,
-                    p=0.9),
-            ])
-
-        if self.augment and self.config.random_crop:
-            transforms.append(albumentations.RandomCrop(self.config.crop_size, self.config.crop_size))
-        elif self.augment and self.config.center_crop:
-            transforms.append(albumentations.CenterCrop(self.config.crop_size, self.config.crop_size))
-
-        # transforms.append(albumentations.pytorch.ToTensorV2())
-
-        processed = albumentations.Compose(transforms)(image=slices_image, mask=seg)
+        processed = self.transforms(image=slices_image, mask=seg)
         img = processed['image']
         seg = processed['mask']
 
@@ -194,12 +322,7 @@ class IntracranialDataset(Dataset):
         }
 
         if not self.test:
-            out['labels'] = torch.tensor(self.data.loc[idx, ['epidural',
-                                                             'intraparenchymal',
-                                                             'intraventricular',
-                                                             'subarachnoid',
-                                                             'subdural',
-                                                             'any']], dtype=torch.float32)
+            out['labels'] = torch.tensor(self.data_index.labels[idx], dtype=torch.float32)
 
         return out
 
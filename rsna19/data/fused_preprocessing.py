@@ -0,0 +1,192 @@
+""" Single pass preprocessing of 2.5D samples: load, resize, pad, values conversion, center crop and normalization
+are written directly into a preallocated CHW output buffer, without the float64 intermediate arrays of
+load_scan_2dc -> HuConverter.convert -> albumentations.CenterCrop -> ToTensorV2.
+"""
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from rsna19.data.utils import HU_AIR, normalize_train
+from rsna19.preprocessing.hu_converter import HuConverter
+
+
+def build_value_lut(use_cdf=True, min_hu_value=20, max_hu_value=100, dtype=np.float32):
+    """Lookup table converting integer HU values to the model input range.
+
+    Normalization round trip of the dataset ((x + 1) / 2 before augmentation, x * 2 - 1 after) is folded into
+    the table, so results match the regular pipeline.
+
+    :return: (lut, min_hu): value of hu is lut[clip(hu - min_hu, 0, len(lut) - 1)]
+    """
+    if use_cdf:
+        min_hu, max_hu = HuConverter.window
+        lut = HuConverter.convert(np.arange(min_hu, max_hu + 1), use_cdf=True)
+    else:
+        min_hu, max_hu = min_hu_value, max_hu_value
+        lut = normalize_train(np.arange(min_hu, max_hu + 1, dtype=np.float64), min_hu, max_hu)
+
+    lut = ((lut + 1) / 2) * 2 - 1
+    return lut.astype(dtype), min_hu
+
+
+def crop_geometry(slice_size, padded_size, crop_size):
+    """Return (src_from, src_to, dst_from, dst_to): the center crop of padded slices in slice coordinates, clipped to
+    the slice area, and its position in the crop"""
+    full_size = padded_size if padded_size is not None else slice_size
+    margin = (full_size - slice_size) // 2
+    crop_from = (full_size - crop_size) // 2
+
+    src_from = max(crop_from - margin, 0)
+    src_to = min(crop_from + crop_size - margin, slice_size)
+    return src_from, src_to, src_from + margin - crop_from, src_to + margin - crop_from
+
+
+def load_window_fused(middle_img_path, slices_indices, slice_size, padded_size, crop_size, lut, lut_min_hu,
+                      out=None, dtype=np.float32):
+    """Load slices window and write converted center crop into (num_slices, crop_size, crop_size) buffer.
+
+    :param slice_size: slices are resized to slice_size x slice_size
+    :param padded_size: slices are padded with air to padded_size, None for no padding
+    :param crop_size: size of the center crop of padded slices
+    :param lut: lookup table from build_value_lut
+    :param out: optional preallocated output buffer, e.g. a view into a batch array
+    """
+    if out is None:
+        out = np.empty((len(slices_indices), crop_size, crop_size), dtype=dtype)
+
+    src_from, src_to, dst_from, dst_to = crop_geometry(slice_size, padded_size, crop_size)
+
+    air_value = lut[min(max(HU_AIR - lut_min_hu, 0), len(lut) - 1)]
+    num_files = len(os.listdir(middle_img_path.parent))
+    indices = np.empty((src_to - src_from, src_to - src_from), dtype=np.int32)
+
+    for slice_idx, img_num in enumerate(slices_indices):
+        slice_out = out[slice_idx]
+        if img_num < 0 or img_num > num_files - 1:
+            slice_out[:] = air_value
+            continue
+
+        slice_img = np.load(middle_img_path.parent.joinpath('{:03d}.npy'.format(img_num)))
+        if slice_img.shape != (slice_size, slice_size):
+            slice_img = cv2.resize(np.int16(slice_img), (slice_size, slice_size), interpolation=cv2.INTER_AREA)
+
+        if dst_from > 0 or dst_to < crop_size:
+            slice_out[:] = air_value
+
+        indices[:] = slice_img[src_from:src_to, src_from:src_to]
+        indices -= lut_min_hu
+        # 'clip' mode clips HU values to the lut range, same as HuConverter/normalize_train
+        np.take(lut, indices, out=slice_out[dst_from:dst_to, dst_from:dst_to], mode='clip')
+
+    return out
+
+
+def load_windows_fused(study_dirs, windows, slice_size, padded_size, crop_size, lut, lut_min_hu):
+    """Batch version of load_window_fused, return (batch, num_slices, crop_size, crop_size) array of lut dtype.
+
+    Each slice needed by the batch is read once, however many windows of the batch contain it, and values of all
+    read slices are converted with a single lookup over the stacked array.
+
+    :param study_dirs: directory of slices of each sample
+    :param windows: (batch, num_slices) array of slice numbers of each sample's window
+    """
+    src_from, src_to, dst_from, dst_to = crop_geometry(slice_size, padded_size, crop_size)
+    windows = np.asarray(windows)
+    dir_codes, unique_dirs = pd.factorize(pd.Series([str(study_dir) for study_dir in study_dirs]))
+
+    # row of each window slice in the stacked HU crops, row 0 is air used for slices outside of the study
+    rows = np.zeros(windows.shape, dtype=np.int64)
+    hu_crops = [np.full((crop_size, crop_size), HU_AIR, dtype=np.int32)]
+    for dir_code, study_dir in enumerate(unique_dirs):
+        samples = dir_codes == dir_code
+        study_windows = windows[samples]
+        valid = (study_windows >= 0) & (study_windows < len(os.listdir(study_dir)))
+        img_nums, inverse = np.unique(study_windows[valid], return_inverse=True)
+
+        study_rows = np.zeros(study_windows.shape, dtype=np.int64)
+        study_rows[valid] = len(hu_crops) + inverse.ravel()
+        rows[samples] = study_rows
+
+        for img_num in img_nums:
+            slice_img = np.load(os.path.join(study_dir, '{:03d}.npy'.format(img_num)))
+            if slice_img.shape != (slice_size, slice_size):
+                slice_img = cv2.resize(np.int16(slice_img), (slice_size, slice_size), interpolation=cv2.INTER_AREA)
+
+            hu_crop = np.full((crop_size, crop_size), HU_AIR, dtype=np.int32)
+            hu_crop[dst_from:dst_to, dst_from:dst_to] = slice_img[src_from:src_to, src_from:src_to]
+            hu_crops.append(hu_crop)
+
+    indices = np.stack(hu_crops)
+    indices -= lut_min_hu
+    # 'clip' mode clips HU values to the lut range, same as load_window_fused
+    converted = np.take(lut, indices, mode='clip')
+    return converted[rows]
+
+
+def check_parity():
+    import tempfile
+    import time
+    from pathlib import Path
+
+    import albumentations
+    import albumentations.pytorch
+
+    from rsna19.data.utils import load_scan_2dc
+
+    def regular_pipeline(middle_img_path, slices_indices, slice_size, padded_size, crop_size, use_cdf):
+        slices_image = load_scan_2dc(middle_img_path, slices_indices, slice_size, padded_size)
+        if use_cdf:
+            slices_image = HuConverter.convert(slices_image)
+        else:
+            slices_image = normalize_train(slices_image, 20, 100)
+        slices_image = (slices_image.transpose((1, 2, 0)) + 1) / 2
+        transforms = albumentations.Compose([albumentations.CenterCrop(crop_size, crop_size),
+                                             albumentations.pytorch.ToTensorV2()])
+        return ((transforms(image=slices_image)['image']) * 2 - 1).numpy()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(12):
+            size = 400 if i % 2 else 512
+            img = np.random.randint(-2000, 3000, (size, size)).astype(np.int16)
+            np.save(os.path.join(tmp_dir, f'{i:03d}.npy'), img)
+        middle_img_path = Path(tmp_dir) / '001.npy'
+
+        for use_cdf in [True, False]:
+            lut, lut_min_hu = build_value_lut(use_cdf)
+            for slice_size, padded_size, crop_size in [(400, None, 384), (400, 448, 448), (400, 448, 384),
+                                                       (384, 448, 416)]:
+                slices_indices = list(range(-3, 6))
+                expected = regular_pipeline(middle_img_path, slices_indices, slice_size, padded_size, crop_size,
+                                            use_cdf)
+                result = load_window_fused(middle_img_path, slices_indices, slice_size, padded_size, crop_size,
+                                           lut, lut_min_hu)
+                # cdf path is float32 in both pipelines, hu path is float64 in the regular pipeline
+                if use_cdf:
+                    assert np.array_equal(expected, result)
+                else:
+                    assert np.array_equal(np.float32(expected), result)
+
+                windows = np.array([range(-3, 6), range(2, 11), range(4, 13)])
+                batch = load_windows_fused([middle_img_path.parent] * 3, windows, slice_size, padded_size,
+                                           crop_size, lut, lut_min_hu)
+                for window, result in zip(windows, batch):
+                    assert np.array_equal(result, load_window_fused(middle_img_path, window, slice_size, padded_size,
+                                                                    crop_size, lut, lut_min_hu))
+
+        lut, lut_min_hu = build_value_lut(True)
+        start = time.time()
+        for _ in range(20):
+            regular_pipeline(middle_img_path, list(range(9)), 400, None, 384, True)
+        regular_time = (time.time() - start) / 20
+        out = np.empty((9, 384, 384), dtype=np.float32)
+        start = time.time()
+        for _ in range(20):
+            load_window_fused(middle_img_path, list(range(9)), 400, None, 384, lut, lut_min_hu, out=out)
+        fused_time = (time.time() - start) / 20
+        print(f'parity ok, regular: {regular_time * 1000:.1f} ms, fused: {fused_time * 1000:.1f} ms per 9 slices')
+
+
+if __name__ == '__main__':
+    check_parity()
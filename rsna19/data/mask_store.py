@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import skimage
+import skimage.transform
+
+from rsna19.configs.base_config import BaseConfig
+from rsna19.data.utils import load_seg_3d
+
+
+class SegmentationMaskStore:
+    """Read-only store of segmentation masks resized to dataset's image size.
+
+    Masks of a study are converted from nifti on first use and saved as a .npy file, later they are only memory
+    mapped. A converted file older than the nifti or meta.json of its study is converted again. Mapped files are shared through page cache, so all dataset instances and DataLoader workers using the
+    same store directory keep a single copy of mask data in memory, and only studies actually sampled are read.
+    """
+
+    def __init__(self, img_size, masks_dir=None, store_dir=None):
+        """
+        :param img_size: masks are resized to img_size x img_size
+        :param masks_dir: directory with <study_id>/Untitled.nii.gz and <study_id>/meta.json,
+                          defaults to data_root/segmentation_masks
+        :param store_dir: directory of converted masks, defaults to masks_dir/store_<img_size>
+        """
+        self.img_size = img_size
+        self.masks_dir = masks_dir or f'{BaseConfig.data_root}/segmentation_masks'
+        self.store_dir = store_dir or f'{self.masks_dir}/store_{img_size}'
+        # memory maps opened by this process
+        self.studies = {}
+
+    def _store_path(self, study_id):
+        return os.path.join(self.store_dir, f'{study_id}.npy')
+
+    def convert(self, study_id):
+        """Convert nifti masks of a study and save them in the store, if not there or older than the source files"""
+        store_path = self._store_path(study_id)
+        meta_path = f'{self.masks_dir}/{study_id}/meta.json'
+        seg_path = f'{self.masks_dir}/{study_id}/Untitled.nii.gz'
+        if os.path.exists(store_path) and \
+                os.path.getmtime(store_path) >= max(os.path.getmtime(seg_path), os.path.getmtime(meta_path)):
+            return
+
+        seg = load_seg_3d(seg_path, meta_path)
+        if seg.shape[1:] != (self.img_size, self.img_size):
+            seg = np.array([
+                skimage.transform.resize(np.float32(seg[i]), (self.img_size, self.img_size),
+                                         order=0, anti_aliasing=False).astype(seg.dtype)
+                for i in range(seg.shape[0])
+            ])
+
+        # workers may convert the same study at the same time, rename makes the complete file appear atomically
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp_path = f'{store_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, seg)
+        os.replace(tmp_path, store_path)
+
+    def build(self, study_ids):
+        """Convert masks of all given studies, e.g. in the main process before DataLoader workers start"""
+        for study_id in study_ids:
+            self.convert(study_id)
+
+    def get(self, study_id):
+        """Return read-only (slices, img_size, img_size) memory map of study masks"""
+        seg = self.studies.get(study_id)
+        if seg is None:
+            self.convert(study_id)
+            seg = self.studies[study_id] = np.load(self._store_path(study_id), mmap_mode='r')
+        return seg
+
+    def get_slice(self, study_id, slice_num):
+        return np.array(self.get(study_id)[slice_num])
+
+    def __getstate__(self):
+        # memory maps are opened again after unpickling, e.g. in spawned workers
+        state = self.__dict__.copy()
+        state['studies'] = {}
+        return state
+
+
+def check_store():
+    import json
+    import tempfile
+    import time
+
+    import nibabel as nib
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        study_ids = [f'ID_{i:010d}' for i in range(3)]
+        for study_id in study_ids:
+            os.makedirs(f'{tmp_dir}/{study_id}')
+            seg = np.random.randint(0, 7, (512, 512, 30)).astype(np.uint8)
+            nib.save(nib.Nifti1Image(seg, np.eye(4)), f'{tmp_dir}/{study_id}/Untitled.nii.gz')
+            with open(f'{tmp_dir}/{study_id}/meta.json', 'w') as f:
+                json.dump({'spacing': [1.0, 1.0, 5.0], 'image_orientation': [1, 0, 0, 0, 1, 0],
+                           'crop_x': 256, 'crop_y': 256, 'pre_crop_shape': [30, 512, 512],
+                           'out_shape': [30, 512, 512]}, f)
+
+        store = SegmentationMaskStore(400, masks_dir=tmp_dir)
+        start = time.time()
+        first = store.get_slice(study_ids[0], 10)
+        print(f'first access (conversion): {(time.time() - start) * 1000:.0f} ms')
+
+        other_store = SegmentationMaskStore(400, masks_dir=tmp_dir)
+        start = time.time()
+        assert np.array_equal(other_store.get_slice(study_ids[0], 10), first)
+        print(f'access of converted study: {(time.time() - start) * 1000:.1f} ms')
+        assert first.shape == (400, 400) and first.dtype == np.uint8
+        assert sorted(os.listdir(store.store_dir)) == [f'{study_ids[0]}.npy']
+
+        # masks edited after conversion are converted again
+        seg = np.zeros((512, 512, 30), dtype=np.uint8)
+        nib.save(nib.Nifti1Image(seg, np.eye(4)), f'{tmp_dir}/{study_ids[0]}/Untitled.nii.gz')
+        converted_time = os.path.getmtime(store._store_path(study_ids[0]))
+        os.utime(f'{tmp_dir}/{study_ids[0]}/Untitled.nii.gz', (converted_time + 1, converted_time + 1))
+        store.build(study_ids)
+        assert not SegmentationMaskStore(400, masks_dir=tmp_dir).get_slice(study_ids[0], 10).any()
+        assert sorted(os.listdir(store.store_dir)) == [f'{study_id}.npy' for study_id in study_ids]
+
+
+if __name__ == '__main__':
+    check_store()
@@ -0,0 +1,145 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from torch.utils.data.sampler import Sampler
+
+
+class PrefetchingSampler(Sampler):
+    """Wraps a sampler or batch sampler and reads slices of upcoming samples into dataset's shared slice cache.
+
+    The wrapped sampler is iterated depth items ahead of what is yielded to the DataLoader. For each new index,
+    dataset.prefetch_requests(idx) gives (key, load_fn) pairs of slices the sample will need; the ones not cached yet
+    are loaded by a pool of threads in the main process and put into dataset.slice_cache, where DataLoader workers
+    find them. Reads release the GIL, so many reads are in flight at the same time, which hides latency of network
+    storage. The cache budget should hold at least depth samples on top of what workers are processing.
+    """
+
+    def __init__(self, sampler, dataset, depth, num_threads=8):
+        """
+        :param sampler: sampler of indices or batch sampler of lists of indices
+        :param depth: number of sampler items (samples or batches) read ahead
+        :param num_threads: max number of concurrent reads
+        """
+        self.sampler = sampler
+        self.dataset = dataset
+        self.depth = depth
+        self.num_threads = num_threads
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._counters = collections.Counter()
+        self._read_seconds = 0.0
+
+    def _submit(self, item):
+        indices = item if isinstance(item, (list, tuple)) else [item]
+        for idx in indices:
+            for key, load_fn in self.dataset.prefetch_requests(idx):
+                with self._lock:
+                    if key in self._in_flight:
+                        continue
+                    if self.dataset.slice_cache.contains(key):
+                        self._counters['already_cached'] += 1
+                        continue
+                    self._in_flight.add(key)
+                    self._counters['submitted'] += 1
+                    self._counters['max_queue_depth'] = max(self._counters['max_queue_depth'],
+                                                            len(self._in_flight))
+                self._executor.submit(self._load, key, load_fn)
+
+    def _load(self, key, load_fn):
+        start = time.time()
+        try:
+            self.dataset.slice_cache.put(key, load_fn())
+            counter = 'completed'
+        except Exception:
+            # the sample's worker reads the slice again and reports the error
+            counter = 'errors'
+        with self._lock:
+            self._in_flight.discard(key)
+            self._counters[counter] += 1
+            self._read_seconds += time.time() - start
+
+    def __iter__(self):
+        if self._executor is None:
+            # started on first iteration, after DataLoader workers are forked
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+
+        upcoming = collections.deque()
+        for item in self.sampler:
+            upcoming.append(item)
+            self._submit(item)
+            if len(upcoming) > self.depth:
+                yield upcoming.popleft()
+
+        while upcoming:
+            yield upcoming.popleft()
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def stats(self):
+        """Prefetch counters and stall time of workers, i.e. time they spent reading slices missing in the cache"""
+        with self._lock:
+            stats = {
+                'queue_depth': len(self._in_flight),
+                'max_queue_depth': self._counters['max_queue_depth'],
+                'submitted': self._counters['submitted'],
+                'completed': self._counters['completed'],
+                'errors': self._counters['errors'],
+                'already_cached': self._counters['already_cached'],
+                'read_seconds': self._read_seconds
+            }
+        cache_stats = self.dataset.slice_cache.stats()
+        stats['worker_stall_seconds'] = cache_stats['miss_load_seconds']
+        stats['cache_hit_rate'] = cache_stats['hit_rate']
+        return stats
+
+
+def prefetching(sampler, dataset, depth, num_threads=8):
+    """Wrap sampler in PrefetchingSampler if depth > 0 and dataset uses a shared slice cache"""
+    if depth <= 0 or getattr(dataset, 'slice_cache', None) is None:
+        return sampler
+    return PrefetchingSampler(sampler, dataset, depth, num_threads)
+
+
+def check_prefetcher(num_samples=200, read_latency=0.02):
+    """Compare DataLoader time with slow reads (sleep simulates network storage latency) with and without prefetch"""
+    import numpy as np
+    from torch.utils.data import DataLoader, Dataset, SequentialSampler
+
+    from rsna19.data.slice_cache import SharedSliceCache
+
+    class SlowDataset(Dataset):
+        def __init__(self):
+            self.slice_cache = SharedSliceCache(64 * 256 * 256 * 4, 256 * 256 * 4)
+
+        def read(self, slice_num):
+            time.sleep(read_latency)
+            return np.full((256, 256), slice_num, dtype=np.float32)
+
+        def prefetch_requests(self, idx):
+            return [(('study', slice_num), lambda slice_num=slice_num: self.read(slice_num))
+                    for slice_num in range(idx - 1, idx + 2)]
+
+        def __len__(self):
+            return num_samples
+
+        def __getitem__(self, idx):
+            return np.stack([self.slice_cache.get_or_load(key, load_fn) for key, load_fn in self.prefetch_requests(idx)])
+
+    for depth in [0, 16]:
+        dataset = SlowDataset()
+        sampler = prefetching(SequentialSampler(dataset), dataset, depth, num_threads=8)
+        start = time.time()
+        for batch in DataLoader(dataset, batch_size=8, num_workers=2, sampler=sampler):
+            assert batch.shape == (8, 3, 256, 256)
+        elapsed = time.time() - start
+        stats = sampler.stats() if depth > 0 else dataset.slice_cache.stats()
+        print(f'depth {depth}: {num_samples / elapsed:.0f} samples/s, {stats}')
+
+
+if __name__ == '__main__':
+    check_prefetcher()
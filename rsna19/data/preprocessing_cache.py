@@ -0,0 +1,286 @@
+""" Cache of the deterministic part of sample preprocessing.
+
+Slice loading, resize to pre_crop_size, padding and CDF or HU normalization give the same result in every epoch,
+only the augmentations applied after them are random. Converted slices are cached in two tiers:
+ * memory - SharedSliceCache shared by DataLoader workers, config.slice_cache_bytes
+ * disk - DiskSliceCache in config.preprocessing_cache_dir, bounded by config.preprocessing_cache_bytes,
+   kept between runs
+
+Keys contain transform_signature(), a hash of config fields the deterministic part depends on. Changing any of
+them gives a new signature, so entries of the old one are never read again and are the first to be evicted.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from rsna19.data.slice_cache import SharedSliceCache
+
+# bump when code of the deterministic preprocessing changes, to invalidate existing caches
+PREPROCESSING_VERSION = 1
+
+SIGNATURE_FIELDS = ['data_version', 'pre_crop_size', 'padded_size', 'train_image_size', 'use_cdf', 'min_hu_value',
+                    'max_hu_value', 'apply_windows', 'scale_values']
+
+
+def signature_fields(config, kind):
+    """Config fields the deterministic preprocessing of dataset kind (e.g. '2dc', 'seg') depends on"""
+    fields = {name: getattr(config, name, None) for name in SIGNATURE_FIELDS}
+    fields['kind'] = kind
+    fields['version'] = PREPROCESSING_VERSION
+    return fields
+
+
+def transform_signature(config, kind):
+    fields = json.dumps(signature_fields(config, kind), sort_keys=True, default=str)
+    return hashlib.blake2b(fields.encode(), digest_size=8).hexdigest()
+
+
+class DiskSliceCache:
+    """Converted slices stored as .npy files in root_dir/<signature>/<study_id>/<slice_num>.npy.
+
+    Files are written via temporary files, so workers never read partial entries. Reads update file mtime, which
+    orders entries for eviction: every evict_interval writes of a process, files under root_dir (of all signatures)
+    are scanned and the least recently used ones removed until 90% of budget_bytes is used.
+    Hit and miss counters are per process.
+    """
+
+    def __init__(self, root_dir, budget_bytes, signature, fields=None, evict_interval=256):
+        self.root_dir = root_dir
+        self.budget_bytes = budget_bytes
+        self.signature = signature
+        self.cache_dir = os.path.join(root_dir, signature)
+        self.evict_interval = evict_interval
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if fields is not None:
+            with open(os.path.join(self.cache_dir, 'signature.json'), 'w') as f:
+                json.dump(fields, f, indent=2, sort_keys=True, default=str)
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.load_seconds = 0.0
+
+    def path(self, key):
+        study_id, slice_num = key[:2]
+        return os.path.join(self.cache_dir, study_id, f'{int(slice_num):03d}.npy')
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            array = np.load(path)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            # missing, evicted by another process or unreadable
+            self.misses += 1
+            return None
+        self.hits += 1
+        return array
+
+    def put(self, key, array):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+        self.writes += 1
+        if self.writes % self.evict_interval == 0:
+            self.evict()
+
+    def get_or_load(self, key, load_fn):
+        array = self.get(key)
+        if array is None:
+            start = time.time()
+            array = load_fn()
+            self.put(key, array)
+            self.load_seconds += time.time() - start
+        return array
+
+    def entries(self):
+        """Return (mtime, size, path) of all cached files under root_dir"""
+        entries = []
+        for dir_path, _, file_names in os.walk(self.root_dir):
+            for file_name in file_names:
+                if not file_name.endswith('.npy'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.budget_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= 0.9 * self.budget_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / max(self.hits + self.misses, 1),
+            'miss_load_seconds': self.load_seconds,
+            'signature': self.signature,
+            'budget_bytes': self.budget_bytes
+        }
+
+
+class TieredSliceCache:
+    """Memory tier in front of disk tier, with the interface of SharedSliceCache.
+
+    Every memory miss is looked up on disk, so a get is a hit if either tier has the entry and a miss if both miss.
+    Memory counters are shared by all processes, disk counters are per process.
+    """
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+
+    def contains(self, key):
+        return self.memory.contains(key) or self.disk.contains(key)
+
+    def get(self, key):
+        array = self.memory.get(key)
+        if array is None:
+            array = self.disk.get(key)
+            if array is not None:
+                self.memory.put(key, array)
+        return array
+
+    def put(self, key, array):
+        self.memory.put(key, array)
+        self.disk.put(key, array)
+
+    def get_or_load(self, key, load_fn):
+        array = self.get(key)
+        if array is None:
+            start = time.time()
+            array = load_fn()
+            self.put(key, array)
+            # the entry was missing in both tiers
+            load_seconds = time.time() - start
+            self.memory.add_load_seconds(load_seconds)
+            self.disk.load_seconds += load_seconds
+        return array
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+    def stats(self):
+        """Combined hit rate and load time of misses as in SharedSliceCache.stats, with stats of both tiers"""
+        memory = self.memory.stats()
+        disk = self.disk.stats()
+        hits = memory['hits'] + disk['hits']
+        # memory misses are counted again as disk hits or misses
+        misses = disk['misses']
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1),
+            # load time is counted in both tiers, memory counters include all processes
+            'miss_load_seconds': memory['miss_load_seconds'],
+            'memory': memory,
+            'disk': disk
+        }
+
+
+def create_slice_cache(config, kind, slot_bytes):
+    """Create cache of converted slices configured by slice_cache_bytes and preprocessing_cache_dir, or None
+
+    :param slot_bytes: max size of a converted slice
+    """
+    slice_cache_bytes = getattr(config, 'slice_cache_bytes', 0)
+    cache_dir = getattr(config, 'preprocessing_cache_dir', None)
+
+    memory = SharedSliceCache(slice_cache_bytes, slot_bytes) if slice_cache_bytes > 0 else None
+    if cache_dir is None:
+        return memory
+
+    fields = signature_fields(config, kind)
+    disk = DiskSliceCache(cache_dir, getattr(config, 'preprocessing_cache_bytes', 50 * 2 ** 30),
+                          transform_signature(config, kind), fields)
+    if memory is None:
+        return disk
+    return TieredSliceCache(memory, disk)
+
+
+def check_preprocessing_cache():
+    """Compare samples loaded with disk and memory cache against uncached ones, over two epochs and with prefetching"""
+    import tempfile
+
+    import torch
+    from torch.utils.data import DataLoader, SequentialSampler
+
+    from rsna19.configs.clf2Dc import Config
+    from rsna19.data import synthetic
+    from rsna19.data.dataset_2dc import IntracranialDataset
+    from rsna19.data.prefetch import PrefetchingSampler
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_root, csv_root_dir = synthetic.generate_dataset(os.path.join(tmp_dir, 'data'), 3, num_slices=(20, 24))
+
+        class config(Config):
+            pass
+        config.data_root = data_root
+        config.csv_root_dir = csv_root_dir
+        config.val_dataset_file = '5fold.csv'
+        config.preprocessing_cache_dir = os.path.join(tmp_dir, 'cache')
+        config.slice_cache_bytes = 2 ** 26
+        folds = list(range(config.nb_folds))
+
+        reference = IntracranialDataset(config, folds, mode='val')
+        reference.slice_cache = None
+        expected = [reference[idx]['image'] for idx in range(len(reference))]
+
+        for epoch in range(2):
+            dataset = IntracranialDataset(config, folds, mode='val')
+            start = time.time()
+            images = [dataset[idx]['image'] for idx in range(len(dataset))]
+            assert all(np.array_equal(image, expected_image) for image, expected_image in zip(images, expected))
+            print(f'epoch {epoch}: {time.time() - start:.2f} s, {dataset.slice_cache.stats()}')
+
+        # prefetching into the tiered cache from the main process, while DataLoader workers read from it
+        dataset = IntracranialDataset(config, folds, mode='val')
+        dataset.slice_cache.clear()
+        sampler = PrefetchingSampler(SequentialSampler(dataset), dataset, depth=16)
+        images = [batch['image'] for batch in DataLoader(dataset, batch_size=8, num_workers=2, sampler=sampler)]
+        assert all(np.array_equal(image, expected_image)
+                   for image, expected_image in zip(torch.cat(images), expected))
+        stats = sampler.stats()
+        assert stats['submitted'] > 0 and 0 <= stats['cache_hit_rate'] <= 1, stats
+        print(f'prefetch: {stats}')
+
+        # a change of any signature field gives a new cache directory
+        config.pre_crop_size = 384
+        IntracranialDataset(config, folds, mode='val')
+        assert len(os.listdir(config.preprocessing_cache_dir)) == 2
+
+
+if __name__ == '__main__':
+    check_preprocessing_cache()
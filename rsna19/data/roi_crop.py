@@ -0,0 +1,310 @@
+""" Cropping of samples to the bounding box of the head.
+
+Datasets crop a fixed square (crop_size) around the center of the slice, while the head often covers much less of
+it. With config.roi_crop set, IntracranialDataset crops each sample to the bounding box of the head plus
+config.roi_margin pixels instead, then either
+ * resizes the square crop to config.roi_size, or
+ * with roi_size None, takes the smallest of config.roi_buckets which fits the box around its center, without
+   resize. Samples of a batch must share a bucket, see models/commons/bucket_sampler.py.
+
+Boxes are computed per study ('study', union over all slices of the study) or per sample ('slice', union over
+slices of the window). Study boxes are computed once and stored in csv_root_dir/roi_boxes_<data_version>.csv,
+studies missing there are computed when the dataset is created:
+
+    python rsna19/data/roi_crop.py compute --csv 5fold.csv test2.csv --data_version 3d
+    python rsna19/data/roi_crop.py benchmark --backbones resnet34 resnet18 --roi_sizes 256 320
+    python rsna19/data/roi_crop.py report --predictions <crop_dir>/predictions/val_normal.csv \
+        <roi_dir>/predictions/val_normal.csv
+
+Crop geometry of each sample is returned with it as 'roi' (y0, x0, side, out_size, slice_size), map_to_slice()
+maps heatmaps or segmentation outputs of the cropped image back to the slice.
+"""
+import argparse
+import glob
+import math
+import os
+import time
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+from rsna19.configs.base_config import BaseConfig
+
+# pixels above it belong to the head (skin, brain, skull), air and background of cropped 3d data are below
+ROI_HU = -100
+ROI_BOX_COLUMNS = ['y0', 'x0', 'y1', 'x1']
+
+
+def default_csv_root_dir(csv_root_dir=None):
+    return csv_root_dir or os.path.normpath(__file__ + '/../csv')
+
+
+def roi_box_csv(data_version):
+    return f'roi_boxes_{data_version}.csv'
+
+
+def head_box(image, threshold, step=4):
+    """Bounding box (y0, x0, y1, x1) of the largest connected region above threshold, None if there is none
+
+    :param image: (H, W) slice or (N, H, W) slices, whose union is used
+    :param step: the region is found on a grid of every step-th pixel, box is rounded outwards
+    """
+    mask = image[..., ::step, ::step] > threshold
+    if mask.ndim == 3:
+        mask = mask.any(axis=0)
+
+    # drops e.g. the table or the headrest if they are not connected to the head
+    labels, num_regions = ndimage.label(mask)
+    if num_regions == 0:
+        return None
+    if num_regions > 1:
+        mask = labels == np.bincount(labels.ravel())[1:].argmax() + 1
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    height, width = image.shape[-2:]
+    return (int(rows[0]) * step, int(cols[0]) * step,
+            min((int(rows[-1]) + 1) * step, height), min((int(cols[-1]) + 1) * step, width))
+
+
+def study_head_box(study_dir, step=2):
+    """Head box of HU slices of study_dir, relative to slice size (0-1 range), the whole slice if there is no head"""
+    paths = sorted(glob.glob(os.path.join(study_dir, '*.npy')))[::step]
+    if not paths:
+        return 0.0, 0.0, 1.0, 1.0
+
+    projection = None
+    for path in paths:
+        hu = np.load(path)
+        projection = hu if projection is None else np.maximum(projection, hu)
+
+    box = head_box(projection, ROI_HU)
+    if box is None:
+        return 0.0, 0.0, 1.0, 1.0
+    height, width = projection.shape
+    return box[0] / height, box[1] / width, box[2] / height, box[3] / width
+
+
+def study_dir_of_path(path, data_root, data_version):
+    """Slices directory of data_version of a csv path"""
+    full_path = os.path.normpath(os.path.join(data_root, '..', path.replace('npy/', data_version + '/')))
+    return os.path.dirname(full_path)
+
+
+def compute_study_boxes(paths, data_root=None, data_version='npy', workers=8):
+    """Return head boxes of studies of csv paths (one path of each study), as DataFrame indexed by study_id"""
+    data_root = data_root or BaseConfig.data_root
+    study_dirs = [study_dir_of_path(path, data_root, data_version) for path in paths]
+    if workers > 1 and len(study_dirs) > 100:
+        with Pool(workers) as pool:
+            boxes = pool.map(study_head_box, study_dirs, chunksize=16)
+    else:
+        boxes = [study_head_box(study_dir) for study_dir in study_dirs]
+    study_ids = [path.split('/')[2] for path in paths]
+    return pd.DataFrame(boxes, index=pd.Index(study_ids, name='study_id'), columns=ROI_BOX_COLUMNS)
+
+
+def load_study_boxes(csv_root_dir, data_version):
+    path = os.path.join(default_csv_root_dir(csv_root_dir), roi_box_csv(data_version))
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=ROI_BOX_COLUMNS, index=pd.Index([], name='study_id'), dtype=np.float64)
+    return pd.read_csv(path, index_col='study_id')
+
+
+def study_boxes(data, config):
+    """Return head boxes (relative to slice size) of studies of data (a dataset csv), as DataFrame by study_id.
+
+    Boxes missing in roi_boxes_<data_version>.csv are computed.
+    """
+    first_paths = data.path.groupby(data.path.str.split('/').str[2]).first()
+    boxes = load_study_boxes(config.csv_root_dir, config.data_version)
+    missing = sorted(set(first_paths.index) - set(boxes.index))
+    if missing:
+        print(f'computing head boxes of {len(missing)} studies, '
+              f'store them with: python rsna19/data/roi_crop.py compute --data_version {config.data_version}')
+        boxes = pd.concat([boxes, compute_study_boxes(first_paths[missing].tolist(), config.data_root,
+                                                      config.data_version)])
+    return boxes.reindex(first_paths.index)
+
+
+def slice_box(relative_box, pre_crop_size, padded_size=None):
+    """Box relative to the loaded slice converted to pixels of a slice loaded by load_scan_2dc"""
+    offset = (padded_size - pre_crop_size) // 2 if padded_size is not None else 0
+    return tuple(offset + value * pre_crop_size for value in relative_box)
+
+
+def roi_geometry(box, slice_size, margin, out_size=None, buckets=None):
+    """Square crop of a head box, as int array (y0, x0, side, out_size, slice_size).
+
+    The crop is centered on the box, its side is the longer side of the box plus 2 * margin. It is resized to
+    out_size, or with out_size None enlarged to the smallest bucket which fits it (resized to the largest bucket if
+    none does). Corners may lie outside of the slice.
+    """
+    y0, x0, y1, x1 = box
+    side = int(math.ceil(max(y1 - y0, x1 - x0))) + 2 * margin
+    if out_size is None:
+        fitting = [bucket for bucket in sorted(buckets) if bucket >= side]
+        out_size = fitting[0] if fitting else max(buckets)
+        side = max(side, out_size)
+
+    top = int(round((y0 + y1 - side) / 2))
+    left = int(round((x0 + x1 - side) / 2))
+    return np.array([top, left, side, out_size, slice_size], dtype=np.int32)
+
+
+def bucket_of_geometry(geometry, buckets):
+    return sorted(buckets).index(int(geometry[3]))
+
+
+def crop_roi(image, geometry, fill_value=0):
+    """Crop (H, W, C) image to roi geometry, parts outside the image are filled with fill_value"""
+    top, left, side, out_size = (int(value) for value in geometry[:4])
+    height, width = image.shape[:2]
+
+    cropped = np.full((side, side) + image.shape[2:], fill_value, dtype=image.dtype)
+    src_y0, src_x0 = max(top, 0), max(left, 0)
+    src_y1, src_x1 = min(top + side, height), min(left + side, width)
+    if src_y1 > src_y0 and src_x1 > src_x0:
+        cropped[src_y0 - top:src_y1 - top, src_x0 - left:src_x1 - left] = image[src_y0:src_y1, src_x0:src_x1]
+
+    if side != out_size:
+        interpolation = cv2.INTER_AREA if side > out_size else cv2.INTER_LINEAR
+        resized = cv2.resize(cropped, (out_size, out_size), interpolation=interpolation)
+        # cv2 drops the channel axis of single channel images
+        cropped = resized.reshape((out_size, out_size) + image.shape[2:])
+    return cropped
+
+
+def map_to_slice(output, geometry, interpolation=cv2.INTER_LINEAR, fill_value=0):
+    """Map output of a cropped sample (heatmap, segmentation) back to the slice the crop was taken from.
+
+    :param output: (H, W) or (C, H, W) array of any resolution covering the cropped image
+    :param geometry: 'roi' of the sample
+    :return: array of shape (slice_size, slice_size) or (C, slice_size, slice_size)
+    """
+    top, left, side, _, slice_size = (int(value) for value in geometry)
+    output = np.asarray(output)
+    channels_first = output.ndim == 3
+    planes = output if channels_first else output[None]
+
+    mapped = np.full((len(planes), slice_size, slice_size), fill_value, dtype=planes.dtype)
+    dst_y0, dst_x0 = max(top, 0), max(left, 0)
+    dst_y1, dst_x1 = min(top + side, slice_size), min(left + side, slice_size)
+    if dst_y1 > dst_y0 and dst_x1 > dst_x0:
+        for plane, mapped_plane in zip(planes, mapped):
+            resized = cv2.resize(plane, (side, side), interpolation=interpolation)
+            mapped_plane[dst_y0:dst_y1, dst_x0:dst_x1] = resized[dst_y0 - top:dst_y1 - top, dst_x0 - left:dst_x1 - left]
+
+    return mapped if channels_first else mapped[0]
+
+
+def benchmark(args):
+    """Images/s of data loading and forward pass of Classifier2DC, center crop against roi crop variants"""
+    import tempfile
+
+    import torch
+
+    from rsna19.configs.clf2Dc import Config
+    from rsna19.data import synthetic
+    from rsna19.data.dataset_2dc import IntracranialDataset
+    from rsna19.models.clf2Dc.classifier2dc import Classifier2DC
+
+    tmp_dir = tempfile.mkdtemp()
+    data_root, csv_root_dir = synthetic.generate_dataset(os.path.join(tmp_dir, 'data'), args.num_studies,
+                                                         layouts=('3d',))
+    variants = [('center crop', dict(roi_crop=None))]
+    variants += [(f'roi {args.roi_level} {size}', dict(roi_crop=args.roi_level, roi_size=size))
+                 for size in args.roi_sizes]
+    if args.roi_level == 'study':
+        variants.append((f'roi study buckets {args.roi_buckets}', dict(roi_crop='study', roi_size=None,
+                                                                      roi_buckets=args.roi_buckets)))
+
+    for backbone in args.backbones:
+        for name, overrides in variants:
+            overrides = dict(overrides, data_root=data_root, csv_root_dir=csv_root_dir, val_dataset_file='5fold.csv',
+                             data_version='3d', backbone=backbone, pretrained=None, multibranch=False,
+                             num_slices=3, pre_crop_size=400, padded_size=None, crop_size=384, gpus=[],
+                             batch_size=args.batch_size, num_workers=args.workers)
+            config = type('config', (Config,), overrides)
+            dataset = IntracranialDataset(config, list(range(config.nb_folds)), mode='val')
+            model = Classifier2DC(config).to(args.device)
+            model.eval()
+
+            data_loader = model.data_loader('bench', dataset, sampler=range(len(dataset)))
+            load_seconds = forward_seconds = 0.0
+            num_images = 0
+            sizes = set()
+            start = time.time()
+            with torch.no_grad():
+                for batch in data_loader:
+                    load_seconds += time.time() - start
+                    start = time.time()
+                    images = model.transport_decoder.decode(batch['image'])
+                    model(images.to(args.device))
+                    forward_seconds += time.time() - start
+                    num_images += len(images)
+                    sizes.add(images.shape[-1])
+                    if num_images >= args.num_images:
+                        break
+                    start = time.time()
+
+            print(f'{backbone} {name}: input {sorted(sizes)}, loading {num_images / load_seconds:.1f} images/s, '
+                  f'forward on {args.device} {num_images / forward_seconds:.1f} images/s')
+
+
+def report(predictions_paths):
+    """Print weighted log loss of OOF predictions, relative to the first of them"""
+    from rsna19.data.blank_slices import weighted_log_loss
+    from rsna19.data.sample_index import LABEL_COLUMNS
+
+    base = None
+    for path in predictions_paths:
+        predictions = pd.read_csv(path)
+        loss = weighted_log_loss(predictions[['gt_' + c for c in LABEL_COLUMNS]].values,
+                                 predictions[['pred_' + c for c in LABEL_COLUMNS]].values)
+        base = loss if base is None else base
+        print(f'{path}: {len(predictions)} slices, log loss {loss:.5f} ({loss - base:+.5f})')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['compute', 'benchmark', 'report'])
+    parser.add_argument('--csv', type=str, nargs='+', default=['5fold.csv'], help='dataset csv files')
+    parser.add_argument('--csv_root_dir', type=str, default=None)
+    parser.add_argument('--data_version', type=str, default='3d')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--predictions', type=str, nargs='+', default=[])
+    parser.add_argument('--backbones', type=str, nargs='+', default=['resnet34', 'resnet18'])
+    parser.add_argument('--roi_level', type=str, default='study', choices=['study', 'slice'])
+    parser.add_argument('--roi_sizes', type=int, nargs='+', default=[256, 320])
+    parser.add_argument('--roi_buckets', type=int, nargs='+', default=[256, 320, 384])
+    parser.add_argument('--num_studies', type=int, default=6)
+    parser.add_argument('--num_images', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    if args.action == 'compute':
+        csv_root_dir = default_csv_root_dir(args.csv_root_dir)
+        data = pd.concat([pd.read_csv(os.path.join(csv_root_dir, csv_file)) for csv_file in args.csv], sort=False)
+        first_paths = data.path.groupby(data.path.str.split('/').str[2]).first()
+
+        boxes = load_study_boxes(csv_root_dir, args.data_version)
+        missing = sorted(set(first_paths.index) - set(boxes.index))
+        boxes = pd.concat([boxes, compute_study_boxes(first_paths[missing].tolist(), data_version=args.data_version,
+                                                      workers=args.workers)])
+        boxes.to_csv(os.path.join(csv_root_dir, roi_box_csv(args.data_version)))
+        sides = np.maximum(boxes.y1 - boxes.y0, boxes.x1 - boxes.x0)
+        print(f'{len(missing)} studies computed, longer side of head box: median {sides.median():.2f}, '
+              f'max {sides.max():.2f} of slice size')
+    elif args.action == 'benchmark':
+        benchmark(args)
+    else:
+        report(args.predictions)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+LABEL_COLUMNS = ['epidural', 'intraparenchymal', 'intraventricular', 'subarachnoid', 'subdural', 'any']
+
+
+class SampleIndex:
+    """Compact, read-only index of dataset samples built from a fold csv.
+
+    All data is kept in a few flat numpy arrays, so per item lookups don't allocate pandas objects and forked
+    DataLoader workers reading the index don't touch per-row python objects (which would un-share copy-on-write
+    pages because of reference counting).
+    """
+
+    def __init__(self, data, with_labels=True):
+        """
+        :param data: DataFrame with 'path' column (e.g. rsna/train/ID_0004f7a877/npy/000.npy) and label columns
+        :param with_labels: if True, LABEL_COLUMNS are read into labels matrix
+        """
+        paths = [path.encode() for path in data.path]
+        lengths = np.array([len(path) for path in paths], dtype=np.int64)
+        self.path_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.path_bytes = np.array(bytearray(b''.join(paths)), dtype=np.uint8)
+
+        study_codes, study_names = pd.factorize(data.path.str.split('/').str[2])
+        self.study_ids = study_codes.astype(np.int32)
+        self.study_names = np.array(study_names, dtype=np.bytes_)
+        self.slice_nums = data.path.apply(lambda x: int(os.path.basename(x).split('.')[0])).values.astype(np.int32)
+
+        if with_labels:
+            self.labels = data[LABEL_COLUMNS].values.astype(np.float32)
+        else:
+            self.labels = None
+
+    def __len__(self):
+        return len(self.slice_nums)
+
+    def path(self, idx):
+        return self.path_bytes[self.path_offsets[idx]:self.path_offsets[idx + 1]].tobytes().decode()
+
+    def study_name(self, idx):
+        return self.study_names[self.study_ids[idx]].decode()
+
+
+def _private_dirty_kb():
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Private_Dirty'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        return -1
+
+
+def _measure_in_child(fn, n):
+    """Run fn(i) for n items in forked process, return (us per item, private dirty memory growth in kB)"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        mem_before = _private_dirty_kb()
+        start = time.time()
+        for i in range(n):
+            fn(i)
+        latency = (time.time() - start) / n * 1e6
+        os.write(write_fd, f'{latency} {_private_dirty_kb() - mem_before}'.encode())
+        os._exit(0)
+
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    latency, mem = os.read(read_fd, 1024).decode().split()
+    os.close(read_fd)
+    return float(latency), int(mem)
+
+
+def check_performance(num_samples=670000, num_items=20000):
+    """Compare per item lookups and memory touched by a forked worker: pandas .loc vs SampleIndex
+
+    Both read the same num_items rows, spread over the whole dataset.
+    """
+    rows = np.arange(num_samples)
+    data = pd.DataFrame({'path': [f'rsna/train/ID_{i // 40:010d}/npy/{i % 40:03d}.npy' for i in rows],
+                         'fold': rows % 5})
+    for col in LABEL_COLUMNS:
+        data[col] = (np.random.rand(num_samples) > 0.9).astype(np.float64)
+
+    index = SampleIndex(data)
+    assert index.path(12345) == data.loc[12345, 'path']
+    assert index.study_name(12345) == data.loc[12345, 'path'].split('/')[2]
+
+    step = max(num_samples // num_items, 1)
+
+    def pandas_item(i):
+        i *= step
+        return data.loc[i, 'path'], data.loc[i, LABEL_COLUMNS].values.astype(np.float32)
+
+    def index_item(i):
+        i *= step
+        return index.path(i), index.labels[i].copy()
+
+    # see how much memory a worker un-shares
+    for name, fn in [('pandas .loc', pandas_item), ('SampleIndex', index_item)]:
+        latency, mem = _measure_in_child(fn, num_items)
+        print(f'{name}: {latency:.2f} us/item, worker private memory +{mem / 1024:.1f} MB '
+              f'({mem / num_items:.3f} kB/item, {num_items} items)')
+
+
+if __name__ == '__main__':
+    check_performance()
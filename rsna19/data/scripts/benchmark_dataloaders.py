@@ -0,0 +1,290 @@
+""" DataLoader throughput benchmark of all datasets on synthetic data, runs on CPU.
+
+For each dataset, representative config, storage backend and number of workers measures samples/s, per item
+latency (p50/p99, measured inside workers), bytes of tensors sent from workers per sample and RSS of worker
+processes. Results are stored as JSON, a previous result file can be given to compare throughput:
+
+    python rsna19/data/scripts/benchmark_dataloaders.py --out bench.json --workers 0 2 4 --backends disk shm latency:5
+    python rsna19/data/scripts/benchmark_dataloaders.py --out bench2.json --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from rsna19.configs.base_config import BaseConfig
+from rsna19.data import synthetic
+
+# dataset name -> representative model names (clf2D, 3d_v2) or config modules (2dc, seg)
+DEFAULT_CONFIGS = {
+    'clf2D': ['resnet34_512_crop_384_window_set7', 'resnet34_512_crop_384_cdf',
+              'resnet34_256_cdf_5_planes_combine_last'],
+    '2dc': ['clf2Dc', 'clf2Dc_resnet34_3c', 'clf2Dc_resnet50_3c_384'],
+    '3d_v2': ['resnet34_400_5_planes_combine_last'],
+    'seg': ['segmentation_config']
+}
+
+
+class TimedDataset(Dataset):
+    """Adds time spent in __getitem__ to samples, so that latency measured in workers reaches the main process"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        start = time.perf_counter()
+        sample = self.dataset[idx]
+        sample['bench_item_seconds'] = time.perf_counter() - start
+        return sample
+
+
+def load_config(name, data_root, csv_root_dir):
+    import importlib
+
+    config = importlib.import_module(f'rsna19.configs.{name}').Config
+    overrides = dict(data_root=data_root, csv_root_dir=csv_root_dir, dataset_file='5fold.csv',
+                     train_dataset_file='5fold.csv', val_dataset_file='5fold.csv', gpus=[])
+    return type(name, (config,), overrides)
+
+
+def create_dataset(dataset_name, config_name, data_root, csv_root_dir, augment):
+    folds = list(range(BaseConfig.nb_folds))
+    if dataset_name == 'clf2D':
+        from rsna19.data import dataset
+        from rsna19.models.clf2D.experiments import MODELS
+
+        preprocess_func = None
+        if augment:
+            import albumentations
+            import cv2
+            preprocess_func = albumentations.Compose([
+                albumentations.ShiftScaleRotate(shift_limit=16. / 256, scale_limit=0.05, rotate_limit=30,
+                                                interpolation=cv2.INTER_LINEAR, border_mode=cv2.BORDER_REPLICATE,
+                                                p=0.80),
+                albumentations.Flip(),
+                albumentations.RandomRotate90()
+            ])
+        return dataset.IntracranialDataset(csv_file='5fold.csv', folds=folds, csv_root_dir=csv_root_dir,
+                                           preprocess_func=preprocess_func, **MODELS[config_name].dataset_args)
+
+    if dataset_name == '3d_v2':
+        import albumentations.pytorch
+        from rsna19.data import dataset_3d_v2
+        from rsna19.models.clf3D.experiments_3d import MODELS
+
+        return dataset_3d_v2.IntracranialDataset(csv_file='5fold.csv', folds=folds, csv_root_dir=csv_root_dir,
+                                                 random_slice=augment,
+                                                 preprocess_func=albumentations.pytorch.ToTensorV2(),
+                                                 **MODELS[config_name].dataset_args)
+
+    config = load_config(config_name, data_root, csv_root_dir)
+    if dataset_name == '2dc':
+        from rsna19.data import dataset_2dc
+        return dataset_2dc.IntracranialDataset(config, folds, mode='train', augment=augment)
+
+    if dataset_name == 'seg':
+        from rsna19.data import dataset_seg
+        return dataset_seg.IntracranialDataset(config, folds, augment=augment)
+
+    raise ValueError(f'Unknown dataset {dataset_name}')
+
+
+def init_latency_worker(latency):
+    """Return worker_init_fn adding latency to each np.load, simulating network storage"""
+    def worker_init_fn(worker_id):
+        np_load = np.load
+
+        def slow_load(*args, **kwargs):
+            time.sleep(latency)
+            return np_load(*args, **kwargs)
+
+        np.load = slow_load
+
+    return worker_init_fn
+
+
+def prepare_backend(backend, data_dir, tmp_dir):
+    """Return (data dir, worker_init_fn) of a storage backend: 'disk', 'shm' or 'latency:<ms>'"""
+    if backend == 'disk':
+        return data_dir, None
+    if backend == 'shm':
+        shm_dir = os.path.join(tempfile.mkdtemp(dir='/dev/shm'), 'data')
+        shutil.copytree(data_dir, shm_dir)
+        return shm_dir, None
+    if backend.startswith('latency:'):
+        return data_dir, init_latency_worker(float(backend.split(':')[1]) / 1000)
+    raise ValueError(f'Unknown backend {backend}')
+
+
+def process_rss_kb(pid):
+    """Return (VmRSS, RssAnon) in kB, RssAnon is memory not shared with files"""
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS', 'RssAnon')):
+                    key, value = line.split(':')
+                    values[key] = int(value.split()[0])
+    except FileNotFoundError:
+        pass
+    return values.get('VmRSS', 0), values.get('RssAnon', 0)
+
+
+def batch_bytes(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.element_size() * batch.numel()
+    if isinstance(batch, dict):
+        return sum(batch_bytes(value) for value in batch.values())
+    if isinstance(batch, (list, tuple)):
+        return sum(batch_bytes(value) for value in batch)
+    return 0
+
+
+def run_loader(dataset, num_workers, batch_size, num_batches, warmup_batches, worker_init_fn):
+    if worker_init_fn is not None and num_workers == 0:
+        np_load = np.load
+        worker_init_fn(0)
+    data_loader = DataLoader(TimedDataset(dataset), batch_size=batch_size, num_workers=num_workers, shuffle=True,
+                             worker_init_fn=worker_init_fn)
+    loader_iter = iter(data_loader)
+
+    item_seconds = []
+    sample_bytes = []
+    num_samples = 0
+    # without warmup the first batch is counted, so its loading time is too
+    start = time.perf_counter() if warmup_batches == 0 else None
+    try:
+        for batch_num in range(warmup_batches + num_batches):
+            try:
+                batch = next(loader_iter)
+            except StopIteration:
+                break
+            if batch_num == warmup_batches - 1:
+                start = time.perf_counter()
+            elif batch_num >= warmup_batches:
+                item_seconds.extend(batch['bench_item_seconds'].tolist())
+                sample_bytes.append(batch_bytes(batch) / len(batch['bench_item_seconds']))
+                num_samples += len(batch['bench_item_seconds'])
+        elapsed = time.perf_counter() - start
+
+        workers = getattr(loader_iter, '_workers', None) or getattr(loader_iter, 'workers', [])
+        workers_rss = [process_rss_kb(worker.pid) for worker in workers]
+    finally:
+        del loader_iter
+        if worker_init_fn is not None and num_workers == 0:
+            np.load = np_load
+
+    main_rss, _ = process_rss_kb(os.getpid())
+    return {
+        'samples': num_samples,
+        'samples_per_second': num_samples / elapsed if elapsed > 0 else None,
+        'item_latency_p50_ms': float(np.percentile(item_seconds, 50) * 1000) if item_seconds else None,
+        'item_latency_p99_ms': float(np.percentile(item_seconds, 99) * 1000) if item_seconds else None,
+        'ipc_bytes_per_sample': float(np.mean(sample_bytes)) if sample_bytes else None,
+        'worker_rss_mb': [rss / 1024 for rss, _ in workers_rss],
+        'worker_rss_anon_mb': [rss_anon / 1024 for _, rss_anon in workers_rss],
+        'main_rss_mb': main_rss / 1024
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['dataset'], r['config'], r['backend'], r['num_workers']): r for r in json.load(f)['results']}
+
+    for result in results:
+        key = (result['dataset'], result['config'], result['backend'], result['num_workers'])
+        if key not in baseline or not result.get('samples_per_second') \
+                or not baseline[key].get('samples_per_second'):
+            continue
+        ratio = result['samples_per_second'] / baseline[key]['samples_per_second']
+        print(f'{" ".join(map(str, key)):80s} {ratio:6.2f}x samples/s vs baseline')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', type=str, required=True, help='output JSON file')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='synthetic data directory, generated if it does not exist, defaults to a temp dir')
+    parser.add_argument('--num_studies', type=int, default=20)
+    parser.add_argument('--datasets', type=str, nargs='+', default=list(DEFAULT_CONFIGS))
+    parser.add_argument('--configs', type=str, nargs='+', default=None,
+                        help='model names or config modules, defaults to representative ones of each dataset')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument('--backends', type=str, nargs='+', default=['disk'],
+                        help="'disk', 'shm' (copy in /dev/shm) or 'latency:<ms>' (delay of each np.load)")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_batches', type=int, default=20)
+    parser.add_argument('--warmup_batches', type=int, default=2)
+    parser.add_argument('--augment', action='store_true')
+    parser.add_argument('--compare', type=str, default=None, help='previous JSON result to compare with')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    data_dir = args.data_dir or os.path.join(tmp_dir, 'data')
+    if not os.path.exists(os.path.join(data_dir, 'csv', '5fold.csv')):
+        print(f'generating {args.num_studies} synthetic studies in {data_dir}')
+        synthetic.generate_dataset(data_dir, args.num_studies)
+
+    results = []
+    try:
+        for backend in args.backends:
+            backend_dir, worker_init_fn = prepare_backend(backend, data_dir, tmp_dir)
+            data_root = os.path.join(backend_dir, 'rsna')
+            csv_root_dir = os.path.join(backend_dir, 'csv')
+            BaseConfig.data_root = data_root
+
+            try:
+                for dataset_name in args.datasets:
+                    for config_name in args.configs or DEFAULT_CONFIGS[dataset_name]:
+                        entry = dict(dataset=dataset_name, config=config_name, backend=backend, augment=args.augment)
+                        try:
+                            dataset = create_dataset(dataset_name, config_name, data_root, csv_root_dir, args.augment)
+                        except Exception as e:
+                            # e.g. configs looking up checkpoints at import time
+                            print(f'skip {dataset_name} {config_name}: {e!r}')
+                            results.append(dict(entry, num_workers=None, error=repr(e)))
+                            continue
+
+                        for num_workers in args.workers:
+                            result = dict(entry, num_workers=num_workers)
+                            result.update(run_loader(dataset, num_workers, args.batch_size, args.num_batches,
+                                                     args.warmup_batches, worker_init_fn))
+                            print(json.dumps(result))
+                            results.append(result)
+            finally:
+                if backend == 'shm':
+                    # the copy in /dev/shm is not under tmp_dir, it would stay in memory after a failed run
+                    shutil.rmtree(os.path.dirname(backend_dir), ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump({
+            'environment': {
+                'cpu_count': os.cpu_count(),
+                'platform': platform.platform(),
+                'python': platform.python_version(),
+                'torch': torch.__version__,
+                'numpy': np.__version__,
+                'torch_threads': torch.get_num_threads()
+            },
+            'args': vars(args),
+            'results': results
+        }, f, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
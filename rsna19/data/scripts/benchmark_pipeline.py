@@ -0,0 +1,95 @@
+""" Time preprocessing scripts end to end on synthetic DICOM studies, runs on CPU.
+
+Generates competition style DICOM data with data/synthetic.py, points BaseConfig to it and runs create_dataframe,
+create_symlinks, convert_dataset and prepare_3d_data in order, like on the real dataset. Stages which fail (e.g.
+vtk not installed) are reported with the error. Results are stored as JSON; the output directory can be passed
+as --data_dir to benchmark_dataloaders.py to time datasets on the preprocessed data:
+
+    python rsna19/data/scripts/benchmark_pipeline.py --out pipeline.json --num_studies 20 --keep /tmp/synthetic
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import traceback
+from glob import glob
+
+from rsna19.configs.base_config import BaseConfig
+from rsna19.data import synthetic
+
+
+def run_create_symlinks(module):
+    module.main(os.path.join(BaseConfig.data_root, 'df.pkl'), os.path.join(BaseConfig.data_root, 'id_to_path.pkl'))
+
+
+# stage name -> function running the stage given its module, modules read BaseConfig paths at import time
+STAGES = [
+    ('create_dataframe', lambda module: module.main()),
+    ('create_symlinks', run_create_symlinks),
+    ('convert_dataset', lambda module: module.main()),
+    ('prepare_3d_data', lambda module: module.main())
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', type=str, required=True, help='output JSON file')
+    parser.add_argument('--num_studies', type=int, default=20)
+    parser.add_argument('--num_test_studies', type=int, default=5)
+    parser.add_argument('--num_slices', type=int, nargs=2, default=[24, 40])
+    parser.add_argument('--dicom_size', type=int, default=512)
+    parser.add_argument('--stages', type=str, nargs='+', default=[name for name, _ in STAGES])
+    parser.add_argument('--keep', type=str, default=None, help='directory to keep generated and converted data in')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    out_dir = args.keep or tempfile.mkdtemp()
+    if os.path.exists(os.path.join(out_dir, 'rsna')):
+        raise ValueError(f'{out_dir} already contains converted data, create_symlinks needs an empty directory')
+
+    results = {}
+    try:
+        start = time.time()
+        synthetic.generate_dataset(out_dir, args.num_studies, num_slices=args.num_slices,
+                                   num_test_studies=args.num_test_studies, dicom_size=args.dicom_size,
+                                   seed=args.seed, layouts=('dicom',))
+        num_slices = len(glob(f'{out_dir}/stage_2_*/*.dcm'))
+        results['generate'] = {'seconds': time.time() - start}
+        synthetic.configure(out_dir)
+        os.makedirs(BaseConfig.data_root, exist_ok=True)
+
+        for name, run in STAGES:
+            if name not in args.stages:
+                continue
+            try:
+                start = time.time()
+                run(importlib.import_module(f'rsna19.data.scripts.{name}'))
+                seconds = time.time() - start
+                results[name] = {'seconds': seconds, 'slices_per_second': num_slices / seconds}
+            except Exception as e:
+                traceback.print_exc()
+                results[name] = {'error': repr(e)}
+            print(name, results[name])
+    finally:
+        if args.keep is None:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump({
+            'environment': {
+                'cpu_count': os.cpu_count(),
+                'platform': platform.platform(),
+                'python': platform.python_version()
+            },
+            'args': vars(args),
+            'num_slices': num_slices,
+            'results': results
+        }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import hashlib
+import mmap
+import multiprocessing
+import time
+
+import numpy as np
+
+
+def slice_key(study_id, slice_num, data_version, size, conversion):
+    """Build cache key of a single preprocessed slice.
+
+    :param size: output size(s) of the slice, e.g. (pre_crop_size, padded_size)
+    :param conversion: description of the values conversion, e.g. ('cdf',) or ('hu', min_hu_value, max_hu_value)
+    """
+    return study_id, int(slice_num), data_version, size, conversion
+
+
+class SharedSliceCache:
+    """LRU cache of preprocessed slices kept in anonymous shared memory.
+
+    Memory is allocated in the constructor, so the cache has to be created before DataLoader workers are forked
+    (e.g. in dataset's __init__). All worker processes and the main process then see the same entries.
+    Entries are stored in fixed size slots of slot_bytes, number of slots is derived from the byte budget.
+    Only fork start method is supported, the cache can't be pickled.
+    """
+    _DTYPES = [np.dtype(t) for t in (np.uint8, np.int16, np.int32, np.int64, np.float16, np.float32, np.float64)]
+    _MAX_DIMS = 3
+
+    # per slot metadata columns
+    _KEY, _TICK, _NBYTES, _DTYPE, _SHAPE = 0, 1, 2, 3, 4
+    # shared counters, load time of get_or_load misses is in microseconds
+    _CLOCK, _HITS, _MISSES, _LOAD_US = 0, 1, 2, 3
+
+    def __init__(self, budget_bytes, slot_bytes):
+        """
+        :param budget_bytes: total memory available for cached data
+        :param slot_bytes: max size of a single entry, larger arrays are not cached
+        """
+        self.slot_bytes = int(slot_bytes)
+        self.num_slots = max(int(budget_bytes) // self.slot_bytes, 1)
+
+        self._data_buffer = mmap.mmap(-1, self.num_slots * self.slot_bytes)
+        self._meta_buffer = mmap.mmap(-1, self.num_slots * (self._SHAPE + self._MAX_DIMS) * 8)
+        self._counters_buffer = mmap.mmap(-1, 4 * 8)
+
+        self._data = np.frombuffer(self._data_buffer, dtype=np.uint8).reshape(self.num_slots, self.slot_bytes)
+        self._meta = np.frombuffer(self._meta_buffer, dtype=np.int64).reshape(self.num_slots, -1)
+        self._counters = np.frombuffer(self._counters_buffer, dtype=np.int64)
+
+        self._lock = multiprocessing.Lock()
+
+    @staticmethod
+    def _hash(key):
+        # python's hash() of str is salted per process, use stable digest instead
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+        h = int(np.frombuffer(digest, dtype=np.int64)[0])
+        # 0 marks empty slot
+        return h if h != 0 else 1
+
+    def _find(self, h):
+        found = np.flatnonzero(self._meta[:, self._KEY] == h)
+        return found[0] if len(found) else -1
+
+    def contains(self, key):
+        """Check if key is cached, without updating LRU order and hit counters"""
+        h = self._hash(key)
+        with self._lock:
+            return self._find(h) >= 0
+
+    def get(self, key):
+        """Return a copy of cached array or None"""
+        h = self._hash(key)
+        with self._lock:
+            slot = self._find(h)
+            if slot < 0:
+                self._counters[self._MISSES] += 1
+                return None
+
+            self._counters[self._CLOCK] += 1
+            self._counters[self._HITS] += 1
+            meta = self._meta[slot]
+            meta[self._TICK] = self._counters[self._CLOCK]
+
+            dtype = self._DTYPES[meta[self._DTYPE]]
+            shape = tuple(int(d) for d in meta[self._SHAPE:] if d > 0)
+            return self._data[slot, :meta[self._NBYTES]].view(dtype).reshape(shape).copy()
+
+    def put(self, key, array):
+        if array.nbytes > self.slot_bytes or array.ndim > self._MAX_DIMS or array.dtype not in self._DTYPES:
+            return
+
+        h = self._hash(key)
+        array = np.ascontiguousarray(array)
+        with self._lock:
+            if self._find(h) >= 0:
+                return
+
+            empty = np.flatnonzero(self._meta[:, self._KEY] == 0)
+            slot = empty[0] if len(empty) else np.argmin(self._meta[:, self._TICK])
+
+            self._counters[self._CLOCK] += 1
+            meta = self._meta[slot]
+            meta[self._KEY] = h
+            meta[self._TICK] = self._counters[self._CLOCK]
+            meta[self._NBYTES] = array.nbytes
+            meta[self._DTYPE] = self._DTYPES.index(array.dtype)
+            meta[self._SHAPE:] = 0
+            meta[self._SHAPE:self._SHAPE + array.ndim] = array.shape
+            self._data[slot, :array.nbytes] = array.reshape(-1).view(np.uint8)
+
+    def get_or_load(self, key, load_fn):
+        array = self.get(key)
+        if array is None:
+            start = time.time()
+            array = load_fn()
+            self.put(key, array)
+            self.add_load_seconds(time.time() - start)
+        return array
+
+    def add_load_seconds(self, seconds):
+        """Count time spent loading a missing entry, shared by all processes"""
+        with self._lock:
+            self._counters[self._LOAD_US] += int(seconds * 1e6)
+
+    def clear(self):
+        with self._lock:
+            self._meta[:] = 0
+            self._counters[:] = 0
+
+    def stats(self):
+        with self._lock:
+            hits = int(self._counters[self._HITS])
+            misses = int(self._counters[self._MISSES])
+            used = self._meta[:, self._KEY] != 0
+            return {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / max(hits + misses, 1),
+                # time spent loading missing entries by get_or_load callers
+                'miss_load_seconds': int(self._counters[self._LOAD_US]) / 1e6,
+                'entries': int(used.sum()),
+                'slots': self.num_slots,
+                'bytes_held': int(self._meta[used, self._NBYTES].sum()),
+                'budget_bytes': self.num_slots * self.slot_bytes
+            }
+
+
+def check_cache():
+    import os
+    import time
+
+    cache = SharedSliceCache(budget_bytes=4 * 400 * 400 * 4, slot_bytes=400 * 400 * 4)
+    for i in range(6):
+        cache.put(('study', i), np.full((400, 400), i, dtype=np.float32))
+    assert cache.get(('study', 0)) is None
+    assert cache.get(('study', 5))[0, 0] == 5
+
+    # entries added in a forked process are visible in the parent
+    pid = os.fork()
+    if pid == 0:
+        cache.put(('worker', 0), np.arange(10, dtype=np.int16))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert np.array_equal(cache.get(('worker', 0)), np.arange(10, dtype=np.int16))
+
+    start = time.time()
+    for i in range(10000):
+        cache.get(('study', i % 8))
+    print(f'get: {(time.time() - start) / 10000 * 1e6:.1f} us')
+    print(cache.stats())
+
+
+if __name__ == '__main__':
+    check_cache()
@@ -0,0 +1,306 @@
+""" Synthetic CT studies in the layouts consumed by scripts and datasets, for benchmarks on machines without RSNA data.
+
+Studies are simple head phantoms (skull ring, brain, ventricles) with hyperdense bleeding blobs on positive
+slices. Depending on layouts, data is written as:
+ * 'dicom' - competition style raw data, to run the whole preprocessing pipeline:
+   <out_dir>/stage_2_train/ID_<sop>.dcm, <out_dir>/stage_2_test/ID_<sop>.dcm - flat dirs of DICOM slices with
+   ImagePositionPatient and ImageOrientationPatient (gantry tilt) tags, and <out_dir>/stage_2_train.csv labels
+ * 'npy' - <out_dir>/rsna/<subset>/<study_id>/npy/NNN.npy - int16 HU slices, like convert_dataset output
+ * '3d' - <out_dir>/rsna/<subset>/<study_id>/3d/NNN.npy and meta.json - slices cropped to img_size around center
+   of mass, like prepare_3d_data output. Pixels of tilted studies are not sheared, only meta.json records the tilt.
+ * 'masks' - <out_dir>/rsna/train/<study_id>/Untitled.nii.gz - masks of segmented studies, used by dataset_seg,
+   and the same masks with meta.json in <out_dir>/rsna/segmentation_masks/<study_id>/, used by dataset.py
+Fold csv files are always written: <out_dir>/csv/5fold.csv, 5fold3D.csv and test.csv.
+BaseConfig.data_root should point to <out_dir>/rsna and csv_root_dir to <out_dir>/csv, see configure().
+"""
+import json
+import os
+import shutil
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from rsna19.data.utils import HU_AIR, crop_scan
+
+LABEL_COLUMNS = ['epidural', 'intraparenchymal', 'intraventricular', 'subarachnoid', 'subdural', 'any']
+LAYOUTS = ('dicom', 'npy', '3d', 'masks')
+# as in prepare_3d_data
+BG_HU = -2000
+RESCALE_INTERCEPT = -1024
+
+
+def phantom_slice(img_size, slice_pos, random_state, center=(0.0, 0.0)):
+    """Return int16 HU axial slice of a head phantom and its brain mask
+
+    :param slice_pos: position in 0-1 range from the bottom of the head
+    :param center: (row, col) offset of head center from image center, as a fraction of img_size
+    """
+    rows, cols = np.mgrid[:img_size, :img_size].astype(np.float32) / img_size - 0.5
+    rows -= center[0]
+    cols -= center[1]
+    # head gets smaller towards top and bottom of the study
+    scale = 0.2 + 0.25 * np.sin(np.pi * (0.15 + 0.8 * slice_pos))
+    head = (rows / (scale * 1.15)) ** 2 + (cols / scale) ** 2
+
+    img = np.full((img_size, img_size), HU_AIR, dtype=np.float32)
+    img[head < 1.0] = 1000
+    img[head < 0.85] = 35
+    img[(rows / (scale * 0.3)) ** 2 + (cols / (scale * 0.12)) ** 2 < 1.0] = 5
+    img[head < 0.85] += random_state.normal(0, 6, size=int((head < 0.85).sum()))
+    return img.astype(np.int16), head < 0.85
+
+
+def add_bleeding(img, brain, class_num, random_state):
+    """Add a hyperdense blob to the brain, return its mask"""
+    candidates = np.argwhere(brain)
+    center = candidates[random_state.randint(len(candidates))]
+    radius = random_state.uniform(0.02, 0.06) * img.shape[0]
+    rows, cols = np.mgrid[:img.shape[0], :img.shape[1]]
+    mask = ((rows - center[0]) ** 2 + (cols - center[1]) ** 2 < radius ** 2) & brain
+    img[mask] = 60 + 5 * class_num
+    return mask
+
+
+def generate_study(num_slices, img_size, positive, positive_ratio, class_probs, random_state):
+    """Return (HU volume, masks volume, per slice labels) of a study"""
+    center = random_state.uniform(-0.05, 0.05, size=2)
+    scan = np.zeros((num_slices, img_size, img_size), dtype=np.int16)
+    seg = np.zeros((num_slices, img_size, img_size), dtype=np.uint8)
+    labels = np.zeros((num_slices, len(LABEL_COLUMNS)))
+
+    for slice_num in range(num_slices):
+        scan[slice_num], brain = phantom_slice(img_size, slice_num / num_slices, random_state, center)
+        if positive and random_state.rand() < positive_ratio:
+            class_num = random_state.choice(len(class_probs), p=class_probs)
+            seg[slice_num][add_bleeding(scan[slice_num], brain, class_num, random_state)] = class_num + 1
+            labels[slice_num, class_num] = labels[slice_num, -1] = 1
+
+    return scan, seg, labels
+
+
+def random_uid(random_state):
+    return f'ID_{random_state.randint(0, 2 ** 40, dtype=np.int64):010x}'
+
+
+def save_dicom(path, pixels, study_id, sop_id, patient_id, slice_num, position, orientation, pixel_spacing):
+    """Save uint16 pixels as a DICOM slice with tags read by create_dataframe, PydicomLoader and vtk"""
+    import pydicom
+    from pydicom.dataset import FileDataset
+    from pydicom.uid import ExplicitVRLittleEndian
+    try:
+        from pydicom.dataset import FileMetaDataset
+    except ImportError:
+        # pydicom < 1.4
+        from pydicom.dataset import Dataset as FileMetaDataset
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    file_meta.MediaStorageSOPInstanceUID = f'1.2.3.{int(sop_id[3:], 16)}'
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        ds = FileDataset(path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPInstanceUID = sop_id
+        ds.StudyInstanceUID = study_id
+        ds.SeriesInstanceUID = study_id.replace('ID_', 'ID_s')
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.Modality = 'CT'
+    ds.PatientID = patient_id
+    ds.StudyID = ''
+    ds.InstanceNumber = slice_num + 1
+    ds.ImagePositionPatient = [round(float(v), 4) for v in position]
+    ds.ImageOrientationPatient = [round(float(v), 6) for v in orientation]
+    ds.PixelSpacing = [float(pixel_spacing), float(pixel_spacing)]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows, ds.Columns = pixels.shape
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.WindowCenter = 40
+    ds.WindowWidth = 80
+    ds.RescaleIntercept = RESCALE_INTERCEPT
+    ds.RescaleSlope = 1
+    ds.PixelData = pixels.astype('<u2').tobytes()
+    with warnings.catch_warnings():
+        # RSNA style ids are not valid UIDs, as in competition data
+        warnings.simplefilter('ignore')
+        pydicom.dcmwrite(path, ds, write_like_original=False)
+
+
+def save_seg(seg, study_dir, meta_path):
+    """Save masks as nifti in pre-crop space next to meta.json of the 3D scan, readable by utils.load_seg_3d"""
+    import nibabel as nib
+
+    os.makedirs(study_dir, exist_ok=True)
+    # load_seg transposes nifti data from (x, y, z) to (z, y, x)
+    nib.save(nib.Nifti1Image(seg.transpose(2, 1, 0), np.eye(4)), os.path.join(study_dir, 'Untitled.nii.gz'))
+    if os.path.abspath(os.path.dirname(meta_path)) != os.path.abspath(study_dir):
+        shutil.copy(meta_path, os.path.join(study_dir, 'meta.json'))
+
+
+def save_3d(scan, study_dir, img_size, pixel_spacing, slice_thickness, orientation):
+    """Save cropped slices in study_dir/3d/ and meta.json like prepare_3d_data.process_scan, return meta.json path"""
+    from scipy import ndimage
+
+    out_dir = os.path.join(study_dir, '3d')
+    os.makedirs(out_dir, exist_ok=True)
+
+    _, y, x = ndimage.center_of_mass(scan > 0)
+    scan_cropped = crop_scan(scan, (img_size, img_size), x, y, BG_HU)
+    for slice_num, scan_slice in enumerate(scan_cropped):
+        np.save(os.path.join(out_dir, f'{slice_num:03d}.npy'), scan_slice.astype(np.int16))
+
+    meta_path = os.path.join(study_dir, 'meta.json')
+    with open(meta_path, 'w') as f:
+        json.dump({
+            'spacing': [pixel_spacing, pixel_spacing, slice_thickness],
+            'image_orientation': list(orientation),
+            'crop_x': x,
+            'crop_y': y,
+            'pre_crop_shape': list(scan.shape),
+            'out_shape': list(scan_cropped.shape)
+        }, f, indent=2)
+    return meta_path
+
+
+def generate_dataset(out_dir, num_studies=20, num_slices=(24, 40), img_size=400, positive_ratio=0.3,
+                     segmented_ratio=0.2, nb_folds=5, seed=0, num_test_studies=0, dicom_size=None,
+                     positive_study_ratio=0.5, class_probs=None, tilted_ratio=0.2, max_tilt=25.0,
+                     pixel_spacing=0.5, slice_thickness=5.0, layouts=('3d', 'masks')):
+    """
+    :param num_studies: number of train studies, test studies are extra
+    :param num_slices: (min, max) number of slices of a study
+    :param img_size: size of cropped 3d/ slices
+    :param positive_ratio: fraction of slices of positive studies with bleeding
+    :param segmented_ratio: fraction of positive train studies with segmentation masks
+    :param dicom_size: size of dicom and npy/ slices, defaults to img_size * 1.28 (512 for 400)
+    :param positive_study_ratio: fraction of studies with bleeding
+    :param class_probs: probabilities of the 5 bleeding classes on positive slices, uniform by default
+    :param tilted_ratio: fraction of studies with gantry tilt, in the range of +-max_tilt degrees
+    :param layouts: subset of LAYOUTS to write
+    :return: (data_root, csv_root_dir)
+    """
+    unknown_layouts = set(layouts) - set(LAYOUTS)
+    if unknown_layouts:
+        raise ValueError(f'Unknown layouts {unknown_layouts}, expected a subset of {LAYOUTS}')
+
+    random_state = np.random.RandomState(seed)
+    dicom_size = dicom_size or int(round(img_size * 1.28))
+    class_probs = np.ones(5) / 5 if class_probs is None else np.asarray(class_probs, dtype=np.float64)
+    class_probs = class_probs / class_probs.sum()
+
+    data_root = os.path.join(out_dir, 'rsna')
+    csv_root_dir = os.path.join(out_dir, 'csv')
+    os.makedirs(csv_root_dir, exist_ok=True)
+
+    slice_rows = []
+    study_rows = []
+    test_rows = []
+    dicom_labels = []
+    for study_num in range(num_studies + num_test_studies):
+        subset = 'train' if study_num < num_studies else 'test'
+        study_id = f'ID_{study_num:010x}'
+        study_dir = os.path.join(data_root, subset, study_id)
+        fold = study_num % nb_folds
+
+        study_slices = random_state.randint(num_slices[0], num_slices[1] + 1)
+        positive_study = random_state.rand() < positive_study_ratio
+        scan, seg, labels = generate_study(study_slices, dicom_size, positive_study, positive_ratio, class_probs,
+                                           random_state)
+
+        tilt = random_state.uniform(-max_tilt, max_tilt) if random_state.rand() < tilted_ratio else 0.0
+        orientation = [1, 0, 0, 0, np.cos(np.radians(tilt)), np.sin(np.radians(tilt))]
+
+        if 'dicom' in layouts:
+            dicom_dir = os.path.join(out_dir, f'stage_2_{subset}')
+            os.makedirs(dicom_dir, exist_ok=True)
+            patient_id = random_uid(random_state)
+            origin = -dicom_size * pixel_spacing / 2
+            for slice_num in range(study_slices):
+                sop_id = random_uid(random_state)
+                position = [origin, origin, slice_num * slice_thickness]
+                save_dicom(os.path.join(dicom_dir, f'{sop_id}.dcm'),
+                           np.maximum(scan[slice_num].astype(np.int32) - RESCALE_INTERCEPT, 0),
+                           study_id, sop_id, patient_id, slice_num, position, orientation, pixel_spacing)
+                if subset == 'train':
+                    dicom_labels += [[f'{sop_id}_{column}', int(labels[slice_num, i])]
+                                     for i, column in enumerate(LABEL_COLUMNS)]
+
+        if 'npy' in layouts:
+            os.makedirs(os.path.join(study_dir, 'npy'), exist_ok=True)
+            for slice_num in range(study_slices):
+                np.save(os.path.join(study_dir, 'npy', f'{slice_num:03d}.npy'), scan[slice_num])
+
+        meta_path = None
+        if '3d' in layouts or 'masks' in layouts:
+            meta_path = save_3d(scan, study_dir, img_size, pixel_spacing, slice_thickness, orientation)
+            if '3d' not in layouts:
+                shutil.rmtree(os.path.join(study_dir, '3d'))
+
+        if subset == 'test':
+            test_rows += [f'rsna/test/{study_id}/npy/{slice_num:03d}.npy' for slice_num in range(study_slices)]
+            continue
+
+        if 'masks' in layouts and positive_study and random_state.rand() < segmented_ratio:
+            save_seg(seg, study_dir, meta_path)
+            save_seg(seg, os.path.join(data_root, 'segmentation_masks', study_id), meta_path)
+
+        slice_rows += [[f'rsna/train/{study_id}/npy/{slice_num:03d}.npy', fold] + list(labels[slice_num])
+                       for slice_num in range(study_slices)]
+        study_labels = labels.max(axis=0)
+        study_rows.append(list(study_labels[-1:]) + list(study_labels[:-1]) + [f'rsna/train/{study_id}', fold])
+
+    pd.DataFrame(slice_rows, columns=['path', 'fold'] + LABEL_COLUMNS) \
+        .to_csv(os.path.join(csv_root_dir, '5fold.csv'), index=False)
+    pd.DataFrame(study_rows, columns=['any'] + LABEL_COLUMNS[:-1] + ['path', 'fold']) \
+        .to_csv(os.path.join(csv_root_dir, '5fold3D.csv'), index=False)
+    pd.DataFrame({'path': test_rows}).to_csv(os.path.join(csv_root_dir, 'test.csv'), index=False)
+    if 'dicom' in layouts:
+        pd.DataFrame(dicom_labels, columns=['ID', 'Label']) \
+            .to_csv(os.path.join(out_dir, 'stage_2_train.csv'), index=False)
+
+    return data_root, csv_root_dir
+
+
+def configure(out_dir, config=None):
+    """Point BaseConfig (and optionally a config class) paths to data generated in out_dir"""
+    from rsna19.configs.base_config import BaseConfig
+
+    for cls in [BaseConfig] + ([config] if config is not None else []):
+        cls.data_root = os.path.join(out_dir, 'rsna')
+        cls.csv_root_dir = os.path.join(out_dir, 'csv')
+        cls.train_dir = os.path.join(out_dir, 'stage_2_train')
+        cls.test_dir = os.path.join(out_dir, 'stage_2_test')
+        cls.labels_path = os.path.join(out_dir, 'stage_2_train.csv')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--num_studies', type=int, default=20)
+    parser.add_argument('--num_test_studies', type=int, default=0)
+    parser.add_argument('--num_slices', type=int, nargs=2, default=[24, 40])
+    parser.add_argument('--img_size', type=int, default=400)
+    parser.add_argument('--dicom_size', type=int, default=None)
+    parser.add_argument('--positive_study_ratio', type=float, default=0.5)
+    parser.add_argument('--positive_ratio', type=float, default=0.3)
+    parser.add_argument('--class_probs', type=float, nargs=5, default=None)
+    parser.add_argument('--segmented_ratio', type=float, default=0.2)
+    parser.add_argument('--tilted_ratio', type=float, default=0.2)
+    parser.add_argument('--layouts', type=str, nargs='+', default=['3d', 'masks'], choices=LAYOUTS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(generate_dataset(args.out_dir, args.num_studies, num_slices=args.num_slices, img_size=args.img_size,
+                           positive_ratio=args.positive_ratio, segmented_ratio=args.segmented_ratio,
+                           seed=args.seed, num_test_studies=args.num_test_studies, dicom_size=args.dicom_size,
+                           positive_study_ratio=args.positive_study_ratio, class_probs=args.class_probs,
+                           tilted_ratio=args.tilted_ratio, layouts=args.layouts))
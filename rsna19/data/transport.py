@@ -0,0 +1,147 @@
+""" Compact transport of images from DataLoader workers to the training process.
+
+Workers emit images in a small dtype and the conversion to float32 model input is done for a whole batch in the
+main process, preferably on the training device:
+ * 'float16' - final values in half precision
+ * 'uint8' - final values quantized to 256 levels of a known value range
+ * 'int16' - raw HU values, values conversion (cdf or HU window lookup table, scaling, windows) is done by decoder,
+   only possible when workers don't apply transforms changing or interpolating values
+ * 'float32' or None - no compression
+"""
+import numpy as np
+import torch
+
+TRANSPORT_DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'uint8': torch.uint8,
+    'int16': torch.int16
+}
+
+
+def check_transport_dtype(transport_dtype):
+    if transport_dtype is not None and transport_dtype not in TRANSPORT_DTYPES:
+        raise ValueError(f'Unknown transport dtype {transport_dtype}, expected one of {list(TRANSPORT_DTYPES)}')
+
+
+def hu_identity_lut():
+    """Lookup table for fused_preprocessing.load_window_fused returning int16 HU values unchanged"""
+    return np.arange(np.iinfo(np.int16).min, np.iinfo(np.int16).max + 1).astype(np.int16), int(np.iinfo(np.int16).min)
+
+
+def encode_image(img, transport_dtype, value_range=(-1.0, 1.0)):
+    """Convert image tensor of a worker to transport dtype
+
+    :param img: float image tensor, or HU values tensor for 'int16'
+    :param value_range: range of image values, used for 'uint8' quantization
+    """
+    if transport_dtype is None:
+        return img
+
+    dtype = TRANSPORT_DTYPES[transport_dtype]
+    if img.dtype == dtype:
+        return img
+
+    if transport_dtype == 'uint8':
+        low, high = value_range
+        img = ((img - low) * (255.0 / (high - low))).round_().clamp_(0, 255)
+    # int16 casting truncates like HuConverter's conversion to int32
+    return img.to(dtype)
+
+
+class BatchDecoder:
+    """Converts collated batch of transport dtype images to float32 model input"""
+
+    def __init__(self, value_range=(-1.0, 1.0), scale_values=1.0, value_lut=None, lut_min_hu=0, windows=None,
+                 device=None):
+        """
+        :param value_range: range of 'uint8' quantized values
+        :param scale_values: 'int16' HU values are multiplied by scale_values before value_lut and windows
+        :param value_lut: optional lookup table for 'int16' values, value of hu is lut[clip(hu - lut_min_hu)]
+        :param windows: optional list of (min, max) windows of 'int16' values, applied after value_lut,
+                        each window is mapped to 0-1 range and output channels of windows are concatenated
+        :param device: device to move batches to before decoding, None keeps batch device
+        """
+        self.value_range = value_range
+        self.scale_values = scale_values
+        self.value_lut = None if value_lut is None else torch.as_tensor(value_lut, dtype=torch.float32)
+        self.lut_min_hu = lut_min_hu
+        self.windows = windows
+        self.device = device
+
+    def __call__(self, images):
+        if self.device is not None:
+            images = images.to(self.device, non_blocking=True)
+        return self.decode(images)
+
+    def decode(self, images):
+        """Decode batch on its current device, float32 batches are returned unchanged"""
+        if images.dtype == torch.uint8:
+            low, high = self.value_range
+            return images.float() * ((high - low) / 255.0) + low
+
+        if images.dtype != torch.int16:
+            return images.float()
+
+        values = images.float()
+        if self.scale_values != 1.0:
+            values = values * self.scale_values
+
+        if self.value_lut is not None:
+            if self.value_lut.device != values.device:
+                self.value_lut = self.value_lut.to(values.device)
+            indices = (values.long() - self.lut_min_hu).clamp_(0, len(self.value_lut) - 1)
+            values = self.value_lut[indices]
+
+        if self.windows is not None:
+            values = torch.cat([torch.clamp((values - w_min) / (w_max - w_min), 0.0, 1.0)
+                                for w_min, w_max in self.windows], dim=1)
+
+        return values
+
+
+def check_transport(num_samples=500, num_workers=4, batch_size=32):
+    """Check decoding errors and benchmark DataLoader throughput of each transport dtype, in samples/s"""
+    import time
+    from torch.utils.data import DataLoader, Dataset
+
+    from rsna19.data.fused_preprocessing import build_value_lut
+
+    lut, lut_min_hu = build_value_lut(use_cdf=True)
+    hu = torch.randint(-1200, 1500, (4, 9, 64, 64), dtype=torch.int16)
+    expected = torch.from_numpy(lut)[(hu.long() - lut_min_hu).clamp(0, len(lut) - 1)]
+
+    decoder = BatchDecoder(value_lut=lut, lut_min_hu=lut_min_hu)
+    assert torch.equal(decoder(encode_image(hu, 'int16')), expected)
+    for transport_dtype, max_error in [('float16', 1e-3), ('uint8', 1.0 / 255 + 1e-6)]:
+        error = (decoder(encode_image(expected, transport_dtype)) - expected).abs().max()
+        assert error <= max_error, (transport_dtype, error)
+        print(f'{transport_dtype} max error {error:.5f}')
+
+    class RandomWindows(Dataset):
+        def __init__(self, transport_dtype):
+            self.transport_dtype = transport_dtype
+            # like dataset_2dc, float64 images by default
+            if transport_dtype == 'int16':
+                self.img = torch.randint(-1000, 1000, (9, 384, 384), dtype=torch.int16)
+            else:
+                self.img = torch.rand(9, 384, 384, dtype=torch.float64) * 2 - 1
+
+        def __len__(self):
+            return num_samples
+
+        def __getitem__(self, idx):
+            return {'image': encode_image(self.img.clone(), self.transport_dtype)}
+
+    for transport_dtype in [None, 'float32', 'float16', 'uint8', 'int16']:
+        data_loader = DataLoader(RandomWindows(transport_dtype), batch_size=batch_size, num_workers=num_workers)
+        start = time.time()
+        for batch in data_loader:
+            decoder(batch['image'])
+        samples_per_second = num_samples / (time.time() - start)
+        print(f'{str(transport_dtype):8s}: {batch["image"][0].numel() * batch["image"].element_size() / 2**20:.1f} '
+              f'MB/sample, {samples_per_second:.0f} samples/s')
+
+
+if __name__ == '__main__':
+    check_transport()
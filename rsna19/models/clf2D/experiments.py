@@ -20,8 +20,10 @@ class ModelInfo:
                  clip_grad=1.0,
                  single_slice_steps=0,
                  freeze_bn_step=-1,
-                 use_vflip=True
+                 use_vflip=True,
+                 batch_augment=False
                  ):
+        self.batch_augment = batch_augment
         self.use_vflip = use_vflip
         self.freeze_bn_step = freeze_bn_step
         self.single_slice_steps = single_slice_steps
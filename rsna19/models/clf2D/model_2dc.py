@@ -38,12 +38,8 @@ class ClassificationModelResnetCombineLast(nn.Module):
         for param in self.base_model.parameters():
             param.requires_grad = True
 
-    def forward(self, inputs, output_per_pixel=False):
-        res = []
-        batch_size = inputs.shape[0]
-        nb_input_slices = self.nb_input_slices
-
-        x = inputs.view(batch_size*nb_input_slices, 1, inputs.shape[2], inputs.shape[3])
+    def encode(self, x):
+        """Trunk features of single slices, Nx1xHxW -> NxCxhxw, see study_inference"""
         x = self.l1(x)
         x = self.bn1(x)
         # TODO: batch norm here may still help when cdf used
@@ -54,9 +50,21 @@ class ClassificationModelResnetCombineLast(nn.Module):
         x = self.base_model.layer2(x)
         x = self.base_model.layer3(x)
         x = self.base_model.layer4(x)
+        return x
+
+    def forward(self, inputs, output_per_pixel=False):
+        batch_size = inputs.shape[0]
+        nb_input_slices = self.nb_input_slices
 
+        x = inputs.view(batch_size*nb_input_slices, 1, inputs.shape[2], inputs.shape[3])
+        x = self.encode(x)
+        return self.combine(x, batch_size, nb_input_slices, output_per_pixel=output_per_pixel)
+
+    def combine(self, x, batch_size, nb_input_slices, output_per_pixel=False):
+        """Output of windows from trunk features of their slices, (B*S)xCxhxw"""
+        res = []
         base_model_features = x.shape[1]
-        x = x.view(batch_size, base_model_features*nb_input_slices, x.shape[2], x.shape[3])
+        x = x.reshape(batch_size, base_model_features*nb_input_slices, x.shape[2], x.shape[3])
         x = self.combine_conv(x)
 
         # TODO: seems to work worse with relu here, need more testing
@@ -149,8 +157,21 @@ class ClassificationModelResnetCombineLastVariable(nn.Module):
         self.l1.requires_grad = True
         self.bn1.requires_grad = True
 
+    def encode(self, x):
+        """Trunk features of single slices, Nx1xHxW -> NxCxhxw, see study_inference"""
+        x = self.l1(x)
+        x = self.bn1(x)
+        # TODO: batch norm here may still help when cdf used
+        x = torch.relu(x)
+        x = self.maxpool(x)
+
+        x = self.base_model.layer1(x)
+        x = self.base_model.layer2(x)
+        x = self.base_model.layer3(x)
+        x = self.base_model.layer4(x)
+        return x
+
     def forward(self, inputs, output_per_pixel=False, output_before_combine_slices=False, train_last_layers_only=False):
-        res = []
         batch_size = inputs.shape[0]
         nb_input_slices = inputs.shape[1]
 
@@ -158,16 +179,7 @@ class ClassificationModelResnetCombineLastVariable(nn.Module):
 
         if not train_last_layers_only:
             x = x.view(batch_size*nb_input_slices, 1, inputs.shape[2], inputs.shape[3])
-            x = self.l1(x)
-            x = self.bn1(x)
-            # TODO: batch norm here may still help when cdf used
-            x = torch.relu(x)
-            x = self.maxpool(x)
-
-            x = self.base_model.layer1(x)
-            x = self.base_model.layer2(x)
-            x = self.base_model.layer3(x)
-            x = self.base_model.layer4(x)
+            x = self.encode(x)
 
             base_model_features = x.shape[1]
             x = x.view(batch_size, nb_input_slices, base_model_features, x.shape[2], x.shape[3])  # BxSxCxHxW
@@ -175,6 +187,12 @@ class ClassificationModelResnetCombineLastVariable(nn.Module):
         if output_before_combine_slices:
             return x
 
+        return self.combine(x, batch_size, nb_input_slices, output_per_pixel=output_per_pixel)
+
+    def combine(self, x, batch_size, nb_input_slices, output_per_pixel=False):
+        """Output of windows from trunk features of their slices, (B*S)xCxhxw or BxSxCxhxw"""
+        res = []
+        x = x.view(batch_size, nb_input_slices, x.shape[-3], x.shape[-2], x.shape[-1])  # BxSxCxHxW
         x = x.permute((0, 2, 1, 3, 4))  # BxCxSxHxW
         # x = self.combine_conv(x)  # BxCx1xHxW
         slice_offset = (self.nb_input_slices - nb_input_slices) // 2
@@ -503,12 +503,8 @@ class ResnetWeightedSegmentatation(nn.Module):
         x = x.view(batch_size, x.shape[1], x.shape[3], x.shape[4])
         return x
 
-    def forward(self, inputs):
-        batch_size = inputs.shape[0]
-        nb_input_slices = inputs.shape[1]
-
-        x = inputs
-        x = x.view(batch_size*nb_input_slices, 1, inputs.shape[2], inputs.shape[3])
+    def encode(self, x):
+        """Trunk features of single slices at the combined levels, Nx1xHxW -> (x2, x3, x4), see study_inference"""
         x = self.l1(x)
         x = self.bn1(x)
         x = torch.relu(x)
@@ -518,7 +514,19 @@ class ResnetWeightedSegmentatation(nn.Module):
         x2 = self.base_model.layer2(x1)
         x3 = self.base_model.layer3(x2)
         x4 = self.base_model.layer4(x3)
+        return x2, x3, x4
+
+    def forward(self, inputs):
+        batch_size = inputs.shape[0]
+        nb_input_slices = inputs.shape[1]
+
+        x = inputs
+        x = x.view(batch_size*nb_input_slices, 1, inputs.shape[2], inputs.shape[3])
+        return self.combine(self.encode(x), batch_size, nb_input_slices)
 
+    def combine(self, features, batch_size, nb_input_slices):
+        """Classification and segmentation of windows from encode() features of their slices, (B*S)xCxhxw"""
+        x2, x3, x4 = features
         x2_combined = self.combine_slices(x2, self.combine_conv2, batch_size=batch_size,
                                           nb_input_slices=nb_input_slices)
         x3_combined = self.combine_slices(x3, self.combine_conv3, batch_size=batch_size,
@@ -13,7 +13,10 @@ from tqdm import tqdm
 from rsna19.configs.base_config import BaseConfig
 from rsna19.data import dataset
 from rsna19.models.clf2D.experiments import MODELS
+from rsna19.models.clf2D.study_inference import StudyFeatureEngine
 from rsna19.models.clf2D.train import build_model_str
+from rsna19.models.commons import worker_init
+from rsna19.models.commons.inference_runner import InferenceRunner, add_runner_args, runner_args
 
 
 # import ttach as tta
@@ -45,7 +48,14 @@ class Rotate90(albumentations.DualTransform):
         return albumentations.augmentations.functional.keypoint_rot90(keypoint, 1, **params)
 
 
-def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=None):
+def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=None, worker_args=None,
+            study_features=False, inference_args=None):
+    """
+    :param worker_args: kwargs of worker_init.loader_args, 8 workers by default
+    :param inference_args: kwargs of InferenceRunner (device, threads, ...), GPU if available by default
+    :param study_features: encode each slice once for all windows containing it, for combine-last models,
+                           see study_inference
+    """
     model_str = build_model_str(model_name, fold, run)
     model_info = MODELS[model_name]
 
@@ -72,21 +82,21 @@ def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=No
         **{**model_info.dataset_args, "add_segmentation_masks": False, "segmentation_oversample": 1}
     )
 
-    model.eval()
+    runner = InferenceRunner(**(inference_args or {}))
     print(f'load {checkpoints_dir}/{epoch:03}.pt')
-
-    if torch.cuda.is_available():
-        checkpoint = torch.load(f'{checkpoints_dir}/{epoch:03}.pt')
-        model.load_state_dict(checkpoint['model_state_dict'])
-        model = model.cuda()
-    else:
-        checkpoint = torch.load(f'{checkpoints_dir}/{epoch:03}.pt', map_location=lambda storage, loc: storage)
-        model.load_state_dict(checkpoint['model_state_dict'])
+    checkpoint = runner.load_checkpoint(f'{checkpoints_dir}/{epoch:03}.pt')
+    model.load_state_dict(checkpoint['model_state_dict'])
+    model = runner.prepare(model)
 
     data_loader = DataLoader(dataset_valid,
                              shuffle=False,
-                             num_workers=8,
-                             batch_size=model_info.batch_size * 2)
+                             batch_size=model_info.batch_size * 2,
+                             **worker_init.loader_args(dataset=dataset_valid, batch_size=model_info.batch_size * 2,
+                                                       **(worker_args or {'num_workers': 8})))
+    transport_decoder = dataset_valid.transport_decoder()
+
+    # samples are predicted in csv order, so windows of a study come in consecutive batches
+    engine = StudyFeatureEngine(model) if study_features else None
 
     all_paths = []
     all_study_id = []
@@ -94,10 +104,14 @@ def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=No
     all_gt = []
     all_pred = []
 
-    data_iter = tqdm(enumerate(data_loader), total=len(data_loader))
+    data_iter = tqdm(enumerate(runner.batches(data_loader, decode=transport_decoder.decode)), total=len(data_loader))
     for iter_num, batch in data_iter:
-        with torch.set_grad_enabled(False):
-            y_hat = torch.sigmoid(model(batch['image'].float().cuda()))
+        with runner.inference():
+            images = batch['image']
+            if engine is not None:
+                y_hat = torch.sigmoid(engine(images, batch['study_id'], batch['slice_num']))
+            else:
+                y_hat = torch.sigmoid(model(images))
             all_pred.append(y_hat.cpu().numpy())
             all_paths.extend(batch['path'])
             all_study_id.extend(batch['study_id'])
@@ -107,6 +121,10 @@ def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=No
                 y = batch['labels']
                 all_gt.append(y.numpy())
 
+    if engine is not None:
+        print(f'study features: {engine.stats()}')
+    runner.report(model_name)
+
     pred_columns = ['pred_epidural', 'pred_intraparenchymal', 'pred_intraventricular', 'pred_subarachnoid',
                     'pred_subdural', 'pred_any']
     gt_columns = ['gt_epidural', 'gt_intraparenchymal', 'gt_intraventricular', 'gt_subarachnoid', 'gt_subdural',
@@ -125,7 +143,8 @@ def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=No
     df.to_csv(df_out_path, index=False)
 
 
-def predict_test(model_name, fold, epoch, mode='normal', run=None):
+def predict_test(model_name, fold, epoch, mode='normal', run=None, worker_args=None, study_features=False,
+                 inference_args=None):
     run_str = '' if not run else f'_{run}'
     prediction_dir = f'{BaseConfig.prediction_dir}/{model_name}{run_str}/fold{fold}/predictions/'
     os.makedirs(prediction_dir, exist_ok=True)
@@ -135,10 +154,11 @@ def predict_test(model_name, fold, epoch, mode='normal', run=None):
         print('Skip existing', df_out_path)
     else:
         predict(model_name=model_name, fold=fold, epoch=epoch, is_test=True, df_out_path=df_out_path, mode=mode,
-                run=run)
+                run=run, worker_args=worker_args, study_features=study_features, inference_args=inference_args)
 
 
-def predict_oof(model_name, fold, epoch, mode='normal', run=None):
+def predict_oof(model_name, fold, epoch, mode='normal', run=None, worker_args=None, study_features=False,
+                inference_args=None):
     run_str = '' if not run else f'_{run}'
     prediction_dir = f'{BaseConfig.prediction_dir}/{model_name}{run_str}/fold{fold}/predictions/'
     os.makedirs(prediction_dir, exist_ok=True)
@@ -148,7 +168,7 @@ def predict_oof(model_name, fold, epoch, mode='normal', run=None):
         print('Skip existing', df_out_path)
     else:
         predict(model_name=model_name, fold=fold, epoch=epoch, is_test=False, df_out_path=df_out_path, mode=mode,
-                run=run)
+                run=run, worker_args=worker_args, study_features=study_features, inference_args=inference_args)
 
 
 if __name__ == '__main__':
@@ -160,9 +180,15 @@ if __name__ == '__main__':
     parser.add_argument('--weights', type=str, default='')
     parser.add_argument('--epoch', type=int, nargs='+')
     parser.add_argument('--mode', type=str, default=['normal'], nargs='+')
+    parser.add_argument('--study_features', action='store_true',
+                        help='encode each slice once per study, for combine-last models')
+    worker_init.add_worker_args(parser, default_num_workers=8)
+    add_runner_args(parser)
 
     args = parser.parse_args()
     action = args.action
+    worker_args = dict(num_workers=args.num_workers, threads_per_worker=args.worker_threads,
+                       pin_cpus=args.pin_worker_cpus)
     modes = args.mode
     if modes == ['all']:
         modes = ['normal', 'h_flip', 'v_flip', 'rot90']
@@ -172,11 +198,15 @@ if __name__ == '__main__':
             for epoch in args.epoch:
                 for mode in modes:
                     print(f'fold {fold}, epoch {epoch}, {mode}')
-                    predict_test(model_name=args.model, run=args.run, fold=fold, epoch=epoch, mode=mode)
+                    predict_test(model_name=args.model, run=args.run, fold=fold, epoch=epoch, mode=mode,
+                                 worker_args=worker_args, study_features=args.study_features,
+                                 inference_args=runner_args(args))
 
     if action == 'predict_oof':
         for fold in args.fold:
             for epoch in args.epoch:
                 for mode in modes:
                     print(f'fold {fold}, epoch {epoch}, {mode}')
-                    predict_oof(model_name=args.model, run=args.run, fold=fold, epoch=epoch, mode=mode)
+                    predict_oof(model_name=args.model, run=args.run, fold=fold, epoch=epoch, mode=mode,
+                                worker_args=worker_args, study_features=args.study_features,
+                                inference_args=runner_args(args))
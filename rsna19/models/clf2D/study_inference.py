@@ -0,0 +1,145 @@
+""" Inference of combine-last models with trunk features shared between windows of a study.
+
+Combine-last models (model_2dc.ClassificationModelResnetCombineLast, ...CombineLastVariable and
+model_2dc_segmentation.ResnetWeightedSegmentatation) run the trunk on each slice of a window separately and combine
+slices only after it. Predicting all slices of a study, each slice is a part of num_slices windows, so its trunk
+features were computed num_slices times. StudyFeatureEngine runs model.encode() once per slice and passes the
+features of all windows of a batch to model.combine() at once.
+
+Features are keyed by (study id, slice number), the image of a slice has to be the same in every window containing
+it, i.e. preprocessing must be deterministic (flips of TTA modes are fine, random augmentations are not).
+Features of studies of the previous batch are kept, so that studies split between batches are encoded once too.
+"""
+import time
+
+import numpy as np
+import torch
+
+
+class StudyFeatureEngine:
+    def __init__(self, model, chunk_size=64):
+        """
+        :param model: model with encode() and combine() methods, in eval mode
+        :param chunk_size: max number of slices encoded at once
+        """
+        if not hasattr(model, 'encode') or not hasattr(model, 'combine'):
+            raise ValueError(f'{type(model).__name__} is not a combine-last model with encode() and combine()')
+        self.model = model
+        self.chunk_size = chunk_size
+        # (study id, slice number) -> tuple of features of the slice, one per combined level
+        self.features = {}
+        self.encoded_slices = 0
+        self.windows = 0
+
+    def encode_missing(self, images, keys):
+        """Encode slices of keys missing in cache, images are BxSxHxW windows, keys are per window slice"""
+        missing = {}
+        for position, key in enumerate(keys):
+            if key not in self.features and key not in missing:
+                missing[key] = position
+        if not missing:
+            return
+
+        slices = images.view(-1, 1, images.shape[2], images.shape[3])
+        positions = torch.tensor(list(missing.values()), dtype=torch.int64, device=images.device)
+        missing_keys = list(missing.keys())
+        for start in range(0, len(missing_keys), self.chunk_size):
+            encoded = self.model.encode(slices[positions[start:start + self.chunk_size]])
+            if isinstance(encoded, torch.Tensor):
+                encoded = (encoded,)
+            for num, key in enumerate(missing_keys[start:start + self.chunk_size]):
+                self.features[key] = tuple(level[num] for level in encoded)
+        self.encoded_slices += len(missing_keys)
+
+    def __call__(self, images, study_ids, slice_nums, **combine_args):
+        """Model output of a batch of windows, as returned by model(images)
+
+        :param images: BxSxHxW windows centered on slice_nums
+        :param study_ids: study id of each window
+        :param slice_nums: number of the center slice of each window
+        """
+        batch_size, nb_input_slices = images.shape[:2]
+        offsets = np.arange(nb_input_slices) - nb_input_slices // 2
+        keys = [(study_id, int(slice_num) + offset) for study_id, slice_num in zip(study_ids, slice_nums)
+                for offset in offsets]
+
+        self.encode_missing(images, keys)
+        num_levels = len(self.features[keys[0]])
+        features = [torch.stack([self.features[key][level] for key in keys]) for level in range(num_levels)]
+        self.windows += batch_size
+
+        # features of slices of studies not in this batch won't be needed again
+        studies = set(study_ids)
+        self.features = {key: value for key, value in self.features.items() if key[0] in studies}
+
+        return self.model.combine(features[0] if num_levels == 1 else features, batch_size, nb_input_slices,
+                                  **combine_args)
+
+    def clear(self):
+        self.features = {}
+
+    def stats(self):
+        """Trunk runs per window, the model encodes nb_input_slices slices per window"""
+        return {
+            'windows': self.windows,
+            'encoded_slices': self.encoded_slices,
+            'slices_per_window': self.encoded_slices / max(self.windows, 1)
+        }
+
+
+def check_study_inference(num_slices=(20, 30), batch_size=16, img_size=128, num_studies=3):
+    """Compare outputs and time of per window and study feature inference on random studies"""
+    import pretrainedmodels
+
+    from rsna19.models.clf2D import model_2dc, model_2dc_segmentation
+
+    torch.manual_seed(0)
+    random_state = np.random.RandomState(0)
+    studies = [torch.randn(random_state.randint(*num_slices), img_size, img_size) for _ in range(num_studies)]
+
+    windows, study_ids, slice_nums = [], [], []
+    for study_num, study in enumerate(studies):
+        # missing slices at the ends of a study are air, like in data.dataset
+        air = torch.full((2, img_size, img_size), -1.0)
+        padded = torch.cat([air, study, air])
+        for slice_num in range(len(study)):
+            windows.append(padded[slice_num:slice_num + 5])
+            study_ids.append(f'ID_{study_num}')
+            slice_nums.append(slice_num)
+    windows = torch.stack(windows)
+
+    models = {
+        'combine_last': model_2dc.ClassificationModelResnetCombineLast(
+            pretrainedmodels.resnet34(pretrained=None), base_model_features=512, base_model_l1_outputs=64,
+            nb_features=6),
+        'combine_last_var': model_2dc.ClassificationModelResnetCombineLastVariable(
+            pretrainedmodels.resnet34(pretrained=None), base_model_features=512, base_model_l1_outputs=64,
+            nb_features=6),
+        'weighted_segmentation': model_2dc_segmentation.ResnetWeightedSegmentatation(
+            pretrainedmodels.resnet18(pretrained=None), DecoderBlock=model_2dc_segmentation.DecoderBlockBN,
+            base_model_l1_outputs=64, nb_features=6, filters=8)
+    }
+    for name, model in models.items():
+        model.eval()
+        engine = StudyFeatureEngine(model)
+        with torch.no_grad():
+            start = time.time()
+            expected = [model(windows[i:i + batch_size]) for i in range(0, len(windows), batch_size)]
+            window_seconds = time.time() - start
+
+            start = time.time()
+            outputs = [engine(windows[i:i + batch_size], study_ids[i:i + batch_size], slice_nums[i:i + batch_size])
+                       for i in range(0, len(windows), batch_size)]
+            engine_seconds = time.time() - start
+
+        max_diff = max((output - expected_output).abs().max().item()
+                       for batch_outputs, batch_expected in zip(outputs, expected)
+                       for output, expected_output in zip(*[[o] if isinstance(o, torch.Tensor) else o
+                                                            for o in (batch_outputs, batch_expected)]))
+        assert max_diff < 1e-4, max_diff
+        print(f'{name}: max abs difference {max_diff:.2e}, {engine.stats()}, '
+              f'per window {window_seconds:.1f} s, study features {engine_seconds:.1f} s')
+
+
+if __name__ == '__main__':
+    check_study_inference()
@@ -1,6 +1,7 @@
 import argparse
 import collections
 import os
+from glob import glob
 
 import numpy as np
 import torch
@@ -20,8 +21,12 @@ from apex import amp
 import torch.nn as nn
 import torch.nn.functional as F
 from rsna19.configs.base_config import BaseConfig
+from rsna19.data.batch_augment import BatchAugmentation
 from rsna19.models.commons import radam
 from rsna19.models.commons import metrics
+from rsna19.models.commons import worker_init
+from rsna19.models.commons.hard_example_sampler import HardExampleSampler, dataset_path_index
+from rsna19.models.commons.resumable_sampler import ResumableRandomSampler, rng_state, save_checkpoint, set_rng_state
 from rsna19.models.clf2D.experiments import MODELS
 from torch.utils.tensorboard import SummaryWriter
 
@@ -53,7 +58,17 @@ def log_metrics(logger, phase, epoch_num, y_hat, y):
         logger.add_scalar(f'{phase}_bce_{class_name}', sklearn.metrics.log_loss(y[:, i], y_hat[:, i]), epoch_num)
 
 
-def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
+def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False, num_workers=8, worker_threads=None,
+          pin_worker_cpus=False, hard_example_fraction=None, hard_example_oof=None, checkpoint_interval=None,
+          resume_last=False):
+    """
+    :param checkpoint_interval: if set, model, optimizer, sampler and RNG states are saved to last.pt every
+                                checkpoint_interval training batches
+    :param resume_last: resume from last.pt at the next batch after the checkpoint
+    :param hard_example_fraction: if set, train epochs draw this fraction of the training set with
+                                  HardExampleSampler, proportionally to per sample losses
+    :param hard_example_oof: glob of OOF files of previous runs used to initialize losses of HardExampleSampler
+    """
     model_str = build_model_str(model_name, fold, run)
 
     model_info = MODELS[model_name]
@@ -97,6 +112,17 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
             albumentations.HorizontalFlip()
         ]
 
+    if model_info.batch_augment:
+        # the same augmentations applied to whole batches on the training device
+        augmentations = []
+        batch_augmentation = BatchAugmentation(shift_limit=16. / 256, scale_limit=0.05, rotate_limit=30, p=0.80,
+                                               hflip=0.5,
+                                               vflip=0.5 if model_info.use_vflip else 0.0,
+                                               rotate90=model_info.use_vflip,
+                                               border_mode='border')
+    else:
+        batch_augmentation = None
+
     dataset_train = dataset.IntracranialDataset(
         csv_file='5fold-test-rev3.csv',
         folds=[f for f in range(BaseConfig.nb_folds) if f != fold],
@@ -111,15 +137,33 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
         **model_info.dataset_args
     )
 
+    # all datasets share dataset_args, so images of every loader are decoded the same way
+    transport_decoder = dataset_train.transport_decoder(device='cuda')
+
+    # calibrated once on the training set when num_workers is 'auto', used by all loaders
+    worker_args = worker_init.loader_args(num_workers, dataset_train, model_info.batch_size,
+                                          threads_per_worker=worker_threads, pin_cpus=pin_worker_cpus)
+
+    if hard_example_fraction is not None:
+        hard_example_sampler = HardExampleSampler(len(dataset_train),
+                                                  num_draws=int(len(dataset_train) * hard_example_fraction))
+        if hard_example_oof:
+            num_found = hard_example_sampler.update_from_oof(sorted(glob(hard_example_oof)),
+                                                             dataset_path_index(dataset_train))
+            print(f'hard example losses of {num_found} samples loaded from {hard_example_oof}')
+    else:
+        hard_example_sampler = None
+
+    # training samplers can be resumed in the middle of an epoch
     data_loaders = {
         'train': DataLoader(dataset_train,
-                            num_workers=8,
-                            shuffle=True,
-                            batch_size=model_info.batch_size),
+                            sampler=hard_example_sampler or ResumableRandomSampler(len(dataset_train)),
+                            batch_size=model_info.batch_size,
+                            **worker_args),
         'val':   DataLoader(dataset_valid,
                             shuffle=False,
-                            num_workers=8,
-                            batch_size=model_info.batch_size)
+                            batch_size=model_info.batch_size,
+                            **worker_args)
     }
 
     if model_info.single_slice_steps > 0:
@@ -139,6 +183,9 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
                 albumentations.HorizontalFlip()
             ]
 
+        if model_info.batch_augment:
+            augmentations = []
+
         dataset_train_1_slice = dataset.IntracranialDataset(
             csv_file='5fold-test-rev3.csv',
             folds=[f for f in range(BaseConfig.nb_folds) if f != fold],
@@ -155,14 +202,14 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
 
         data_loaders['train_1_slice'] = DataLoader(
             dataset_train_1_slice,
-            num_workers=8,
-            shuffle=True,
-            batch_size=model_info.batch_size*2)
+            sampler=ResumableRandomSampler(len(dataset_train_1_slice)),
+            batch_size=model_info.batch_size*2,
+            **worker_args)
         data_loaders['val_1_slice'] = DataLoader(
             dataset_valid_1_slice,
             shuffle=False,
-            num_workers=8,
-            batch_size=model_info.batch_size*2)
+            batch_size=model_info.batch_size*2,
+            **worker_args)
 
     model.train()
 
@@ -172,7 +219,7 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
         return F.binary_cross_entropy_with_logits(y_pred, y_true, class_weights.repeat(y_pred.shape[0], 1))
 
     # fit the new layers first:
-    if resume_epoch == -1 and model_info.is_pretrained:
+    if resume_epoch == -1 and not resume_last and model_info.is_pretrained:
         model.train()
         model.freeze_encoder()
         data_loader = data_loaders.get('train_1_slice', data_loaders['train'])
@@ -185,7 +232,9 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
             if iter_num > pre_fit_steps:
                 break
             with torch.set_grad_enabled(True):
-                img = data['image'].float().cuda()
+                img = transport_decoder(data['image'])
+                if batch_augmentation is not None:
+                    img = batch_augmentation(img)
                 labels = data['labels'].cuda()
                 pred = model(img)
                 loss = criterium(pred, labels)
@@ -217,7 +266,35 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
         if 'amp' in checkpoint:
             amp.load_state_dict(checkpoint['amp'])
 
-    for epoch_num in range(resume_epoch+1, 7):
+    start_epoch = resume_epoch + 1
+    resume_state = None
+    if resume_last:
+        resume_state = torch.load(f'{checkpoints_dir}/last.pt')
+        print('load', f'{checkpoints_dir}/last.pt', 'epoch', resume_state['epoch'])
+        model.load_state_dict(resume_state['model_state_dict'])
+        optimizer.load_state_dict(resume_state['optimizer_state_dict'])
+        if use_apex:
+            amp.load_state_dict(resume_state['amp'])
+        start_epoch = resume_state['epoch']
+        if start_epoch > 0:
+            # the saved optimizer may hold the lr of the previous epoch, last.pt is written before the scheduler
+            # step of validation, so the lr of start_epoch is set the same way an uninterrupted run does
+            scheduler.step(epoch=start_epoch - 1)
+
+    def save_last(epoch_num, sampler_state):
+        save_checkpoint(
+            {
+                'epoch': epoch_num,
+                'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'amp': amp.state_dict(),
+                'sampler': sampler_state,
+                'rng': rng_state()
+            },
+            f'{checkpoints_dir}/last.pt'
+        )
+
+    for epoch_num in range(start_epoch, 7):
         for phase in ['train', 'val']:
             model.train(phase == 'train')
             epoch_loss = []
@@ -235,6 +312,15 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
                 data_loader = data_loaders[phase]
                 print("use N slices input")
 
+            if phase == 'train':
+                if resume_state is not None and resume_state['sampler'] is not None:
+                    data_loader.sampler.load_state_dict(resume_state['sampler'])
+                    set_rng_state(resume_state['rng'])
+                    print(f'resume epoch {epoch_num} at sample {data_loader.sampler.start}')
+                else:
+                    data_loader.sampler.set_epoch(epoch_num)
+                resume_state = None
+
             # if epoch_num == model_info.single_slice_steps:
             #     print("train only conv slices/fn layers")
             #     model.module.freeze_encoder_full()
@@ -249,7 +335,9 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
 
             data_iter = tqdm(enumerate(data_loader), total=len(data_loader), ncols=200)
             for iter_num, data in data_iter:
-                img = data['image'].float().cuda()
+                img = transport_decoder(data['image'])
+                if batch_augmentation is not None and phase == 'train':
+                    img = batch_augmentation(img)
                 labels = data['labels'].float().cuda()
 
                 with torch.set_grad_enabled(phase == 'train'):
@@ -262,6 +350,12 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
                     pred = model(img)
                     loss = criterium(pred, labels)
 
+                    if phase == 'train' and data_loader.sampler is hard_example_sampler:
+                        with torch.no_grad():
+                            losses = F.binary_cross_entropy_with_logits(
+                                pred, labels, class_weights.repeat(pred.shape[0], 1), reduction='none').mean(dim=1)
+                        hard_example_sampler.update(data['idx'].numpy(), losses.cpu().numpy())
+
                     if phase == 'train':
                         if use_apex:
                             with amp.scale_loss(loss / model_info.accumulation_steps, optimizer) as scaled_loss:
@@ -275,6 +369,10 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
                             optimizer.step()
                             optimizer.zero_grad()
 
+                            if checkpoint_interval and (iter_num + 1) % checkpoint_interval == 0:
+                                save_last(epoch_num, data_loader.sampler.state_dict(
+                                    num_consumed=(iter_num + 1) * data_loader.batch_size))
+
                     epoch_loss.append(float(loss))
 
                     epoch_labels.append(labels.detach().cpu().numpy())
@@ -284,7 +382,17 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
                 data_iter.set_description(
                     f'{epoch_num} Loss: Running {np.mean(epoch_loss[-1000:]):1.4f} Avg {np.mean(epoch_loss):1.4f}')
 
+            slice_cache = getattr(data_loader.dataset, 'slice_cache', None)
+            if slice_cache is not None:
+                print(f'{phase} slice cache: {slice_cache.stats()}')
+
             logger.add_scalar(f'loss_{phase}', np.mean(epoch_loss), epoch_num)
+            if phase == 'train' and data_loader.sampler is hard_example_sampler:
+                # visits of the whole training set so far, to compare val loss with uniform sampling epochs
+                hard_example_stats = hard_example_sampler.stats()
+                print(f'hard example sampler: {hard_example_stats}')
+                logger.add_scalar('effective_epochs', hard_example_stats['effective_epochs'], epoch_num)
+                logger.add_scalar('hard_example_coverage', hard_example_stats['coverage'], epoch_num)
             logger.add_scalar('lr', optimizer.param_groups[0]['lr'], epoch_num)  # scheduler.get_lr()[0]
             try:
                 epoch_labels = np.row_stack(epoch_labels)
@@ -317,6 +425,9 @@ def train(model_name, fold, run=None, resume_epoch=-1, use_apex=False):
                     },
                     f'{checkpoints_dir}/{epoch_num:03}.pt'
                 )
+                if checkpoint_interval:
+                    # the next resume starts at the next epoch, validation of this epoch is skipped then
+                    save_last(epoch_num + 1, None)
 
 
 def check_heatmap(model_name, fold, epoch, run=None):
@@ -498,13 +609,25 @@ if __name__ == '__main__':
 
     parser.add_argument('--resume_weights', type=str, default='')
     parser.add_argument('--resume_epoch', type=int, default=-1)
+    parser.add_argument('--checkpoint_interval', type=int, default=None,
+                        help='save model, optimizer, sampler and RNG states to last.pt every N training batches')
+    parser.add_argument('--resume_last', action='store_true', help='resume from last.pt at the next batch')
+    parser.add_argument('--hard_example_fraction', type=float, default=None,
+                        help='fraction of training set drawn per epoch proportionally to per sample losses')
+    parser.add_argument('--hard_example_oof', type=str, default=None,
+                        help='glob of OOF files of previous runs to initialize per sample losses')
+    worker_init.add_worker_args(parser, default_num_workers=8)
 
     args = parser.parse_args()
     action = args.action
 
     if action == 'train':
         try:
-            train(model_name=args.model, run=args.run, fold=args.fold, resume_epoch=args.resume_epoch, use_apex=args.apex)
+            train(model_name=args.model, run=args.run, fold=args.fold, resume_epoch=args.resume_epoch, use_apex=args.apex,
+                  num_workers=args.num_workers, worker_threads=args.worker_threads,
+                  pin_worker_cpus=args.pin_worker_cpus, hard_example_fraction=args.hard_example_fraction,
+                  hard_example_oof=args.hard_example_oof, checkpoint_interval=args.checkpoint_interval,
+                  resume_last=args.resume_last)
         except KeyboardInterrupt:
             pass
 
@@ -0,0 +1,153 @@
+""" Study level inference of multibranch Classifier2DC with each branch input encoded once.
+
+A multibranch model runs the backbone on num_branches groups of multibranch_input_channels slices of every sample,
+e.g. slices (s-4..s-2), (s-1..s+1), (s+2..s+4) of a 9 slice window of clf2Dc_resnet34_3x3. Neighbouring samples of
+a study share most of these groups, the same group of slices is a branch input of up to num_branches samples.
+BranchFeatureEngine keys branch inputs by (study id, slice numbers), runs the backbone once per unique group and
+gathers features of all branches of a batch for combine_branches() (attention, combine_conv and pooling).
+
+Inputs of the same slices must be equal in every sample, i.e. preprocessing must be deterministic: no random
+augmentations or TTA transforms, no roi_crop 'slice'. Channels of appended segmentation masks (append_masks) have
+no slice numbers, such models are not supported. Features of studies of the previous batch are kept, samples
+should come grouped by study, e.g. from StudyBlockSampler.
+"""
+import time
+
+import torch
+
+
+def dedup_supported(config, transforms=None):
+    """Check if branch inputs of config (and additional dataset transforms) are the same in all samples"""
+    return getattr(config, 'multibranch', False) and transforms is None and \
+        getattr(config, 'roi_crop', None) != 'slice' and not getattr(config, 'append_masks', False)
+
+
+class BranchFeatureEngine:
+    def __init__(self, model, chunk_size=64):
+        """
+        :param model: multibranch Classifier2DC in eval mode
+        :param chunk_size: max number of branch inputs passed to the backbone at once
+        """
+        if not model.config.multibranch:
+            raise ValueError('branch deduplication needs multibranch model')
+        if getattr(model.config, 'append_masks', False):
+            raise ValueError('branch deduplication keys inputs by slice numbers, mask channels have none')
+        self.model = model
+        self.chunk_size = chunk_size
+        self.branch_channels = model.branch_channels()
+        # (study id, slice numbers of the branch) -> backbone features
+        self.features = {}
+        self.encoded_branches = 0
+        self.samples = 0
+
+    def branch_keys(self, study_ids, slice_nums):
+        # channel 0 is the first slice of the window, the input may have more channels than slices
+        half = self.model.config.num_slices // 2
+        return [(study_id, tuple(int(slice_num) - half + channel for channel in channels))
+                for study_id, slice_num in zip(study_ids, slice_nums)
+                for channels in self.branch_channels]
+
+    def __call__(self, images, study_ids, slice_nums):
+        """Model output of a batch, as returned by model(images)
+
+        :param images: decoded batch, (N, num_slices, H, W)
+        :param study_ids: study id of each sample
+        :param slice_nums: slice number of each sample, the center slice of its window
+        """
+        batch_size = images.shape[0]
+        keys = self.branch_keys(study_ids, slice_nums)
+
+        missing = {}
+        for position, key in enumerate(keys):
+            if key not in self.features and key not in missing:
+                missing[key] = position
+        if missing:
+            num_branches = len(self.branch_channels)
+            missing_keys = list(missing.keys())
+            positions = list(missing.values())
+            for start in range(0, len(missing_keys), self.chunk_size):
+                inputs = torch.stack([images[position // num_branches, self.branch_channels[position % num_branches]]
+                                      for position in positions[start:start + self.chunk_size]])
+                encoded = self.model.encode_branches(inputs)
+                for num, key in enumerate(missing_keys[start:start + self.chunk_size]):
+                    self.features[key] = encoded[num]
+            self.encoded_branches += len(missing_keys)
+
+        features = torch.stack([self.features[key] for key in keys])
+        features = features.view(batch_size, len(self.branch_channels), *features.shape[1:])
+        self.samples += batch_size
+
+        # features of studies not in this batch won't be needed again
+        studies = set(study_ids)
+        self.features = {key: value for key, value in self.features.items() if key[0] in studies}
+
+        return self.model.combine_branches(features)
+
+    def clear(self):
+        self.features = {}
+
+    def stats(self):
+        """Backbone runs per sample, per sample inference runs num_branches of them"""
+        return {
+            'samples': self.samples,
+            'encoded_branches': self.encoded_branches,
+            'branches_per_sample': self.encoded_branches / max(self.samples, 1)
+        }
+
+
+def check_branch_inference(num_studies=3, batch_size=32, crop_size=128, device='cpu'):
+    """Compare outputs and time of per sample and deduplicated inference with settings of clf2Dc_resnet34_3x3 configs
+
+    Configs with multibranch_channel_indices None (9 slices, disjoint branches) and [0, 1, 2, 1, 2, 3, 2, 3, 4]
+    (5 slices, overlapping branches) are compared, on synthetic studies.
+    """
+    import tempfile
+
+    from torch.utils.data import DataLoader
+
+    from rsna19.configs.clf2Dc import Config
+    from rsna19.data import synthetic
+    from rsna19.data.dataset_2dc import IntracranialDataset
+    from rsna19.models.clf2Dc.classifier2dc import Classifier2DC
+    from rsna19.models.commons.study_block_sampler import StudyBlockSampler
+
+    variants = {
+        'clf2Dc_resnet34_3x3': dict(num_slices=9, multibranch_channel_indices=None),
+        'clf2Dc_resnet34_3x3_5_slices': dict(num_slices=5, multibranch_channel_indices=[0, 1, 2, 1, 2, 3, 2, 3, 4])
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_root, csv_root_dir = synthetic.generate_dataset(tmp_dir, num_studies, num_slices=(24, 32))
+        for name, overrides in variants.items():
+            overrides = dict(overrides, data_root=data_root, csv_root_dir=csv_root_dir, val_dataset_file='5fold.csv',
+                             backbone='resnet34', pretrained=None, multibranch=True, num_branches=3,
+                             multibranch_input_channels=3, pre_crop_size=crop_size, padded_size=None,
+                             crop_size=crop_size, gpus=[], freeze_backbone_iterations=0)
+            config = type(name, (Config,), overrides)
+            dataset = IntracranialDataset(config, list(range(config.nb_folds)), mode='val')
+            data_loader = DataLoader(dataset, batch_size=batch_size,
+                                     sampler=StudyBlockSampler(*dataset.study_slice_index(), shuffle=False))
+            batches = list(data_loader)
+
+            torch.manual_seed(0)
+            model = Classifier2DC(config).to(device)
+            model.eval()
+            engine = BranchFeatureEngine(model)
+            with torch.no_grad():
+                start = time.time()
+                expected = [model(batch['image'].to(device)) for batch in batches]
+                sample_seconds = time.time() - start
+
+                start = time.time()
+                outputs = [engine(batch['image'].to(device), batch['study_id'], batch['slice_num'])
+                           for batch in batches]
+                engine_seconds = time.time() - start
+
+            max_diff = max((output - expected_output).abs().max().item()
+                           for output, expected_output in zip(outputs, expected))
+            assert max_diff < 1e-4, max_diff
+            print(f'{name}: max abs difference {max_diff:.2e}, {engine.stats()}, per sample {sample_seconds:.1f} s, '
+                  f'deduplicated {engine_seconds:.1f} s, speedup {sample_seconds / engine_seconds:.2f}x')
+
+
+if __name__ == '__main__':
+    check_branch_inference()
@@ -6,14 +6,21 @@ import torch.nn as nn
 from sklearn.metrics import log_loss
 from torch.nn import functional as F
 from torch.optim.lr_scheduler import CosineAnnealingLR, LambdaLR
-from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
 import numpy as np
 
-from rsna19.data.dataset_2dc import IntracranialDataset
+from rsna19.data.batch_fetch import batch_fetch_loader
+from rsna19.data.batch_ring import BatchRingLoader
+from rsna19.data.dataset_2dc import IntracranialDataset, create_batch_augmentation, create_transport_decoder
+from rsna19.data.prefetch import PrefetchingSampler, prefetching
 from rsna19.models.commons.attention import ContextualAttention, SpatialAttention
-from rsna19.models.commons.balancing_sampler import BalancedBatchSampler
+from rsna19.models.commons.balancing_sampler import BalancedBatchSampler, DistributedBalancedBatchSampler
+from rsna19.models.commons.bucket_sampler import BucketBatchSampler
+from rsna19.models.commons.distributed import rank_and_world_size
 import rsna19.models.commons.metrics as metrics
 from rsna19.models.commons.radam import RAdam
+from rsna19.models.commons import worker_init
+from rsna19.models.commons.study_block_sampler import DistributedStudySampler, StudyBlockSampler
 from rsna19.models.commons.concat_pool import concat_pool
 from rsna19.models.commons.get_base_model import get_base_model
 
@@ -55,6 +62,19 @@ class Classifier2DC(pl.LightningModule):
 
         self.scheduler = None
 
+        device = f'cuda:{config.gpus[0]}' if torch.cuda.is_available() and config.gpus else None
+        if self.config.augment and getattr(self.config, 'batch_augment', False):
+            self.batch_augmentation = create_batch_augmentation(config, device)
+        else:
+            self.batch_augmentation = None
+
+        # training batches are decoded in on_batch_start, before they are moved to the device by the trainer
+        self.transport_decoder = create_transport_decoder(config, device)
+
+        # samplers reading slices ahead into the shared slice cache, see data.prefetch
+        self.prefetch_samplers = {}
+        self.resolved_num_workers = None
+
         if self.config.freeze_backbone_iterations > 0:
             self.freeze_backbone()
             self.backbone_frozen = True
@@ -82,45 +102,66 @@ class Classifier2DC(pl.LightningModule):
         for param in self.backbone.parameters():
             param.requires_grad = True
 
-    def forward(self, x):
-        if self.config.multibranch:
-            batch_in_size = x.shape[0]
+    def branch_channels(self):
+        """Input channels of each branch of multibranch model"""
+        channels = self.config.multibranch_channel_indices
+        if channels is None:
+            channels = list(range(self.config.num_branches * self.config.multibranch_input_channels))
+        size = self.config.multibranch_input_channels
+        return [list(channels[i:i + size]) for i in range(0, len(channels), size)]
 
-            if self.config.multibranch_channel_indices is not None:
-                x = x[:, self.config.multibranch_channel_indices, :, :]
+    def encode_branches(self, x):
+        """Backbone features of branch inputs, (N, multibranch_input_channels, H, W) -> (N, C, h, w)"""
+        return self.backbone(x)
 
-            x = x.view(batch_in_size * self.config.num_branches, self.config.multibranch_input_channels,
-                       x.shape[2], x.shape[3])
-            x = self.backbone(x)
-            x = x.view(batch_in_size, self.config.num_branches, self.num_features_backbone, x.shape[2], x.shape[3])
+    def combine_branches(self, x):
+        """Output of samples from backbone features of their branches, (N, num_branches, C, h, w)"""
+        batch_in_size = x.shape[0]
 
-            if self.config.contextual_attention:
-                x = self.contextual_attention(x)
+        if self.config.contextual_attention:
+            x = self.contextual_attention(x)
 
-            if self.config.spatial_attention:
-                x = self.spatial_attention(x)
+        if self.config.spatial_attention:
+            x = self.spatial_attention(x)
 
-            if self.config.multibranch3d:
-                # transform to (N, C, D, H, W), where D is num_branches
-                x = x.transpose(1, 2)
+        if self.config.multibranch3d:
+            # transform to (N, C, D, H, W), where D is num_branches
+            x = x.transpose(1, 2)
 
-                x = self.combine_conv(x)
-                x = F.adaptive_avg_pool3d(x, 1)
-                x = x.view(x.shape[0], -1)
+            x = self.combine_conv(x)
+            x = F.adaptive_avg_pool3d(x, 1)
+            x = x.view(x.shape[0], -1)
 
-            else:
-                x = x.view(batch_in_size, self.config.num_branches * self.num_features_backbone, x.shape[3], x.shape[4])
-                x = self.combine_conv(x)
-                x = concat_pool(x)
         else:
-            x = self.backbone(x)
+            x = x.reshape(batch_in_size, self.config.num_branches * self.num_features_backbone, x.shape[3], x.shape[4])
+            x = self.combine_conv(x)
             x = concat_pool(x)
 
+        return self.classify(x)
+
+    def classify(self, x):
         if self.dropout is not None:
             x = self.dropout(x)
         x = self.last_linear(x)
         return x
 
+    def forward(self, x):
+        if self.config.multibranch:
+            batch_in_size = x.shape[0]
+
+            if self.config.multibranch_channel_indices is not None:
+                x = x[:, self.config.multibranch_channel_indices, :, :]
+
+            x = x.view(batch_in_size * self.config.num_branches, self.config.multibranch_input_channels,
+                       x.shape[2], x.shape[3])
+            x = self.encode_branches(x)
+            x = x.view(batch_in_size, self.config.num_branches, self.num_features_backbone, x.shape[2], x.shape[3])
+            return self.combine_branches(x)
+
+        x = self.backbone(x)
+        x = concat_pool(x)
+        return self.classify(x)
+
     # training step and validation step should return tensor or nested dicts of tensor for data parallel to work
     def training_step(self, batch, batch_nb):
         x, y = batch['image'], batch['labels']
@@ -132,7 +173,7 @@ class Classifier2DC(pl.LightningModule):
                 'progress': {'learning_rate': lr}}
 
     def validation_step(self, batch, batch_nb):
-        x, y = batch['image'], batch['labels']
+        x, y = self.transport_decoder.decode(batch['image']), batch['labels']
         y_hat = self.forward(x)
         class_weights = torch.tensor(self._CLASS_WEIGHTS, dtype=torch.float32).to(y_hat.get_device())
 
@@ -183,6 +224,11 @@ class Classifier2DC(pl.LightningModule):
         return out_dict
 
     def on_batch_start(self, batch):
+        batch['image'] = self.transport_decoder(batch['image'])
+
+        if self.batch_augmentation is not None:
+            batch['image'] = self.batch_augmentation(batch['image'])
+
         if self.backbone_frozen and self.global_step >= self.config.freeze_backbone_iterations:
             self.unfreeze_backbone()
             self.backbone_frozen = False
@@ -221,22 +267,93 @@ class Classifier2DC(pl.LightningModule):
 
         return optimizer
 
+    def prefetching(self, name, dataset, sampler, batch_sampler=False):
+        """Wrap sampler in PrefetchingSampler if config.prefetch_depth (in samples) is set"""
+        depth = getattr(self.config, 'prefetch_depth', 0)
+        if batch_sampler:
+            depth = -(-depth // self.config.batch_size)
+        sampler = prefetching(sampler, dataset, depth, getattr(self.config, 'prefetch_threads', 8))
+        if isinstance(sampler, PrefetchingSampler):
+            self.prefetch_samplers[name] = sampler
+        return sampler
+
+    def worker_args(self, dataset):
+        """num_workers and worker_init_fn of DataLoaders, config.num_workers 'auto' is calibrated on the first dataset"""
+        threads_per_worker = getattr(self.config, 'worker_threads', None)
+        pin_cpus = getattr(self.config, 'pin_worker_cpus', False)
+        if self.resolved_num_workers is None:
+            self.resolved_num_workers = worker_init.loader_args(self.config.num_workers, dataset,
+                                                                self.config.batch_size, threads_per_worker,
+                                                                pin_cpus)['num_workers']
+        return worker_init.loader_args(self.resolved_num_workers, threads_per_worker=threads_per_worker,
+                                       pin_cpus=pin_cpus)
+
+    def on_epoch_end(self):
+        for name, sampler in self.prefetch_samplers.items():
+            print(f'{name} prefetch: {sampler.stats()}')
+
+    def data_loader(self, name, dataset, sampler=None, batch_sampler=None):
+        """DataLoader of samples from sampler or batches from batch_sampler.
+
+        With config.batch_fetch, whole batches are loaded by dataset.get_batch, see data.batch_fetch.
+        With config.batch_ring, batches are written by workers into shared memory slots, see data.batch_ring.
+        With roi_crop size buckets, batches contain samples of a single bucket, batch_ring doesn't support them.
+        """
+        bucket_ids = dataset.roi_bucket_ids()
+        if bucket_ids is not None:
+            if batch_sampler is not None:
+                raise ValueError('roi_crop size buckets need a sampler of samples, e.g. no balancing')
+            batch_sampler = BucketBatchSampler(sampler, bucket_ids, self.config.batch_size)
+
+        batch_ring = getattr(self.config, 'batch_ring', False)
+        batch_fetch = getattr(self.config, 'batch_fetch', False)
+        if (batch_fetch or batch_ring) and batch_sampler is None:
+            batch_sampler = BatchSampler(sampler, self.config.batch_size, drop_last=False)
+
+        if batch_sampler is not None:
+            batch_sampler = self.prefetching(name, dataset, batch_sampler, batch_sampler=True)
+            if batch_ring:
+                return BatchRingLoader(dataset, batch_sampler, num_slots=getattr(self.config, 'batch_ring_slots', None),
+                                       batch_size=self.config.batch_size, **self.worker_args(dataset))
+            if batch_fetch:
+                return batch_fetch_loader(dataset, batch_sampler, **self.worker_args(dataset))
+            return DataLoader(dataset, batch_sampler=batch_sampler, **self.worker_args(dataset))
+
+        return DataLoader(dataset,
+                          batch_size=self.config.batch_size,
+                          sampler=self.prefetching(name, dataset, sampler),
+                          **self.worker_args(dataset))
+
     @pl.data_loader
     def train_dataloader(self):
+        dataset = IntracranialDataset(self.config, self.train_folds, mode='train',
+                                      augment=self.config.augment, use_cq500=self.config.use_cq500)
+        # with distributed data parallel training each process samples its own disjoint part of the dataset
+        distributed = rank_and_world_size()
+        seed = getattr(self.config, 'sampler_seed', 0)
         if self.config.balancing:
-            return DataLoader(IntracranialDataset(self.config, self.train_folds, mode='train',
-                                                  augment=self.config.augment, use_cq500=self.config.use_cq500),
-                              num_workers=self.config.num_workers,
-                              batch_sampler=BalancedBatchSampler(self.config, self.train_folds))
+            if distributed:
+                batch_sampler = DistributedBalancedBatchSampler(self.config, self.train_folds, *distributed, seed=seed)
+            else:
+                batch_sampler = BalancedBatchSampler(self.config, self.train_folds)
+            return self.data_loader('train', dataset, batch_sampler=batch_sampler)
+        elif getattr(self.config, 'study_block_sampling', False):
+            if distributed:
+                sampler = DistributedStudySampler(*dataset.study_slice_index(), *distributed, seed=seed)
+            else:
+                sampler = StudyBlockSampler(*dataset.study_slice_index(),
+                                            block_size=self.config.study_block_size,
+                                            interleave=self.config.study_block_interleave)
+            return self.data_loader('train', dataset, sampler=sampler)
         else:
-            return DataLoader(IntracranialDataset(self.config, self.train_folds, mode='train',
-                                                  augment=self.config.augment, use_cq500=self.config.use_cq500),
-                              num_workers=self.config.num_workers,
-                              batch_size=self.config.batch_size,
-                              shuffle=True)
+            if distributed:
+                sampler = DistributedStudySampler(*dataset.study_slice_index(), *distributed, seed=seed,
+                                                  shuffle_slices=True)
+            else:
+                sampler = RandomSampler(dataset)
+            return self.data_loader('train', dataset, sampler=sampler)
 
     @pl.data_loader
     def val_dataloader(self):
-        return DataLoader(IntracranialDataset(self.config, self.val_folds, mode='val'),
-                          num_workers=self.config.num_workers,
-                          batch_size=self.config.batch_size)
+        dataset = IntracranialDataset(self.config, self.val_folds, mode='val')
+        return self.data_loader('val', dataset, sampler=SequentialSampler(dataset))
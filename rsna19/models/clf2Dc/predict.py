@@ -8,18 +8,29 @@ import numpy as np
 import os
 import pandas as pd
 import torch
+# used by DataLoader workers, batches of config.batch_ring are not sent through shared memory files
 torch.multiprocessing.set_sharing_strategy('file_system')
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, DataLoader
 from tqdm import tqdm
 
 from rsna19.configs.base_config import BaseConfig
+from rsna19.data.batch_fetch import batch_fetch_loader
+from rsna19.data.batch_ring import BatchRingLoader
+from rsna19.data.blank_slices import calibrated_blank_prediction
 from rsna19.data.dataset_2dc import IntracranialDataset
+from rsna19.models.clf2Dc.branch_inference import BranchFeatureEngine, dedup_supported
 from rsna19.models.clf2Dc.classifier2dc import Classifier2DC
+from rsna19.models.commons import worker_init
+from rsna19.models.commons.bucket_sampler import BucketBatchSampler
+from rsna19.models.commons.inference_runner import InferenceRunner
+from rsna19.models.commons.study_block_sampler import StudyBlockSampler
 
 
 VAL_SET = '5fold.csv'
 TEST_SET = 'test2.csv'
+# DataLoader workers, or 'auto' to calibrate with a short run, see worker_init.WorkerInit for thread limits
+NUM_WORKERS = 4
 
 
 rot_params = {'interpolation': cv2.INTER_LINEAR, 'border_mode': cv2.BORDER_CONSTANT, 'value': 0, 'always_apply': True}
@@ -54,7 +65,14 @@ TTA_TRANSFORMS_RESNET50_7c_400 = {
 }
 
 
-def predict(checkpoint_path, device, subset, tta_transforms, tta_variant=None):
+def predict(checkpoint_path, device, subset, tta_transforms, tta_variant=None, num_workers=NUM_WORKERS,
+            dedup_branches=True, inference_args=None):
+    """
+    :param device: GPU index, device name, or None for a GPU if available and CPU otherwise
+    :param inference_args: other kwargs of InferenceRunner, e.g. num_threads
+    :param dedup_branches: with multibranch models and deterministic preprocessing, run the backbone once per group
+                           of slices shared by branches of neighbouring samples, see branch_inference
+    """
     assert subset in ['train', 'val', 'test']
     assert tta_variant in tta_transforms
 
@@ -84,15 +102,14 @@ def predict(checkpoint_path, device, subset, tta_transforms, tta_variant=None):
         config_dict['test_dataset_file'] = TEST_SET
         config = type('config', (), config_dict)
 
-    with torch.cuda.device(device):
-        checkpoint = torch.load(checkpoint_path, map_location=torch.device(device))
+    runner = InferenceRunner(device, **(inference_args or {}))
+    with runner.device_context():
+        checkpoint = runner.load_checkpoint(checkpoint_path)
 
         model = Classifier2DC(config)
         model.load_state_dict(checkpoint['state_dict'])
         model.on_load_checkpoint(checkpoint)
-        model.cuda()
-
-        model.eval()
+        model = runner.prepare(model)
         model.freeze()
 
         if subset == 'train':
@@ -102,7 +119,14 @@ def predict(checkpoint_path, device, subset, tta_transforms, tta_variant=None):
         else:
             folds = None
 
-        dataset = IntracranialDataset(config, folds, mode=subset, augment=False, transforms=tta_transforms[tta_variant])
+        if tta_transforms[tta_variant] is not None and getattr(config, 'transport_dtype', None) == 'int16':
+            # TTA transforms work on converted values, HU values can't be sent
+            config.transport_dtype = None
+        # slices without brain tissue are not run through the model, see data.blank_slices
+        skip_blank_slices = getattr(config, 'blank_tissue_fraction', None) is not None
+        # samples come grouped by study, the slab of the current study is enough
+        dataset = IntracranialDataset(config, folds, mode=subset, augment=False, transforms=tta_transforms[tta_variant],
+                                      skip_blank_slices=skip_blank_slices, study_slabs=1)
 
         all_paths = []
         all_study_id = []
@@ -111,9 +135,33 @@ def predict(checkpoint_path, device, subset, tta_transforms, tta_variant=None):
         all_pred = []
 
         batch_size = 128
-        data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=4)
-        for bix, batch in tqdm(enumerate(data_loader), total=len(dataset) // batch_size):
-            y_hat = F.sigmoid(model(batch['image'].cuda()))
+        # samples are grouped by study, so that overlapping windows reuse slices loaded by a worker
+        sampler = StudyBlockSampler(*dataset.study_slice_index(), shuffle=False)
+        batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+        if dataset.roi_bucket_ids() is not None:
+            # batches of roi_crop size buckets
+            batch_sampler = BucketBatchSampler(sampler, dataset.roi_bucket_ids(), batch_size)
+        worker_args = worker_init.loader_args(num_workers, dataset, batch_size,
+                                              threads_per_worker=getattr(config, 'worker_threads', None),
+                                              pin_cpus=getattr(config, 'pin_worker_cpus', False))
+        if getattr(config, 'batch_ring', False):
+            data_loader = BatchRingLoader(dataset, batch_sampler, num_slots=getattr(config, 'batch_ring_slots', None),
+                                          batch_size=batch_size, **worker_args)
+        elif getattr(config, 'batch_fetch', False):
+            data_loader = batch_fetch_loader(dataset, batch_sampler, **worker_args)
+        else:
+            data_loader = DataLoader(dataset, batch_sampler=batch_sampler, **worker_args)
+        engine = None
+        if dedup_branches and dedup_supported(config, tta_transforms[tta_variant]):
+            engine = BranchFeatureEngine(model)
+
+        batches = runner.batches(data_loader, decode=model.transport_decoder.decode)
+        for bix, batch in tqdm(enumerate(batches), total=len(batch_sampler)):
+            with runner.inference():
+                if engine is not None:
+                    y_hat = F.sigmoid(engine(batch['image'], batch['study_id'], batch['slice_num']))
+                else:
+                    y_hat = F.sigmoid(model(batch['image']))
             all_pred.append(y_hat.cpu().numpy())
             all_paths.extend(batch['path'])
             all_study_id.extend(batch['study_id'])
@@ -123,6 +171,20 @@ def predict(checkpoint_path, device, subset, tta_transforms, tta_variant=None):
                 y = batch['labels']
                 all_gt.append(y.numpy())
 
+        if engine is not None:
+            print(f'branch deduplication: {engine.stats()}')
+        runner.report(os.path.normpath(train_dir))
+
+        if len(dataset.blank_index) > 0:
+            paths, study_ids, slice_nums, labels = dataset.blank_samples()
+            all_pred.append(np.tile(calibrated_blank_prediction(config), (len(paths), 1)).astype(np.float32))
+            all_paths.extend(paths)
+            all_study_id.extend(study_ids)
+            all_slice_num.extend(slice_nums)
+            if subset != 'test':
+                all_gt.append(labels)
+            print(f'{len(paths)} blank slices of {len(paths) + len(dataset)} predicted with a constant')
+
     pred_columns = ['pred_epidural', 'pred_intraparenchymal', 'pred_intraventricular', 'pred_subarachnoid',
                     'pred_subdural', 'pred_any']
     gt_columns = ['gt_epidural', 'gt_intraparenchymal', 'gt_intraventricular', 'gt_subarachnoid', 'gt_subdural',
@@ -142,12 +204,14 @@ def predict(checkpoint_path, device, subset, tta_transforms, tta_variant=None):
 
     # Free GPU memory
     del model
-    torch.cuda.empty_cache()
+    if runner.device.type == 'cuda':
+        torch.cuda.empty_cache()
 
 
 if __name__ == '__main__':
 
-    gpu = 0
+    # GPU 0, or CPU on nodes without GPUs
+    device = 0 if torch.cuda.is_available() else 'cpu'
     jobs = [
         (BaseConfig.model_outdir + '/0038_7s_res50_400', 'val', TTA_TRANSFORMS_RESNET50_7c_400),
         (BaseConfig.model_outdir + '/0038_7s_res50_400', 'test', TTA_TRANSFORMS_RESNET50_7c_400),
@@ -169,4 +233,4 @@ if __name__ == '__main__':
             for tta in ttas:
 
                 print(f"Calculating predictions for {checkpoint_path}, TTA: {tta}, subset: {subset}")
-                predict(checkpoint_path, gpu, subset, ttas, tta)
+                predict(checkpoint_path, device, subset, ttas, tta)
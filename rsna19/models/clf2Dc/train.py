@@ -30,7 +30,7 @@ def main():
     )
 
     trainer = Trainer(experiment=exp,
-                      distributed_backend='dp',
+                      distributed_backend=getattr(config, 'distributed_backend', 'dp'),
                       max_nb_epochs=config.max_epoch,
                       checkpoint_callback=checkpoint_callback,
                       gpus=config.gpus,
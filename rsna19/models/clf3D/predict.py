@@ -14,11 +14,21 @@ from rsna19.models.clf2D.train import build_model_str
 import albumentations
 import albumentations.pytorch
 from rsna19.models.clf2D.predict import Rotate90
+from rsna19.models.commons import worker_init
+from rsna19.models.commons.inference_runner import InferenceRunner, add_runner_args, runner_args
 
 # import ttach as tta
 
 
-def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=None):
+def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=None, stream_chunk=None,
+            stream_extra_context=0, worker_args=None, inference_args=None):
+    """
+    :param stream_chunk: if set, studies are predicted in overlapping chunks of stream_chunk slices and
+                         predictions are stitched per slice, otherwise whole studies are passed to the model
+    :param stream_extra_context: context slices added to chunks on top of model's combine_slices_padding
+    :param worker_args: kwargs of worker_init.loader_args, 8 workers by default
+    :param inference_args: kwargs of InferenceRunner (device, threads, ...), GPU if available by default
+    """
     model_str = build_model_str(model_name, fold, run)
     model_info = MODELS[model_name]
 
@@ -43,20 +53,25 @@ def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=No
         return_labels=not is_test,
         is_test=is_test,
         return_all_slices=True,
+        stream_chunk_slices=stream_chunk,
+        stream_extra_context=stream_extra_context,
         **{**model_info.dataset_args}
     )
 
+    runner = InferenceRunner(**(inference_args or {}))
     print(f'load {checkpoints_dir}/{epoch:03}.pt')
-    checkpoint = torch.load(f'{checkpoints_dir}/{epoch:03}.pt')
+    checkpoint = runner.load_checkpoint(f'{checkpoints_dir}/{epoch:03}.pt')
     model.load_state_dict(checkpoint['model_state_dict'])
-    model = model.cuda()
-    model.eval()
+    model = runner.prepare(model)
 
-    batch_size = 1  # always use batch size 1 as nb slices is variable and likely not to fit GPU
+    # always use batch size 1 as nb slices is variable and likely not to fit GPU,
+    # with stream_chunk samples are chunks of studies in order, so chunk predictions are concatenated per slice
+    batch_size = 1
     data_loader = DataLoader(dataset_valid,
                              shuffle=False,
-                             num_workers=8,
-                             batch_size=batch_size)
+                             batch_size=batch_size,
+                             **worker_init.loader_args(dataset=dataset_valid, batch_size=batch_size,
+                                                       **(worker_args or {'num_workers': 8})))
 
     all_paths = []
     all_study_id = []
@@ -64,23 +79,28 @@ def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=No
     all_gt = []
     all_pred = []
 
-    data_iter = tqdm(enumerate(data_loader), total=len(data_loader))
+    data_iter = tqdm(enumerate(runner.batches(data_loader, decode=lambda images: images.float())),
+                     total=len(data_loader))
     for iter_num, batch in data_iter:
         # if iter_num > 100:
         #     break
-        with torch.set_grad_enabled(False):
+        with runner.inference():
             all_paths += batch['path']
             nb_slices = len(batch['path'])
             study_id = batch['study_id'][0]
             all_study_id += [study_id] * nb_slices
             all_slice_num += list(batch['slice_num'][0].cpu().numpy())
 
-            y_hat = torch.sigmoid(model(batch['image'].float().cuda()))[0]
+            y_hat = torch.sigmoid(model(batch['image']))[0]
+            if stream_chunk is not None:
+                output_offset = int(batch['output_offset'][0])
+                y_hat = y_hat[output_offset:output_offset + nb_slices]
             all_pred.append(y_hat.detach().cpu().numpy())
 
             if not is_test:
                 y = batch['labels'].detach().cpu().numpy()[0]
                 all_gt.append(y)
+    runner.report(model_name)
 
     pred_columns = ['pred_epidural', 'pred_intraparenchymal', 'pred_intraventricular', 'pred_subarachnoid',
                     'pred_subdural', 'pred_any']
@@ -106,7 +126,8 @@ def predict(model_name, fold, epoch, is_test, df_out_path, mode='normal', run=No
     df.to_csv(df_out_path, index=False)
 
 
-def predict_test(model_name, fold, epoch, mode='normal', run=None):
+def predict_test(model_name, fold, epoch, mode='normal', run=None, stream_chunk=None, stream_extra_context=0,
+                 worker_args=None, inference_args=None):
     run_str = '' if not run else f'_{run}'
     prediction_dir = f'{BaseConfig.prediction_dir}/{model_name}{run_str}/fold{fold}/predictions/'
     os.makedirs(prediction_dir, exist_ok=True)
@@ -115,10 +136,13 @@ def predict_test(model_name, fold, epoch, mode='normal', run=None):
     if os.path.exists(df_out_path):
         print('Skip existing', df_out_path)
     else:
-        predict(model_name=model_name, fold=fold, epoch=epoch, is_test=True, df_out_path=df_out_path, mode=mode, run=run)
+        predict(model_name=model_name, fold=fold, epoch=epoch, is_test=True, df_out_path=df_out_path, mode=mode, run=run,
+                stream_chunk=stream_chunk, stream_extra_context=stream_extra_context, worker_args=worker_args,
+                inference_args=inference_args)
 
 
-def predict_oof(model_name, fold, epoch, mode='normal', run=None):
+def predict_oof(model_name, fold, epoch, mode='normal', run=None, stream_chunk=None, stream_extra_context=0,
+                worker_args=None, inference_args=None):
     run_str = '' if not run else f'_{run}'
     prediction_dir = f'{BaseConfig.prediction_dir}/{model_name}{run_str}/fold{fold}/predictions/'
     os.makedirs(prediction_dir, exist_ok=True)
@@ -127,7 +151,9 @@ def predict_oof(model_name, fold, epoch, mode='normal', run=None):
     if os.path.exists(df_out_path):
         print('Skip existing', df_out_path)
     else:
-        predict(model_name=model_name, fold=fold, epoch=epoch, is_test=False, df_out_path=df_out_path, mode=mode, run=run)
+        predict(model_name=model_name, fold=fold, epoch=epoch, is_test=False, df_out_path=df_out_path, mode=mode, run=run,
+                stream_chunk=stream_chunk, stream_extra_context=stream_extra_context, worker_args=worker_args,
+                inference_args=inference_args)
 
 
 if __name__ == '__main__':
@@ -139,12 +165,20 @@ if __name__ == '__main__':
     parser.add_argument('--weights', type=str, default='')
     parser.add_argument('--epoch', type=int, nargs='+')
     parser.add_argument('--mode', type=str, default=['normal'], nargs='+')
+    parser.add_argument('--stream_chunk', type=int, default=None,
+                        help='predict studies in chunks of given number of slices, default is whole studies')
+    parser.add_argument('--stream_extra_context', type=int, default=0,
+                        help="context slices of chunks added to model's combine_slices_padding")
 
     parser.add_argument('--resume_weights', type=str, default='')
     parser.add_argument('--resume_epoch', type=int, default=-1)
+    worker_init.add_worker_args(parser, default_num_workers=8)
+    add_runner_args(parser)
 
     args = parser.parse_args()
     action = args.action
+    worker_args = dict(num_workers=args.num_workers, threads_per_worker=args.worker_threads,
+                       pin_cpus=args.pin_worker_cpus)
     modes = args.mode
     if modes == ['all']:
         modes = ['normal', 'h_flip', 'v_flip', 'rot90']
@@ -154,11 +188,15 @@ if __name__ == '__main__':
             for epoch in args.epoch:
                 for mode in modes:
                     print(f'fold {fold}, epoch {epoch}, {mode}')
-                    predict_test(model_name=args.model, run=args.run, fold=fold, epoch=epoch, mode=mode)
+                    predict_test(model_name=args.model, run=args.run, fold=fold, epoch=epoch, mode=mode,
+                                 stream_chunk=args.stream_chunk, stream_extra_context=args.stream_extra_context,
+                                 worker_args=worker_args, inference_args=runner_args(args))
 
     if action == 'predict_oof':
         for fold in args.fold:
             for epoch in args.epoch:
                 for mode in modes:
                     print(f'fold {fold}, epoch {epoch}, {mode}')
-                    predict_oof(model_name=args.model, run=args.run, fold=fold, epoch=epoch, mode=mode)
+                    predict_oof(model_name=args.model, run=args.run, fold=fold, epoch=epoch, mode=mode,
+                                stream_chunk=args.stream_chunk, stream_extra_context=args.stream_extra_context,
+                                worker_args=worker_args, inference_args=runner_args(args))
@@ -20,6 +20,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from rsna19.configs.base_config import BaseConfig
 from rsna19.models.commons import radam
+from rsna19.models.commons import worker_init
+from rsna19.models.commons.resumable_sampler import ResumableRandomSampler, rng_state, save_checkpoint, set_rng_state
 from rsna19.models.clf3D.experiments_3d import MODELS
 from torch.utils.tensorboard import SummaryWriter
 import math
@@ -93,7 +95,13 @@ def check_CosineAnnealingLRWithRestarts():
 # check_CosineAnnealingLRWithRestarts()
 
 
-def train(model_name, fold, run=None, resume_epoch=-1):
+def train(model_name, fold, run=None, resume_epoch=-1, num_workers=16, worker_threads=None, pin_worker_cpus=False,
+          checkpoint_interval=None, resume_last=False):
+    """
+    :param checkpoint_interval: if set, model, optimizer, sampler and RNG states are saved to last.pt every
+                                checkpoint_interval training batches
+    :param resume_last: resume from last.pt at the next batch after the checkpoint
+    """
     model_str = build_model_str(model_name, fold, run)
 
     model_info = MODELS[model_name]
@@ -170,18 +178,45 @@ def train(model_name, fold, run=None, resume_epoch=-1):
         model.module.load_state_dict(checkpoint['model_state_dict'])
         optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
+    start_epoch = resume_epoch + 1
+    resume_state = None
+    if resume_last:
+        resume_state = torch.load(f'{checkpoints_dir}/last.pt')
+        print('load', f'{checkpoints_dir}/last.pt', 'epoch', resume_state['epoch'])
+        model.module.load_state_dict(resume_state['model_state_dict'])
+        optimizer.load_state_dict(resume_state['optimizer_state_dict'])
+        start_epoch = resume_state['epoch']
+        if start_epoch > 0:
+            # the saved optimizer may hold the lr of the previous epoch, last.pt is written before the scheduler
+            # step of validation, so the lr of start_epoch is set the same way an uninterrupted run does
+            scheduler.step(epoch=start_epoch - 1)
+
+    def save_last(epoch_num, sampler_state):
+        save_checkpoint(
+            {
+                'epoch': epoch_num,
+                'model_state_dict': model.module.state_dict(),
+                'optimizer_state_dict': optimizer.state_dict(),
+                'sampler': sampler_state,
+                'rng': rng_state()
+            },
+            f'{checkpoints_dir}/last.pt'
+        )
+
     data_loaders = {
         'train': DataLoader(
             dataset_train,
-            num_workers=16,
-            shuffle=True,
+            # can be resumed in the middle of an epoch
+            sampler=ResumableRandomSampler(len(dataset_train)),
             drop_last=True,
-            batch_size=model_info.batch_size),
+            batch_size=model_info.batch_size,
+            **worker_init.loader_args(num_workers, dataset_train, model_info.batch_size,
+                                      threads_per_worker=worker_threads, pin_cpus=pin_worker_cpus)),
         'val': DataLoader(
             dataset_valid,
             shuffle=False,
-            num_workers=4,
-            batch_size=1)
+            batch_size=1,
+            **worker_init.loader_args(4, threads_per_worker=worker_threads, pin_cpus=pin_worker_cpus))
     }
 
     class_weights = torch.tensor([1.0, 1.0, 1.0, 1.0, 1.0, 2.0]).cuda()
@@ -193,7 +228,7 @@ def train(model_name, fold, run=None, resume_epoch=-1):
         return F.binary_cross_entropy_with_logits(y_pred, y_true, cw)
 
     # fit new layers first:
-    if resume_epoch == -1 and model_info.is_pretrained:
+    if resume_epoch == -1 and not resume_last and model_info.is_pretrained:
         model.train()
         model.module.freeze_encoder()
         data_loader = data_loaders['train']
@@ -227,7 +262,7 @@ def train(model_name, fold, run=None, resume_epoch=-1):
         'val': 2
     }
 
-    for epoch_num in range(resume_epoch+1, 80):
+    for epoch_num in range(start_epoch, 80):
         for phase in ['train', 'val']:
             if epoch_num % phase_period[phase] == 0:
                 model.train(phase == 'train')
@@ -240,6 +275,15 @@ def train(model_name, fold, run=None, resume_epoch=-1):
                     model.module.on_epoch(epoch_num)
 
                 data_loader = data_loaders[phase]
+                if phase == 'train':
+                    if resume_state is not None and resume_state['sampler'] is not None:
+                        data_loader.sampler.load_state_dict(resume_state['sampler'])
+                        set_rng_state(resume_state['rng'])
+                        print(f'resume epoch {epoch_num} at sample {data_loader.sampler.start}')
+                    else:
+                        data_loader.sampler.set_epoch(epoch_num)
+                    resume_state = None
+
                 data_iter = tqdm(enumerate(data_loader), total=len(data_loader))
                 for iter_num, data in data_iter:
                     img = data['image'].float().cuda()
@@ -256,6 +300,10 @@ def train(model_name, fold, run=None, resume_epoch=-1):
                                 optimizer.step()
                                 optimizer.zero_grad()
 
+                                if checkpoint_interval and (iter_num + 1) % checkpoint_interval == 0:
+                                    save_last(epoch_num, data_loader.sampler.state_dict(
+                                        num_consumed=(iter_num + 1) * data_loader.batch_size))
+
                         epoch_loss.append(float(loss))
 
                         epoch_labels.append(np.row_stack(labels.detach().cpu().numpy()))
@@ -311,6 +359,9 @@ def train(model_name, fold, run=None, resume_epoch=-1):
                     },
                     f'{checkpoints_dir}/{epoch_num:03}.pt'
                 )
+                if checkpoint_interval:
+                    # the next resume starts at the next epoch, validation of this epoch is skipped then
+                    save_last(epoch_num + 1, None)
 
 
 def check_score(model_name, fold, epoch, run=None):
@@ -380,13 +431,20 @@ if __name__ == '__main__':
 
     parser.add_argument('--resume_weights', type=str, default='')
     parser.add_argument('--resume_epoch', type=int, default=-1)
+    parser.add_argument('--checkpoint_interval', type=int, default=None,
+                        help='save model, optimizer, sampler and RNG states to last.pt every N training batches')
+    parser.add_argument('--resume_last', action='store_true', help='resume from last.pt at the next batch')
+    worker_init.add_worker_args(parser, default_num_workers=16)
 
     args = parser.parse_args()
     action = args.action
 
     if action == 'train':
         try:
-            train(model_name=args.model, run=args.run, fold=args.fold, resume_epoch=args.resume_epoch)
+            train(model_name=args.model, run=args.run, fold=args.fold, resume_epoch=args.resume_epoch,
+                  num_workers=args.num_workers, worker_threads=args.worker_threads,
+                  pin_worker_cpus=args.pin_worker_cpus, checkpoint_interval=args.checkpoint_interval,
+                  resume_last=args.resume_last)
         except KeyboardInterrupt:
             pass
 
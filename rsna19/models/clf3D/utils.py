@@ -10,12 +10,11 @@ def generate_model(config):
         dropout=config.dropout
     )
 
-    model = model.cuda() 
     net_dict = model.state_dict()
 
     if config.pretrained:
         print('Loading pretrained model {}'.format(config.pretrained))
-        pretrain = torch.load(config.pretrained)
+        pretrain = torch.load(config.pretrained, map_location='cpu')
         pretrain_dict = {k: v for k, v in pretrain['state_dict'].items() if k in net_dict.keys()}
          
         net_dict.update(pretrain_dict)
@@ -1,53 +1,185 @@
-from copy import deepcopy
 import os
+import time
 
 import pandas as pd
 import numpy as np
 from torch.utils.data.sampler import Sampler
 
+from rsna19.data.blank_slices import blank_mask
+
+CLASS_NAMES = ['epidural', 'intraparenchymal', 'intraventricular', 'subarachnoid', 'subdural']
+
+
+def class_indices(data):
+    """Return arrays of row numbers of examples of each class and of negative examples, in config.probas order"""
+    indices = [np.flatnonzero(data[class_name].values == 1.0) for class_name in CLASS_NAMES]
+    indices.append(np.flatnonzero(data['any'].values == 0.0))
+    return indices
+
 
 class BalancedBatchSampler(Sampler):
-    def __init__(self, config, folds):
+    """Batches with classes drawn with config.probas, examples of a class are drawn without replacement.
+
+    Each class keeps a shuffled permutation of its examples and a cursor, a batch takes the next examples after
+    the cursor and the permutation is reshuffled when the cursor wraps, so a batch costs O(batch_size).
+    """
+
+    def __init__(self, config, folds, seed=None):
         self.config = config
+        self.batch_size = int(config.batch_size / len(config.gpus))
+        self.probas = np.asarray(config.probas, dtype=np.float64)
+        self.random_state = np.random.RandomState(seed)
 
         if config.csv_root_dir is None:
             csv_root_dir = os.path.normpath(__file__ + '/../../../data/csv')
         else:
             csv_root_dir = config.csv_root_dir
 
-        data = pd.read_csv(os.path.join(csv_root_dir, config.dataset_file))
+        dataset_file = getattr(config, 'dataset_file', None) or config.train_dataset_file
+        data = pd.read_csv(os.path.join(csv_root_dir, dataset_file))
         data = data[data.fold.isin(folds)]
+        # the same samples as dataset_2dc in train mode
+        data = data[~blank_mask(data, config)]
         data = data.reset_index(drop=True)
-        self.data = data
+        self.num_samples = len(data)
+
+        self.class_indices = class_indices(data)
+        for class_num, indices in enumerate(self.class_indices):
+            if len(indices) == 0 and self.probas[class_num] > 0:
+                raise ValueError(f'no examples of class {class_num} in folds {folds}, but its proba is > 0')
+        self.permutations = [self.random_state.permutation(indices) for indices in self.class_indices]
+        self.cursors = np.zeros(len(self.class_indices), dtype=np.int64)
 
-        class_examples_dfs = {}
-        for class_name in ['epidural', 'intraparenchymal', 'intraventricular', 'subarachnoid', 'subdural']:
-            class_examples_dfs[class_name] = data[data[class_name] == 1.0]
+    def _sample_n(self, class_num, n):
+        permutation = self.permutations[class_num]
+        cursor = self.cursors[class_num]
+        parts = []
+        while n > 0:
+            if cursor == len(permutation):
+                permutation = self.random_state.permutation(self.class_indices[class_num])
+                cursor = 0
+            part = permutation[cursor:cursor + n]
+            parts.append(part)
+            cursor += len(part)
+            n -= len(part)
 
-        class_examples_dfs['negative'] = data[data['any'] == 0.0]
-        self.class_examples_dfs = class_examples_dfs
-        self.class_examples_dfs_used = deepcopy(class_examples_dfs)
+        self.permutations[class_num] = permutation
+        self.cursors[class_num] = cursor
+        return parts
 
     def __iter__(self):
         for _ in range(len(self)):
-            out = np.random.choice(self.config.n_classes, int(self.config.batch_size/len(self.config.gpus)), p=self.config.probas)
-            num_examples = np.zeros(self.config.n_classes, dtype=np.int32)
-            for i in out:
-                num_examples[i] += 1
+            classes = self.random_state.choice(len(self.probas), self.batch_size, p=self.probas)
+            num_examples = np.bincount(classes, minlength=len(self.probas))
 
             batch = []
-            for class_name, n in zip(self.class_examples_dfs_used.keys(), num_examples):
-                indices = self._sample_n(class_name, n)
-                batch.extend(indices)
+            for class_num, n in enumerate(num_examples):
+                batch.extend(self._sample_n(class_num, n))
+            yield np.concatenate(batch).tolist()
+
+    def __len__(self):
+        return int(self.num_samples / self.batch_size)
+
+
+class DistributedBalancedBatchSampler(BalancedBatchSampler):
+    """BalancedBatchSampler of one process of distributed data parallel training.
+
+    In every epoch examples are shuffled with the same (seed, epoch) on all ranks and split into world_size disjoint
+    shards, each rank draws balanced batches from its own shard with a (seed, epoch, rank) random state.
+    Ranks never share examples within an epoch, all ranks yield the same number of batches, and batches of an epoch
+    are the same on each run. The epoch advances after each pass, set_epoch() sets it explicitly.
+    """
+
+    def __init__(self, config, folds, rank, world_size, seed=0, epoch=0, batch_size=None):
+        """
+        :param batch_size: batch size of each process, defaults to config.batch_size
+        """
+        super().__init__(config, folds, seed)
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = epoch
+        self.batch_size = batch_size or config.batch_size
+        self.all_class_indices = self.class_indices
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
-            yield batch
+    def _shard(self, epoch):
+        # examples are assigned to ranks before splitting into classes, as an example can belong to several classes
+        ranks = np.empty(self.num_samples, dtype=np.int64)
+        ranks[np.random.RandomState([self.seed, epoch]).permutation(self.num_samples)] = \
+            np.arange(self.num_samples) % self.world_size
+        self.class_indices = [indices[ranks[indices] == self.rank] for indices in self.all_class_indices]
+        for class_num, indices in enumerate(self.class_indices):
+            if len(indices) == 0 and self.probas[class_num] > 0:
+                raise ValueError(f'no examples of class {class_num} for rank {self.rank} of {self.world_size}')
 
-    def _sample_n(self, class_name, n):
-        if len(self.class_examples_dfs_used[class_name]) <= n:
-            self.class_examples_dfs_used[class_name] = deepcopy(self.class_examples_dfs[class_name])
-        sampled_df = self.class_examples_dfs_used[class_name].sample(n)
-        self.class_examples_dfs_used[class_name] = self.class_examples_dfs_used[class_name].drop(sampled_df.index)
-        return sampled_df.index
+        self.random_state = np.random.RandomState([self.seed, epoch, self.rank])
+        self.permutations = [self.random_state.permutation(indices) for indices in self.class_indices]
+        self.cursors = np.zeros(len(self.class_indices), dtype=np.int64)
+
+    def __iter__(self):
+        self._shard(self.epoch)
+        self.epoch += 1
+        return super().__iter__()
 
     def __len__(self):
-        return int(len(self.data)/int(self.config.batch_size/len(self.config.gpus)))
+        return int(self.num_samples / self.world_size / self.batch_size)
+
+
+def benchmark_sampler(num_samples=670000, num_batches=2000, batch_size=32):
+    """Time batches of BalancedBatchSampler against per class pandas sample/drop of the previous implementation"""
+    import tempfile
+
+    random_state = np.random.RandomState(0)
+    labels = (random_state.rand(num_samples, len(CLASS_NAMES)) < 0.03).astype(np.float64)
+    data = pd.DataFrame(labels, columns=CLASS_NAMES)
+    data['any'] = labels.max(axis=1)
+    data['fold'] = np.arange(num_samples) % 5
+
+    class config:
+        csv_root_dir = None
+        dataset_file = 'balancing.csv'
+        gpus = [0]
+        n_classes = 6
+        probas = [0.1, 0.14, 0.14, 0.14, 0.14, 0.34]
+    config.batch_size = batch_size
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config.csv_root_dir = tmp_dir
+        data.to_csv(os.path.join(tmp_dir, config.dataset_file), index=False)
+
+        start = time.time()
+        sampler = BalancedBatchSampler(config, [0, 1, 2, 3, 4], seed=0)
+        print(f'init: {time.time() - start:.2f} s')
+
+    start = time.time()
+    batches = []
+    for batch_num, batch in enumerate(sampler):
+        batches.append(batch)
+        if batch_num == num_batches - 1:
+            break
+    seconds = time.time() - start
+    print(f'numpy cursors: {num_batches / seconds:.0f} batches/s')
+
+    assert all(len(batch) == sampler.batch_size for batch in batches)
+    sampled = np.concatenate(batches)
+    negative = data['any'].values[sampled] == 0
+    print(f'negative fraction {negative.mean():.3f}, expected {config.probas[-1]}')
+
+    # previous implementation: DataFrame.sample and DataFrame.drop of each class pool on every batch
+    pools = {class_name: data[data[class_name] == 1.0] for class_name in CLASS_NAMES}
+    pools['negative'] = data[data['any'] == 0.0]
+    num_pandas_batches = max(num_batches // 20, 1)
+    start = time.time()
+    for _ in range(num_pandas_batches):
+        num_examples = np.bincount(np.random.choice(6, batch_size, p=config.probas), minlength=6)
+        for class_name, n in zip(list(pools.keys()), num_examples):
+            sampled_df = pools[class_name].sample(n)
+            pools[class_name] = pools[class_name].drop(sampled_df.index)
+    print(f'pandas sample/drop: {num_pandas_batches / (time.time() - start):.0f} batches/s')
+
+
+if __name__ == '__main__':
+    benchmark_sampler()
@@ -0,0 +1,47 @@
+import numpy as np
+from torch.utils.data.sampler import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """Groups samples of a sampler into batches of samples of the same bucket, e.g. the same image size.
+
+    Samples are taken in the order of the sampler and collected per bucket, a batch is emitted as soon as its bucket
+    has batch_size samples, so that the order of the sampler (random, study blocks) is mostly preserved.
+    Incomplete batches are emitted at the end of the epoch, unless drop_last is set.
+    """
+
+    def __init__(self, sampler, bucket_ids, batch_size, drop_last=False):
+        """
+        :param sampler: sampler of dataset indices
+        :param bucket_ids: bucket of each dataset sample
+        """
+        self.sampler = sampler
+        self.bucket_ids = np.asarray(bucket_ids)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        pending = {}
+        for idx in self.sampler:
+            batch = pending.setdefault(self.bucket_ids[idx], [])
+            batch.append(idx)
+            if len(batch) == self.batch_size:
+                yield batch
+                pending[self.bucket_ids[idx]] = []
+
+        if not self.drop_last:
+            for batch in pending.values():
+                if batch:
+                    yield batch
+
+    def __len__(self):
+        num_samples = len(self.sampler)
+        if num_samples == len(self.bucket_ids):
+            # sampler emits every sample once, e.g. random, sequential or study samplers
+            counts = np.unique(self.bucket_ids, return_counts=True)[1]
+        else:
+            # upper bound for a subset of samples, e.g. of a distributed sampler
+            counts = np.array([num_samples] + [self.batch_size - 1] * (len(np.unique(self.bucket_ids)) - 1))
+        if self.drop_last:
+            return int((counts // self.batch_size).sum())
+        return int(((counts + self.batch_size - 1) // self.batch_size).sum())
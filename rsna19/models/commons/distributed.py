@@ -0,0 +1,90 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def rank_and_world_size():
+    """Return (rank, world_size) of the process in distributed data parallel training, None outside of it"""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return None
+
+
+def gather_indices(indices):
+    """All-gather lists of sample indices of equal length from all ranks, returns array of shape (world_size, len)"""
+    tensor = torch.tensor(indices, dtype=torch.int64)
+    gathered = [torch.zeros_like(tensor) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, tensor)
+    return torch.stack(gathered).numpy()
+
+
+def _check_rank(rank, world_size, init_file, csv_root_dir, study_ids, slice_nums):
+    from rsna19.models.commons.balancing_sampler import DistributedBalancedBatchSampler
+    from rsna19.models.commons.study_block_sampler import DistributedStudySampler
+
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=world_size)
+
+    class config:
+        dataset_file = 'balancing.csv'
+        gpus = [0]
+        batch_size = 8
+        probas = [0.1, 0.14, 0.14, 0.14, 0.14, 0.34]
+    config.csv_root_dir = csv_root_dir
+
+    rank, world_size = rank_and_world_size()
+    samplers = [
+        ('balanced', DistributedBalancedBatchSampler(config, [0, 1, 2, 3], rank, world_size, seed=1)),
+        ('study', DistributedStudySampler(study_ids, slice_nums, rank, world_size, seed=1))
+    ]
+    for name, sampler in samplers:
+        epochs = []
+        for epoch in range(2):
+            sampler.set_epoch(epoch)
+            indices = np.ravel(list(sampler)).tolist()
+            assert len(indices) == len(sampler) * (config.batch_size if name == 'balanced' else 1)
+            gathered = gather_indices(indices)
+            if name == 'balanced':
+                # examples are drawn without replacement within shards, so sets of ranks are disjoint
+                sets = [set(rank_indices) for rank_indices in gathered]
+                assert all(not sets[i] & sets[j] for i in range(world_size) for j in range(i + 1, world_size))
+            else:
+                assert len(np.unique(gathered)) == gathered.size
+            epochs.append(gathered)
+
+        sampler.set_epoch(0)
+        assert np.ravel(list(sampler)).tolist() == epochs[0][rank].tolist(), 'epoch shuffle is not deterministic'
+        assert not np.array_equal(epochs[0], epochs[1]), 'epochs are shuffled in the same way'
+        if rank == 0:
+            print(f'{name}: {len(sampler)} items per rank, disjoint ranks, deterministic epochs')
+
+    dist.destroy_process_group()
+
+
+def check_distributed_samplers(world_size=3):
+    """Run distributed samplers in world_size CPU processes with the gloo backend and compare their outputs"""
+    import pandas as pd
+    import torch.multiprocessing as mp
+
+    from rsna19.models.commons.balancing_sampler import CLASS_NAMES
+
+    random_state = np.random.RandomState(0)
+    num_samples = 3000
+    labels = (random_state.rand(num_samples, len(CLASS_NAMES)) < 0.1).astype(np.float64)
+    data = pd.DataFrame(labels, columns=CLASS_NAMES)
+    data['any'] = labels.max(axis=1)
+    data['fold'] = np.arange(num_samples) % 5
+
+    study_ids = np.repeat(np.arange(40), 25)[random_state.permutation(1000)]
+    slice_nums = random_state.permutation(1000)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data.to_csv(os.path.join(tmp_dir, 'balancing.csv'), index=False)
+        mp.spawn(_check_rank, args=(world_size, os.path.join(tmp_dir, 'init'), tmp_dir, study_ids, slice_nums),
+                 nprocs=world_size)
+
+
+if __name__ == '__main__':
+    check_distributed_samplers()
@@ -0,0 +1,197 @@
+import numpy as np
+import torch
+from torch.utils.data.sampler import Sampler
+
+# loss weights of 'epidural', 'intraparenchymal', 'intraventricular', 'subarachnoid', 'subdural', 'any'
+CLASS_WEIGHTS = np.array([1.0, 1.0, 1.0, 1.0, 1.0, 2.0])
+
+
+def sample_losses(predictions, labels, eps=1e-7):
+    """Per sample weighted binary cross entropy of probabilities, shape (num_samples,)"""
+    predictions = np.clip(predictions, eps, 1 - eps)
+    bce = -(labels * np.log(predictions) + (1 - labels) * np.log(1 - predictions))
+    return (bce * CLASS_WEIGHTS).mean(axis=1)
+
+
+def dataset_path_index(dataset):
+    """Map paths returned by data.dataset.IntracranialDataset samples to their dataset indices"""
+    offset = len(dataset.seg_data) * dataset.segmentation_oversample
+    return {path.replace('/npy/', '/3d/'): offset + i for i, path in enumerate(dataset.data.path)}
+
+
+class HardExampleSampler(Sampler):
+    """Samples with replacement proportionally to smoothed per sample loss.
+
+    The loss table is initialized with initial_loss, so unseen samples are drawn first, and updated with
+    exponential moving average of losses of training steps (update()) or of OOF predictions of previous runs
+    (update_from_oof()). Sampling weight of each sample is max(loss, floor * mean loss), so that easy samples
+    are still visited. Probabilities are recomputed every chunk_size draws to follow updates within an epoch.
+
+    A pass yields num_draws samples, stats() reports visits as effective epochs of uniform sampling.
+    The state (loss table, visits, random state and position in the epoch) can be saved in the middle of an epoch,
+    see resumable_sampler.ResumableRandomSampler. Chunks are drawn ahead of training, so the state keeps the
+    remaining draws of the chunk at the saved position and the random state after it, and a resumed run yields
+    the same samples as an uninterrupted one.
+    """
+
+    def __init__(self, num_samples, num_draws=None, smoothing=0.7, floor=0.25, initial_loss=1.0, chunk_size=8192,
+                 seed=None):
+        """
+        :param num_draws: samples drawn per pass, defaults to num_samples
+        :param smoothing: weight of the previous loss in the moving average
+        :param floor: minimal sampling weight relative to the mean loss
+        """
+        self.num_samples = num_samples
+        self.num_draws = num_draws or num_samples
+        self.smoothing = smoothing
+        self.floor = floor
+        self.chunk_size = chunk_size
+        self.random_state = np.random.RandomState(seed)
+
+        self.losses = np.full(num_samples, initial_loss, dtype=np.float64)
+        self.visits = np.zeros(num_samples, dtype=np.int64)
+        self.epoch = 0
+        self.start = 0
+        # (chunk start, drawn indices, random state after the draw) of chunks of the current iteration
+        self.chunks = []
+        # remaining draws of the chunk of a loaded state, yielded before drawing new chunks
+        self.resume_indices = None
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+        self.chunks = []
+
+    def update(self, indices, losses):
+        """Update loss table with losses of samples of dataset indices"""
+        indices = np.asarray(indices, dtype=np.int64)
+        losses = np.asarray(losses, dtype=np.float64)
+        self.losses[indices] = self.smoothing * self.losses[indices] + (1 - self.smoothing) * losses
+
+    def update_from_oof(self, oof_files, path_index):
+        """Set losses of samples found in OOF files saved by clf2D/train.py
+
+        :param oof_files: paths of oof_dir/NNN.pt files with sample_paths, epoch_labels and epoch_predictions
+        :param path_index: sample path -> dataset index, see dataset_path_index()
+        :return: number of samples found
+        """
+        num_found = 0
+        for oof_file in oof_files:
+            oof = torch.load(oof_file)
+            losses = sample_losses(oof['epoch_predictions'], oof['epoch_labels'])
+            indices = np.array([path_index.get(path, -1) for path in oof['sample_paths']])
+            found = indices >= 0
+            self.losses[indices[found]] = losses[found]
+            num_found += found.sum()
+        return num_found
+
+    def probabilities(self):
+        weights = np.maximum(self.losses, self.floor * self.losses.mean())
+        return weights / weights.sum()
+
+    def __iter__(self):
+        self.chunks = []
+        first_chunk = self.start
+        if self.resume_indices is not None:
+            # visits of the chunk were counted before the state was saved
+            indices = self.resume_indices
+            self.resume_indices = None
+            self.chunks.append((self.start, indices, self.random_state.get_state()))
+            first_chunk = self.start + len(indices)
+            yield from indices.tolist()
+
+        for chunk_start in range(first_chunk, self.num_draws, self.chunk_size):
+            size = min(self.chunk_size, self.num_draws - chunk_start)
+            indices = self.random_state.choice(self.num_samples, size, p=self.probabilities())
+            np.add.at(self.visits, indices, 1)
+            self.chunks.append((chunk_start, indices, self.random_state.get_state()))
+            yield from indices.tolist()
+
+    def __len__(self):
+        return self.num_draws - self.start
+
+    def state_dict(self, num_consumed):
+        """
+        :param num_consumed: samples of the current iteration used by training
+        """
+        position = self.start + num_consumed
+        remaining_indices = None
+        random_state = self.random_state.get_state()
+        for chunk_start, indices, chunk_random_state in self.chunks:
+            if chunk_start <= position < chunk_start + len(indices):
+                remaining_indices = indices[position - chunk_start:].copy()
+                random_state = chunk_random_state
+                break
+
+        return {
+            'epoch': self.epoch,
+            'start': position,
+            'num_draws': self.num_draws,
+            'losses': self.losses.copy(),
+            'visits': self.visits.copy(),
+            'random_state': random_state,
+            'remaining_indices': remaining_indices
+        }
+
+    def load_state_dict(self, state):
+        if len(state['losses']) != self.num_samples:
+            raise ValueError(f"sampler state of {len(state['losses'])} samples, dataset has {self.num_samples}")
+        self.num_draws = state['num_draws']
+        self.losses[:] = state['losses']
+        self.visits[:] = state['visits']
+        self.random_state.set_state(state['random_state'])
+        self.set_epoch(state['epoch'], state['start'])
+        self.resume_indices = state.get('remaining_indices')
+
+    def stats(self):
+        return {
+            'visits': int(self.visits.sum()),
+            'effective_epochs': float(self.visits.sum() / self.num_samples),
+            'coverage': float(np.count_nonzero(self.visits) / self.num_samples),
+            'mean_loss': float(self.losses.mean())
+        }
+
+
+def check_hard_example_sampler(num_samples=100000, hard_ratio=0.05):
+    """Sample from a loss table with a few hard samples, as after a previous run"""
+    random_state = np.random.RandomState(0)
+    hard = random_state.rand(num_samples) < hard_ratio
+    losses = np.where(hard, random_state.uniform(0.3, 2.0, num_samples), random_state.uniform(0.0, 0.02, num_samples))
+
+    sampler = HardExampleSampler(num_samples, num_draws=num_samples // 4, seed=0)
+    sampler.losses[:] = losses
+
+    indices = np.array(list(sampler))
+    assert len(indices) == len(sampler)
+    print(f'hard samples: {hard.mean():.3f} of dataset, {hard[indices].mean():.3f} of draws')
+    print(sampler.stats())
+
+    # a run interrupted while the iterator is ahead of training resumes with the same draws
+    def train(sampler, num_steps=None, ahead=300, state=None):
+        if state is not None:
+            sampler.load_state_dict(state)
+        draws = []
+        iterator = iter(sampler)
+        pending = [next(iterator) for _ in range(ahead)]
+        for idx in iterator:
+            pending.append(idx)
+            consumed = pending.pop(0)
+            draws.append(consumed)
+            sampler.update([consumed], [losses[consumed] * 0.5])
+            if num_steps is not None and len(draws) == num_steps:
+                return draws, sampler.state_dict(len(draws))
+        return draws + pending, None
+
+    def new_sampler():
+        sampler = HardExampleSampler(10000, chunk_size=1000, seed=1)
+        sampler.losses[:] = losses[:10000]
+        return sampler
+
+    expected, _ = train(new_sampler())
+    first, state = train(new_sampler(), num_steps=2500)
+    rest, _ = train(new_sampler(), state=state)
+    assert first + rest == expected
+
+
+if __name__ == '__main__':
+    check_hard_example_sampler()
@@ -0,0 +1,290 @@
+""" Device agnostic inference loop shared by predict scripts of clf2D, clf2Dc and clf3D.
+
+InferenceRunner takes care of everything around model(images) of a predict script:
+ * device - 'cuda' if available, otherwise 'cpu', an int selects a GPU; checkpoints are mapped to the device
+ * threads - on CPU torch intra-op threads default to available CPUs not used by DataLoader workers,
+   inter-op threads are only set when requested, torch allows that before the first parallel op only
+ * memory format - on CPU model weights are converted to channels_last (channels_last_3d for 3D convolutions),
+   convolutions then run in the format preferred by mkldnn and pass it on to following layers; inputs are left
+   contiguous, so that views of inputs in models and study/branch feature engines keep working, views of
+   features in models have to be reshapes
+ * inference mode - torch.inference_mode, or torch.no_grad for torch versions without it
+ * overlap - a thread takes batches from the data loader, moves images to the device and decodes them while the
+   main thread runs the model on the previous batch; most torch ops release the GIL, so on CPU receiving and
+   decoding batches overlaps with the forward pass
+ * throughput - images/s of the model and the fraction of time spent waiting for data are reported per run
+
+Typical use, see clf2Dc/predict.py:
+    runner = InferenceRunner(**runner_args)
+    model = runner.prepare(model)
+    with runner.inference():
+        for batch in runner.batches(data_loader, decode=decoder.decode):
+            y_hat = model(batch['image'])
+    runner.report(model_name)
+
+Check speed of CPU inference of the 3x3 multibranch Classifier2DC, with and without the runner:
+    python models/commons/inference_runner.py
+"""
+import contextlib
+import queue
+import threading
+import time
+
+import torch
+
+from rsna19.models.commons.worker_init import available_cpus
+
+
+def pick_device(device=None):
+    """torch.device of device name or GPU index, None picks the first GPU if available, otherwise CPU"""
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    elif isinstance(device, int):
+        device = f'cuda:{device}'
+    return torch.device(device)
+
+
+@contextlib.contextmanager
+def null_context():
+    """contextlib.nullcontext of python 3.7+"""
+    yield
+
+
+def inference_context():
+    """torch.inference_mode if available (torch >= 1.9), torch.no_grad otherwise"""
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def to_channels_last(model):
+    """Convert 4D weights to channels_last and 5D weights to channels_last_3d, models of clf3D mix both,
+    unchanged if torch has no memory formats (torch < 1.5)"""
+    formats = {4: getattr(torch, 'channels_last', None), 5: getattr(torch, 'channels_last_3d', None)}
+
+    def convert(tensor):
+        memory_format = formats.get(tensor.dim())
+        return tensor if memory_format is None else tensor.contiguous(memory_format=memory_format)
+
+    return model._apply(convert)
+
+
+class InferenceRunner:
+    def __init__(self, device=None, num_threads=None, num_interop_threads=None, channels_last=None, prefetch=2):
+        """
+        :param device: device name or GPU index, see pick_device
+        :param num_threads: torch intra-op threads, on CPU defaults to available CPUs minus DataLoader workers
+        :param num_interop_threads: torch inter-op threads, torch default if None
+        :param channels_last: convert model to channels_last memory format, by default on CPU only
+        :param prefetch: number of batches loaded ahead by the loading thread, 0 loads batches in the main thread
+        """
+        self.device = pick_device(device)
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.channels_last = self.device.type == 'cpu' if channels_last is None else channels_last
+        self.prefetch = prefetch
+
+        self.images = 0
+        self.seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def load_checkpoint(self, path):
+        return torch.load(path, map_location=self.device)
+
+    def prepare(self, model):
+        """Move model to device in eval mode, in channels_last memory format if enabled"""
+        model = model.to(self.device)
+        model.eval()
+        if self.channels_last:
+            model = to_channels_last(model)
+        return model
+
+    def inference(self):
+        return inference_context()
+
+    def device_context(self):
+        """Make the GPU of the runner current, no-op on CPU"""
+        if self.device.type != 'cuda':
+            # torch.cuda.device(None) queries the current GPU on torch 1.1, which fails on CPU-only builds
+            return null_context()
+        return torch.cuda.device(self.device)
+
+    def set_threads(self, num_workers):
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+        elif self.device.type == 'cpu':
+            torch.set_num_threads(max(1, len(available_cpus()) - num_workers))
+
+        if self.num_interop_threads is not None and hasattr(torch, 'set_num_interop_threads'):
+            try:
+                torch.set_num_interop_threads(self.num_interop_threads)
+            except RuntimeError as e:
+                # torch allows it only before inter-op parallel work started
+                print(f'inter-op threads not set: {e}')
+
+    def transfer(self, batch, fields, decode, copy):
+        """Move fields of batch to device and decode them, other tensors are copied if the loader reuses batches"""
+        batch = dict(batch)
+        for name, value in batch.items():
+            if not isinstance(value, torch.Tensor):
+                continue
+            if name in fields:
+                if self.device.type == 'cuda' and not value.is_pinned():
+                    value = value.pin_memory()
+                moved = value.to(self.device, non_blocking=True)
+                if copy and moved.data_ptr() == value.data_ptr():
+                    moved = moved.clone()
+                batch[name] = decode(moved) if decode is not None else moved
+            elif copy:
+                batch[name] = value.clone()
+        return batch
+
+    def batches(self, data_loader, fields=('image',), decode=None, count_field='path'):
+        """Iterate batches of data_loader with fields moved to device and decoded, loaded ahead by a thread
+
+        :param fields: tensor fields moved to device, other fields stay on CPU
+        :param decode: function applied to moved fields, e.g. BatchDecoder.decode
+        :param count_field: field with one item per predicted image, used for images/s
+        """
+        self.set_threads(getattr(data_loader, 'num_workers', 0))
+        # batches of BatchRingLoader are only valid until the next one is requested
+        copy = self.prefetch > 0 and getattr(data_loader, 'reuses_batches', False)
+
+        start = time.time()
+        loader_iter = iter(data_loader)
+        # the first batch is taken in the main thread, so that worker processes are forked before the loading
+        # thread starts, forking while another thread holds locks can deadlock workers
+        first = next(loader_iter, None)
+        if first is None:
+            return
+        if self.prefetch == 0:
+            source = (self.transfer(batch, fields, decode, copy) for batch in _chain(first, loader_iter))
+        else:
+            source = self.prefetched(self.transfer(first, fields, decode, copy), loader_iter, fields, decode, copy)
+
+        try:
+            while True:
+                wait_start = time.time()
+                batch = next(source, None)
+                self.wait_seconds += time.time() - wait_start
+                if batch is None:
+                    break
+                yield batch
+                self.images += len(batch[count_field])
+        finally:
+            source.close()
+            self.seconds += time.time() - start
+
+    def prefetched(self, first, loader_iter, fields, decode, copy):
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def load():
+            try:
+                for batch in loader_iter:
+                    batch = self.transfer(batch, fields, decode, copy)
+                    while not stop.is_set():
+                        try:
+                            batches.put(batch, timeout=1)
+                            break
+                        except queue.Full:
+                            pass
+                    if stop.is_set():
+                        return
+                batches.put(done)
+            except Exception as e:
+                batches.put(e)
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        try:
+            yield first
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            thread.join(timeout=5)
+
+    def stats(self):
+        return {
+            'images': self.images,
+            'images_per_second': self.images / max(self.seconds, 1e-6),
+            'data_wait_fraction': self.wait_seconds / max(self.seconds, 1e-6)
+        }
+
+    def report(self, name):
+        stats = self.stats()
+        print(f'{name} on {self.device} ({torch.get_num_threads()} threads): {stats["images"]} images, '
+              f'{stats["images_per_second"]:.1f} images/s, {stats["data_wait_fraction"]:.0%} of time waiting for data')
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def add_runner_args(parser):
+    """Add --device, --threads, --interop_threads, --no_channels_last and --prefetch arguments to a predict script"""
+    parser.add_argument('--device', type=str, default=None, help='cpu, cuda or cuda:N, GPU if available by default')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch intra-op threads, defaults to available cpus minus workers on CPU')
+    parser.add_argument('--interop_threads', type=int, default=None)
+    parser.add_argument('--no_channels_last', action='store_true', help='keep contiguous weights on CPU')
+    parser.add_argument('--prefetch', type=int, default=2, help='batches loaded ahead of the model, 0 disables')
+
+
+def runner_args(args):
+    """kwargs of InferenceRunner from arguments added by add_runner_args"""
+    return dict(device=args.device, num_threads=args.threads, num_interop_threads=args.interop_threads,
+                channels_last=False if args.no_channels_last else None, prefetch=args.prefetch)
+
+
+def check_inference_runner(num_studies=3, batch_size=32, crop_size=256, num_workers=2):
+    """Compare outputs and images/s of a plain CPU loop and InferenceRunner with the 3x3 multibranch Classifier2DC"""
+    import tempfile
+
+    from torch.utils.data import DataLoader
+
+    from rsna19.configs.clf2Dc import Config
+    from rsna19.data import synthetic
+    from rsna19.data.dataset_2dc import IntracranialDataset
+    from rsna19.models.clf2Dc.classifier2dc import Classifier2DC
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_root, csv_root_dir = synthetic.generate_dataset(tmp_dir, num_studies, num_slices=(24, 32))
+        config = type('clf2Dc_resnet34_3x3', (Config,), dict(
+            data_root=data_root, csv_root_dir=csv_root_dir, val_dataset_file='5fold.csv', backbone='resnet34',
+            pretrained=None, multibranch=True, num_branches=3, multibranch_input_channels=3, num_slices=9,
+            multibranch_channel_indices=None, pre_crop_size=crop_size, padded_size=None, crop_size=crop_size,
+            gpus=[], freeze_backbone_iterations=0))
+        dataset = IntracranialDataset(config, list(range(config.nb_folds)), mode='val')
+        data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+
+        torch.manual_seed(0)
+        model = Classifier2DC(config)
+        model.eval()
+        with torch.no_grad():
+            start = time.time()
+            expected = [model(batch['image']) for batch in data_loader]
+            print(f'plain loop: {len(dataset) / (time.time() - start):.1f} images/s')
+
+        runner = InferenceRunner(device='cpu')
+        model = runner.prepare(model)
+        with runner.inference():
+            outputs = [model(batch['image']).clone() for batch in runner.batches(data_loader)]
+        runner.report('InferenceRunner')
+
+        max_diff = max((output - expected_output).abs().max().item()
+                       for output, expected_output in zip(outputs, expected))
+        assert max_diff < 1e-3, max_diff
+        print(f'max abs difference {max_diff:.2e}')
+
+
+if __name__ == '__main__':
+    check_inference_runner()
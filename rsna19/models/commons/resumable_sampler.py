@@ -0,0 +1,116 @@
+import os
+import random
+
+import numpy as np
+import torch
+from torch.utils.data.sampler import Sampler
+
+
+class ResumableRandomSampler(Sampler):
+    """Random sampler which can be stopped and resumed in the middle of an epoch.
+
+    The permutation of each epoch is derived from (seed, epoch), so the sampler state is just the epoch and the
+    position in its permutation. A DataLoader created after load_state_dict() starts at the next sample not
+    consumed by training, skipped batches are not loaded again.
+
+    set_epoch() must be called before each epoch, state_dict() needs the number of samples consumed since
+    the start of the iteration, as DataLoader workers load batches ahead of the training loop.
+    """
+
+    def __init__(self, num_samples, seed=0):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def permutation(self, epoch):
+        return np.random.RandomState([self.seed, epoch]).permutation(self.num_samples)
+
+    def __iter__(self):
+        return iter(self.permutation(self.epoch)[self.start:].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+    def state_dict(self, num_consumed):
+        """
+        :param num_consumed: samples of the current iteration used by training
+        """
+        return {
+            'seed': self.seed,
+            'epoch': self.epoch,
+            'start': self.start + num_consumed,
+            'num_samples': self.num_samples
+        }
+
+    def load_state_dict(self, state):
+        if state['num_samples'] != self.num_samples:
+            raise ValueError(f"sampler state of {state['num_samples']} samples, dataset has {self.num_samples}")
+        self.seed = state['seed']
+        self.set_epoch(state['epoch'], state['start'])
+
+
+def rng_state():
+    """Global random states of python, numpy and torch, DataLoader worker seeds are drawn from the torch state"""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(checkpoint, path):
+    """torch.save via a temporary file, so that a job killed while saving leaves the previous checkpoint intact"""
+    torch.save(checkpoint, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def check_resume(num_samples=103, batch_size=8, stop_batch=5, num_workers=2):
+    """Stop iteration of a DataLoader in the middle of an epoch and resume it with a new sampler and DataLoader"""
+    from torch.utils.data import DataLoader, Dataset
+
+    class IndexDataset(Dataset):
+        def __len__(self):
+            return num_samples
+
+        def __getitem__(self, idx):
+            return idx
+
+    dataset = IndexDataset()
+    sampler = ResumableRandomSampler(len(dataset), seed=3)
+    sampler.set_epoch(2)
+    expected = [batch.tolist() for batch in DataLoader(dataset, batch_size, sampler=sampler)]
+
+    batches = []
+    for batch_num, batch in enumerate(DataLoader(dataset, batch_size, sampler=sampler, num_workers=num_workers)):
+        batches.append(batch.tolist())
+        if batch_num + 1 == stop_batch:
+            state = sampler.state_dict(num_consumed=(batch_num + 1) * batch_size)
+            break
+
+    resumed_sampler = ResumableRandomSampler(len(dataset))
+    resumed_sampler.load_state_dict(state)
+    data_loader = DataLoader(dataset, batch_size, sampler=resumed_sampler, num_workers=num_workers)
+    assert len(data_loader) == len(expected) - stop_batch
+    batches += [batch.tolist() for batch in data_loader]
+    assert batches == expected
+    print(f'resumed at batch {stop_batch} of {len(expected)}, same batches as uninterrupted epoch')
+
+
+if __name__ == '__main__':
+    check_resume()
@@ -0,0 +1,137 @@
+import numpy as np
+from torch.utils.data.sampler import Sampler
+
+
+class StudyBlockSampler(Sampler):
+    """Shuffles studies and emits contiguous runs of slices of each study.
+
+    Consecutive samples of a run share most of their input slices, which lets datasets reuse loaded slices.
+    Randomness is traded against I/O reuse with two parameters:
+     * block_size - max length of a contiguous run of slices, None means whole study
+     * interleave - number of studies processed at the same time, their runs are emitted in round robin order
+    """
+
+    def __init__(self, study_ids, slice_nums, block_size=None, interleave=1, shuffle=True, seed=None):
+        """
+        :param study_ids: study id of each dataset sample
+        :param slice_nums: slice number of each dataset sample, used to order slices within study
+        :param shuffle: if False, studies and slices are emitted in a fixed order, e.g. for prediction
+        """
+        self.block_size = block_size
+        self.interleave = interleave
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed)
+
+        study_ids = np.asarray(study_ids)
+        slice_nums = np.asarray(slice_nums)
+        order = np.lexsort((slice_nums, study_ids))
+        _, study_starts = np.unique(study_ids[order], return_index=True)
+        self.studies = np.split(order, study_starts[1:])
+        self.num_samples = len(order)
+
+    def _study_blocks(self, study):
+        if self.block_size is None or len(study) <= self.block_size:
+            return [study]
+
+        # random first block length, so that block boundaries differ between epochs
+        first = self.random_state.randint(1, self.block_size + 1) if self.shuffle else self.block_size
+        return [study[:first]] + [study[i:i + self.block_size] for i in range(first, len(study), self.block_size)]
+
+    def __iter__(self):
+        if self.shuffle:
+            studies_order = self.random_state.permutation(len(self.studies))
+        else:
+            studies_order = np.arange(len(self.studies))
+
+        for group_start in range(0, len(studies_order), self.interleave):
+            group = [self._study_blocks(self.studies[i])
+                     for i in studies_order[group_start:group_start + self.interleave]]
+            for block_num in range(max(len(blocks) for blocks in group)):
+                for blocks in group:
+                    if block_num < len(blocks):
+                        yield from blocks[block_num].tolist()
+
+    def __len__(self):
+        return self.num_samples
+
+
+class DistributedStudySampler(Sampler):
+    """Study grouped sampler of one process of distributed data parallel training.
+
+    In every epoch studies are shuffled with the same (seed, epoch) on all ranks and their slices are concatenated,
+    each rank takes its own contiguous part of the sequence, so ranks get disjoint samples and whole studies except
+    at most one study split at each boundary. Parts have equal length, the tail of the sequence (less than
+    world_size samples) is dropped unless drop_last is False, then part lengths differ by at most 1.
+    The epoch advances after each pass, set_epoch() sets it explicitly.
+    """
+
+    def __init__(self, study_ids, slice_nums, rank, world_size, seed=0, epoch=0, shuffle=True, shuffle_slices=False,
+                 drop_last=True):
+        """
+        :param study_ids: study id of each dataset sample
+        :param slice_nums: slice number of each dataset sample, used to order slices within study
+        :param shuffle: if False, studies are taken in a fixed order, e.g. for prediction
+        :param shuffle_slices: shuffle samples within the part of the rank, otherwise slices of a study are
+            emitted in order, so that overlapping windows reuse loaded slices
+        """
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = epoch
+        self.shuffle = shuffle
+        self.shuffle_slices = shuffle_slices
+        self.drop_last = drop_last
+
+        study_ids = np.asarray(study_ids)
+        slice_nums = np.asarray(slice_nums)
+        order = np.lexsort((slice_nums, study_ids))
+        _, study_starts = np.unique(study_ids[order], return_index=True)
+        self.studies = np.split(order, study_starts[1:])
+        self.total_samples = len(order)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def rank_indices(self, epoch):
+        if self.shuffle:
+            studies_order = np.random.RandomState([self.seed, epoch]).permutation(len(self.studies))
+            indices = np.concatenate([self.studies[i] for i in studies_order])
+        else:
+            indices = np.concatenate(self.studies)
+
+        if self.drop_last:
+            num_samples = self.total_samples // self.world_size
+            indices = indices[self.rank * num_samples:(self.rank + 1) * num_samples]
+        else:
+            indices = np.array_split(indices, self.world_size)[self.rank]
+
+        if self.shuffle_slices:
+            indices = np.random.RandomState([self.seed, epoch, self.rank]).permutation(indices)
+        return indices
+
+    def __iter__(self):
+        indices = self.rank_indices(self.epoch)
+        self.epoch += 1
+        return iter(indices.tolist())
+
+    def __len__(self):
+        if self.drop_last:
+            return self.total_samples // self.world_size
+        return len(np.array_split(np.arange(self.total_samples), self.world_size)[self.rank])
+
+
+def check_sampler():
+    study_ids = np.repeat(np.arange(4), 10)
+    slice_nums = np.tile(np.arange(10), 4)
+
+    sampler = StudyBlockSampler(study_ids, slice_nums, block_size=4, interleave=2, seed=0)
+    indices = list(sampler)
+    assert sorted(indices) == list(range(40))
+    print([(study_ids[i], slice_nums[i]) for i in indices])
+
+    sampler = StudyBlockSampler(study_ids[::-1], slice_nums[::-1], shuffle=False)
+    print([(study_ids[::-1][i], slice_nums[::-1][i]) for i in sampler])
+
+
+if __name__ == '__main__':
+    check_sampler()
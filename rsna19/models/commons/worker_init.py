@@ -0,0 +1,162 @@
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+BLAS_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+def available_cpus():
+    """CPUs the process is allowed to run on, respects affinity set by taskset or docker --cpuset-cpus"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+class WorkerInit:
+    """DataLoader worker_init_fn limiting thread pools of each worker.
+
+    By default cv2, torch and BLAS start as many threads as there are cores in every worker process, so with
+    num_workers close to the number of cores cv2.resize/warpAffine threads oversubscribe the CPU and get slower
+    with more workers. The policy gives each worker an equal share of available CPUs:
+     * threads_per_worker - threads of cv2, torch and BLAS pools, defaults to cpus // num_workers (at least 1)
+     * pin_cpus - restrict each worker to its own subset of CPUs, workers share CPUs round robin if there are
+       more workers than CPUs. The main process is not pinned.
+    """
+
+    def __init__(self, num_workers, threads_per_worker=None, pin_cpus=False):
+        self.num_workers = max(num_workers, 1)
+        self.threads_per_worker = threads_per_worker
+        self.pin_cpus = pin_cpus
+
+    def worker_cpus(self, worker_id, cpus):
+        if self.num_workers >= len(cpus):
+            return [cpus[worker_id % len(cpus)]]
+        return np.array_split(cpus, self.num_workers)[worker_id].tolist()
+
+    def __call__(self, worker_id):
+        cpus = available_cpus()
+        threads = self.threads_per_worker or max(1, len(cpus) // self.num_workers)
+
+        if self.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.worker_cpus(worker_id, cpus))
+
+        cv2.setNumThreads(threads)
+        torch.set_num_threads(threads)
+        # environment is read by libraries loaded later in the worker, pools of already loaded
+        # BLAS libraries (numpy is imported before fork) are resized with threadpoolctl
+        for name in BLAS_ENV_VARS:
+            os.environ[name] = str(threads)
+        if threadpoolctl is not None:
+            threadpoolctl.threadpool_limits(threads)
+
+
+def measure_throughput(dataset, batch_size, num_workers, num_batches=None, worker_init_fn=None, sampler=None):
+    """Return DataLoader samples/s, not counting start of workers and the first batch of each worker"""
+    warmup_batches = max(num_workers, 1)
+    num_batches = num_batches or max(8, 2 * num_workers)
+    data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                             sampler=sampler or RandomSampler(dataset), worker_init_fn=worker_init_fn)
+
+    num_samples = 0
+    start = None
+    for batch_num, batch in enumerate(data_loader):
+        if batch_num == warmup_batches - 1:
+            start = time.time()
+        elif batch_num >= warmup_batches:
+            num_samples += batch_size
+            if batch_num == warmup_batches + num_batches - 1:
+                break
+    if start is None or num_samples == 0:
+        return 0.0
+    return num_samples / (time.time() - start)
+
+
+def calibrate_num_workers(dataset, batch_size, candidates=None, threads_per_worker=None, pin_cpus=False,
+                          tolerance=0.05, verbose=True):
+    """Return the smallest number of workers within tolerance of the best throughput measured on candidates
+
+    :param candidates: numbers of workers to try, defaults to powers of 2 up to the number of available CPUs
+    """
+    if candidates is None:
+        num_cpus = len(available_cpus())
+        candidates = sorted({2 ** i for i in range(int(np.log2(num_cpus)) + 1)} | {num_cpus})
+
+    throughput = {}
+    for num_workers in candidates:
+        throughput[num_workers] = measure_throughput(
+            dataset, batch_size, num_workers,
+            worker_init_fn=WorkerInit(num_workers, threads_per_worker, pin_cpus) if num_workers > 0 else None)
+        if verbose:
+            print(f'num_workers {num_workers}: {throughput[num_workers]:.1f} samples/s')
+
+    best = max(throughput.values())
+    return min(num_workers for num_workers, samples_per_second in throughput.items()
+               if samples_per_second >= best * (1 - tolerance))
+
+
+def loader_args(num_workers, dataset=None, batch_size=None, threads_per_worker=None, pin_cpus=False):
+    """Return num_workers and worker_init_fn arguments of DataLoader
+
+    :param num_workers: number of workers, or 'auto' to calibrate it on dataset with a short run
+    """
+    if num_workers == 'auto':
+        num_workers = calibrate_num_workers(dataset, batch_size, threads_per_worker=threads_per_worker,
+                                            pin_cpus=pin_cpus)
+        print(f'calibrated num_workers: {num_workers}')
+
+    return {
+        'num_workers': num_workers,
+        'worker_init_fn': WorkerInit(num_workers, threads_per_worker, pin_cpus) if num_workers > 0 else None
+    }
+
+
+def parse_num_workers(value):
+    return value if value == 'auto' else int(value)
+
+
+def add_worker_args(parser, default_num_workers):
+    """Add --num_workers, --worker_threads and --pin_worker_cpus arguments to a script's argument parser"""
+    parser.add_argument('--num_workers', type=parse_num_workers, default=default_num_workers,
+                        help="number of DataLoader workers or 'auto' to calibrate it with a short run")
+    parser.add_argument('--worker_threads', type=int, default=None,
+                        help='cv2, torch and BLAS threads of each worker, defaults to cpus // num_workers')
+    parser.add_argument('--pin_worker_cpus', action='store_true')
+
+
+def check_worker_init(num_samples=64, img_size=512):
+    """Compare throughput of cv2 augmentations in workers with default thread pools and with WorkerInit"""
+    from torch.utils.data import Dataset
+
+    class WarpDataset(Dataset):
+        def __init__(self):
+            self.img = np.random.rand(9, img_size, img_size).astype(np.float32)
+
+        def __len__(self):
+            return num_samples
+
+        def __getitem__(self, idx):
+            m = cv2.getRotationMatrix2D((img_size / 2, img_size / 2), idx % 30, 1.1)
+            img = np.stack([cv2.warpAffine(channel, m, (img_size, img_size), flags=cv2.INTER_LINEAR,
+                                           borderMode=cv2.BORDER_REPLICATE) for channel in self.img])
+            return {'image': torch.from_numpy(cv2.resize(img.transpose(1, 2, 0), (384, 384)).transpose(2, 0, 1))}
+
+    dataset = WarpDataset()
+    num_workers = len(available_cpus())
+    print(f'{num_workers} workers, default threads: '
+          f'{measure_throughput(dataset, 8, num_workers):.1f} samples/s')
+    print(f'{num_workers} workers, WorkerInit: '
+          f'{measure_throughput(dataset, 8, num_workers, worker_init_fn=WorkerInit(num_workers)):.1f} samples/s')
+    print(loader_args('auto', dataset, 8))
+
+
+if __name__ == '__main__':
+    check_worker_init()
@@ -5,7 +5,7 @@ from torch.utils.data import DataLoader
 
 import segmentation_models_pytorch as smp
 
-from rsna19.data.dataset_seg import IntracranialDataset
+from rsna19.data.dataset_seg import IntracranialDataset, create_batch_augmentation
 from rsna19.models.commons.get_base_model import load_base_weights
 from rsna19.models.commons.radam import RAdam
 
@@ -32,6 +32,15 @@ class SegmentationModel(pl.LightningModule):
                 self.model.encoder.load_state_dict(weights)
 
         self.scheduler = None
+        # training dataset, informed about global step for its negative samples curriculum
+        self.train_dataset = None
+
+        if self.config.augment and getattr(self.config, 'batch_augment', False):
+            device = f'cuda:{config.gpus[0]}' if torch.cuda.is_available() and config.gpus else None
+            self.batch_augmentation = create_batch_augmentation(config, device)
+        else:
+            self.batch_augmentation = None
+
         self.loss_func = smp.utils.losses.BCEDiceLoss(eps=1.)
 
         self.iou_metric = smp.utils.metrics.IoUMetric(eps=1., activation='sigmoid')
@@ -74,6 +83,12 @@ class SegmentationModel(pl.LightningModule):
                 'val_iou_any': val_iou_any}
 
     def on_batch_start(self, batch):
+        if self.train_dataset is not None:
+            self.train_dataset.set_global_step(self.global_step)
+
+        if self.batch_augmentation is not None:
+            batch['image'], batch['seg'] = self.batch_augmentation(batch['image'], batch['seg'])
+
         if self.config.scheduler['name'] == 'flat_anneal':
             flat_iter = self.config.scheduler['flat_iterations']
             anneal_iter = self.config.scheduler['anneal_iterations']
@@ -99,8 +114,10 @@ class SegmentationModel(pl.LightningModule):
     @pl.data_loader
     def train_dataloader(self):
         use_negatives = True if self.config.negative_data_steps is not None else False
-        return DataLoader(IntracranialDataset(self.config, self.train_folds, augment=self.config.augment,
-                                              use_negatives=use_negatives),
+        dataset = IntracranialDataset(self.config, self.train_folds, augment=self.config.augment,
+                                      use_negatives=use_negatives)
+        self.train_dataset = dataset
+        return DataLoader(dataset,
                           num_workers=self.config.num_workers,
                           batch_size=self.config.batch_size,
                           shuffle=True)